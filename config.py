@@ -1,5 +1,66 @@
 global SERVER_CONFIG
 
 SERVER_CONFIG: dict = {
-    "port": 3000
+    "port": 3000,
+    "session_grace": 60,  # seconds a disconnected user's session is kept for resuming
+    "session_log_size": 256,  # outgoing events kept per session for replay
+    "session_log_bytes": 1024 * 1024,  # cap on the size of those events; older ones are dropped past it
+    "drain_window": 30,  # seconds over which clients are told to reconnect on SIGTERM
+    "handoff_path": None,  # Unix socket path for passing the listener to a restarted server
+    "serializer_workers": 2,  # threads that build and encode large snapshots off the event loop
+    "offload_threshold": 1000,  # items in a snapshot before it is encoded on the worker pool
+    "metrics_interval": 60,  # seconds between loop lag reports
+    "mailbox_size": 100,  # unacknowledged direct messages kept per user
+    "mailbox_max_bytes": 16 * 1024 * 1024,  # encoded size of all mailboxes before the oldest messages are evicted
+    "delivery_window": 64,  # unacknowledged events in flight per reliable connection (keep below session_log_size)
+    "delivery_max_held": 4096,  # events queued behind a full window before the client is disconnected
+    "ack_timeout": 2,  # seconds without ack progress before in-flight events are resent
+    "ack_timeout_max": 30,  # cap for the doubling redelivery timeout
+    "dedup_size": 256,  # replies remembered per user for requests carrying an idempotency key
+    "dedup_ttl": 300,  # seconds a retried request is still recognised as a repeat
+    "capture_path": None,  # append every inbound frame to this JSONL file for tools/replay.py (None to disable)
+    "capture_redact": ["message", "token"],  # keys whose string values are blanked out in the capture
+    "stall_threshold": 0.25,  # seconds the event loop may be blocked before the watchdog logs its stack
+    "slow_handler_threshold": 0.1,  # seconds a single event handler may take before it is logged
+    "profile_interval": 0.005,  # seconds between sampling profiler stack samples
+    "profile_path": "profile.folded",  # collapsed-stack output written when the profiler is stopped
+    "admin_token": None,  # secret required by the profile event (None disables it; SIGUSR2 always works)
+    "overload_lag": 0.05,  # average loop lag (seconds) at which low-priority events are deferred and snapshots degrade to deltas
+    "overload_lag_critical": 0.25,  # average loop lag at which new connections are turned away as well
+    "overload_queued": 32 * 1024 * 1024,  # outbound bytes buffered across all sockets before shedding starts
+    "overload_queued_critical": 128 * 1024 * 1024,  # outbound bytes buffered before new connections are turned away
+    "max_connections": 10000,  # open sockets beyond which new connections are refused
+    "overload_retry_after": 5,  # seconds a deferred event waits for capacity; also the base retry hint for clients
+    "max_deferred": 1000,  # low-priority events allowed to wait at once before they are refused outright
+    "history_page_max": 200,  # most messages a client may ask for per snapshot or get-history page
+    "compress_min_size": 1024,  # HTTP bodies smaller than this (bytes) are sent uncompressed
+    "compress_level": 6,  # gzip level (1-9) for dynamic HTTP responses; static assets always use the maximum
+    "attachment_root": "attachments",  # directory of the content-addressed attachment store
+    "attachment_max_size": 64 * 1024 * 1024,  # largest accepted upload in bytes
+    "attachment_cache_bytes": 32 * 1024 * 1024,  # memory for the LRU of recently downloaded small attachments
+    "attachment_cache_item_max": 256 * 1024,  # attachments above this size are always sent from disk with sendfile
+    "ingest_max_bytes": 16 * 1024 * 1024,  # largest NDJSON body accepted by POST /api/ingest
+    "ingest_max_line": 64 * 1024,  # longest single NDJSON line (one message) in a bulk ingest body
+    "unix_path": None,  # also serve websockets on this Unix socket, for a reverse proxy on the same host
+    "api_unix_path": None,  # serve the HTTP Api on this Unix socket
+    "api_port": 3001,  # serve the HTTP Api (frontend, attachments, ingest) on this TCP port, or None
+    "api_max_body": 1024 * 1024,  # largest JSON request body the Api reads; uploads and ingest stream and have their own limits
+    "proxy_protocol": False,  # expect a PROXY v1/v2 header on every connection; only enable behind a proxy that sends one
+    "history_root": "history",  # where older chat history is spilled to disk; each process uses its own subdirectory
+    "history_hot_messages": 1000,  # newest messages per chat kept in memory
+    "history_segment_size": 1000,  # messages moved to disk at a time once a chat has this many past the hot limit
+    "history_idle_after": 600,  # seconds a chat goes without messages or viewers before its history is spilled
+    "history_idle_keep": 50,  # messages an idle chat keeps in memory, for the tail most clients ask for first
+    "history_open_segments": 256,  # spilled segments kept memory-mapped at once
+    "ephemeral_tick": 0.1,  # seconds typing/presence updates are coalesced before they go out
+    "ephemeral_rate": 5,  # typing/presence updates per second each user may send (bursts of twice that)
+    "ephemeral_ttl": 6,  # seconds clients keep showing a typing/presence state that isn't refreshed
+    "ws_max_size": 256 * 1024,  # largest inbound websocket frame; bigger ones close the connection (1009); the frontend's MAX_FRAME_BYTES matches it
+    "ws_max_queue": 16,  # inbound frames buffered per connection before reading from it pauses
+    "ws_write_limit": 64 * 1024,  # outbound bytes buffered per connection before sends wait for the socket
+    "max_message_length": 4000,  # characters allowed in a post-message or inbox message
+    "connection_budget": 8 * 1024 * 1024,  # bytes one connection may hold; its log is dropped past this, and it is disconnected if unsent output alone is over
+    "memory_cap": 1024 * 1024 * 1024,  # bytes all connections together may hold before the largest logs, then slowest clients, are shed
+    "memory_evict_to": 0.8,  # shedding stops once the total is back under this fraction of memory_cap
+    "search_scan_limit": 5000  # newest messages containing a query's rarest term that a search ranks, per chat
 }
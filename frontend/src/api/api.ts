@@ -1,26 +1,98 @@
+// Messages per chat snapshot and per get-history page; older ones load on scroll-up
+export const HISTORY_PAGE_SIZE = 100
+
+// Served by the HTTP Api, which also serves this frontend (the dev server proxies /api to it)
+export const ATTACHMENTS_URL = '/api/attachments'
+
+// Reconnect delays grow exponentially up to the cap, and each one is drawn uniformly
+// from [0, delay] ("full jitter") so clients dropped together don't return together
+const RECONNECT_BASE_MS = 500
+const RECONNECT_CAP_MS = 30000
+// Events queued while disconnected; past this the oldest are dropped
+const MAX_QUEUED = 500
+// Signals that are only worth sending live; they are re-sent while they hold, so never queued
+const EPHEMERAL_EVENTS = new Set(['typing', 'presence'])
+// Largest frame the server accepts (its ws_max_size); bigger ones get the socket closed
+const MAX_FRAME_BYTES = 256 * 1024
+const BATCH_ENVELOPE = '{"event":"batch","data":[]}'.length
+const encoder = new TextEncoder()
+
 type Listener<T = any> = (payload: T) => void
+type OutgoingEvent = { event: string; data: any }
 
 export class WebSocketManager {
   public currentUser: string | null = null
   private socket: WebSocket | null = null
   private listeners: Map<string, Set<Listener>> = new Map()
+  private outbox: Array<OutgoingEvent> = []
+  private sessionToken: string | null = null
+  private lastSeq = 0
+  private ackTimer: ReturnType<typeof setTimeout> | null = null
+  private url: string | null = null
+  private attempt = 0
+  private retryTimer: ReturnType<typeof setTimeout> | null = null
+  private retryHint: number | null = null
 
   connect(url: string) {
-    if (this.socket) return
+    this.url = url
+    if (this.socket || this.retryTimer !== null) return
+    this.open()
+  }
 
-    this.socket = new WebSocket(url)
-    console.log(url)
+  private open() {
+    this.socket = new WebSocket(this.url!)
+    const socket = this.socket
 
-    this.socket.onmessage = (e: MessageEvent) => {
+    socket.onopen = () => {
+      this.attempt = 0
+      // Let the server coalesce events sent in the same tick into one frame,
+      // page through the directory instead of pushing full user/chat lists,
+      // redeliver anything we haven't acknowledged, send new messages as deltas,
+      // and only send the latest page of each chat's history
+      const greeting: Array<OutgoingEvent> = [
+        {
+          event: 'hello',
+          data: {
+            batch: true,
+            paged: true,
+            reliable: true,
+            deltas: true,
+            history: HISTORY_PAGE_SIZE,
+          },
+        },
+      ]
+      // Pick the session back up where we left off, before anything queued while offline
+      if (this.sessionToken) {
+        greeting.push({
+          event: 'resume-session',
+          data: { token: this.sessionToken, seq: this.lastSeq },
+        })
+      }
+      this.outbox = [...greeting, ...this.outbox]
+      this.flush()
+    }
+
+    socket.onclose = (e: CloseEvent) => {
+      if (this.socket !== socket) return
+      this.socket = null
+      // 1013 means the server is overloaded or we fell too far behind: don't rush back
+      if (e.code === 1013 && this.retryHint === null) {
+        this.retryHint = RECONNECT_BASE_MS * 2 ** 4 * (1 + Math.random())
+      }
+      this.scheduleReconnect()
+    }
+
+    socket.onmessage = (e: MessageEvent) => {
       console.log(e)
       try {
-        const { event, data } = JSON.parse(e.data)
+        const message = JSON.parse(e.data)
 
-        const callbacks = this.listeners.get(event)
-        if (callbacks) {
-          for (const cb of callbacks) {
-            cb(data)
+        if (message.event === 'batch') {
+          for (const item of message.data) {
+            this.receive(item)
           }
+        } else {
+          this.receive(message)
         }
       } catch (err) {
         console.error('Invalid message format', err)
@@ -28,6 +100,67 @@ export class WebSocketManager {
     }
   }
 
+  private scheduleReconnect() {
+    if (this.url === null) return
+    // The server's hint (from a reconnect or overloaded event) is already jittered
+    const ceiling = Math.min(RECONNECT_CAP_MS, RECONNECT_BASE_MS * 2 ** this.attempt)
+    const delay = this.retryHint ?? Math.random() * ceiling
+    this.retryHint = null
+    this.attempt++
+    this.retryTimer = setTimeout(() => {
+      this.retryTimer = null
+      this.open()
+    }, delay)
+  }
+
+  private receive({ event, data, seq }: { event: string; data: any; seq?: number }) {
+    if (event === 'session' && data.token !== this.sessionToken) {
+      // A new session numbers its events from 1 again
+      this.sessionToken = data.token
+      this.lastSeq = 0
+    }
+    if (event === 'reconnect') {
+      // The server is restarting and will close us at its chosen time; come back shortly after
+      this.retryHint = Math.random() * RECONNECT_BASE_MS
+    }
+    if (event === 'overloaded') {
+      this.retryHint = data.retry_after
+    }
+    if (event === 'error' && data['event-type'] === 'resume-session') {
+      // The session expired while we were away; the user has to register again
+      this.sessionToken = null
+      this.currentUser = null
+      this.emit('session-expired', data)
+    }
+    if (typeof seq === 'number') {
+      // Redelivered events we already handled are dropped, but still acknowledged
+      if (seq > this.lastSeq) {
+        this.lastSeq = seq
+        this.emit(event, data)
+      }
+      this.scheduleAck()
+      return
+    }
+    this.emit(event, data)
+  }
+
+  private scheduleAck() {
+    if (this.ackTimer !== null) return
+    this.ackTimer = setTimeout(() => {
+      this.ackTimer = null
+      this.send('ack', { seq: this.lastSeq })
+    }, 100)
+  }
+
+  private emit(event: string, data: any) {
+    const callbacks = this.listeners.get(event)
+    if (callbacks) {
+      for (const cb of callbacks) {
+        cb(data)
+      }
+    }
+  }
+
   subscribe<T = any>(eventType: string, callback: Listener<T>) {
     if (!this.listeners.has(eventType)) {
       this.listeners.set(eventType, new Set())
@@ -40,19 +173,85 @@ export class WebSocketManager {
   }
 
   send(event: string, data: any) {
-    if (this.socket?.readyState === WebSocket.OPEN) {
-      this.socket.send(JSON.stringify({ event, data }))
+    const open = this.socket?.readyState === WebSocket.OPEN
+    if (!open && (this.url === null || event === 'ack' || EPHEMERAL_EVENTS.has(event))) {
+      return // not connecting, superseded by the seq in resume-session, or stale by reconnect
+    }
+
+    this.outbox.push({ event, data })
+    if (this.outbox.length > MAX_QUEUED) {
+      const dropped = this.outbox.shift()!
+      console.warn('Outbound queue full, dropping', dropped.event)
+    }
+    if (open && this.outbox.length === 1) {
+      queueMicrotask(() => this.flush())
     }
   }
+
+  private flush() {
+    // Anything queued while the socket isn't open waits for the next onopen
+    if (this.socket?.readyState !== WebSocket.OPEN || this.outbox.length === 0) return
+    const events = this.outbox
+    this.outbox = []
+
+    // Pack the queue into as few frames as fit under the server's limit, in order
+    let frame: Array<string> = []
+    let size = BATCH_ENVELOPE
+    for (const event of events) {
+      const encoded = JSON.stringify(event)
+      const bytes = encoder.encode(encoded).length + 1 // and its comma
+      if (BATCH_ENVELOPE + bytes > MAX_FRAME_BYTES) {
+        console.warn('Event too large to send, dropping', event.event)
+        continue
+      }
+      if (size + bytes > MAX_FRAME_BYTES) {
+        this.sendFrame(frame)
+        frame = []
+        size = BATCH_ENVELOPE
+      }
+      frame.push(encoded)
+      size += bytes
+    }
+    this.sendFrame(frame)
+  }
+
+  private sendFrame(encoded: Array<string>) {
+    if (encoded.length === 1) {
+      this.socket!.send(encoded[0])
+    } else if (encoded.length > 1) {
+      this.socket!.send(`{"event":"batch","data":[${encoded.join(',')}]}`)
+    }
+  }
+
+  // Upload a file for a message to carry; resolves to its hash. The session token
+  // from the websocket authorizes the request.
+  async uploadAttachment(file: File): Promise<string> {
+    if (this.sessionToken === null) throw new Error('Not registered')
+    const response = await fetch(ATTACHMENTS_URL, {
+      method: 'POST',
+      headers: {
+        Authorization: `Bearer ${this.sessionToken}`,
+        'Content-Type': file.type || 'application/octet-stream',
+      },
+      body: file,
+    })
+    if (!response.ok) throw new Error(`Upload failed: ${response.status}`)
+    return (await response.json()).hash
+  }
+
+  // Close for good: no reconnect, and queued events are dropped. Listeners stay
+  // registered, since the components that own them unsubscribe themselves.
   disconnect() {
+    this.url = null
+    if (this.retryTimer !== null) {
+      clearTimeout(this.retryTimer)
+      this.retryTimer = null
+    }
     if (this.socket && this.socket.readyState !== WebSocket.CLOSED) {
-      console.log('called')
       this.socket.close()
     }
-
-    // Clean up regardless of readyState
     this.socket = null
-    this.listeners.clear()
+    this.outbox = []
   }
 }
 
@@ -1,6 +1,15 @@
-import { useContext, useState } from 'react'
-import ChatMessageBox from './ChatMessageBox'
-import { WebSocketContext } from './WebSocketProvider'
+import { useContext, useEffect, useRef, useState } from 'react'
+import MessageList from './MessageList'
+import { WebSocketContext, useWebSocketEvent } from './WebSocketProvider'
+import { HISTORY_PAGE_SIZE } from '@/api/api'
+
+// Typing and presence are re-sent while they hold, well within the ttl the server hands out
+const TYPING_REFRESH_MS = 2000
+const TYPING_IDLE_MS = 3000
+const PRESENCE_REFRESH_MS = 3000
+
+type Activity = { typing?: boolean; status?: string; expires: number }
+type Attached = { hash: string; name: string }
 
 interface ChatAreaProps {
   chatname: string
@@ -8,6 +17,7 @@ interface ChatAreaProps {
   admin: Array<any>
   whitelist: Array<any>
   messages: Array<any>
+  more?: boolean
 }
 
 function ChatArea({
@@ -16,10 +26,77 @@ function ChatArea({
   admin,
   whitelist,
   messages,
+  more = false,
 }: ChatAreaProps) {
   const [message, setMessage] = useState('')
+  const [attachment, setAttachment] = useState<Attached | null>(null)
+  const [uploading, setUploading] = useState(false)
+  const [activity, setActivity] = useState<Record<string, Activity>>({})
+  const [now, setNow] = useState(Date.now())
+  const typingSentAt = useRef(0)
+  const typingTimer = useRef<number | null>(null)
 
   const socketManager = useContext(WebSocketContext)
+
+  // Last value wins per user; a state that isn't refreshed within its ttl lapses
+  useWebSocketEvent('room-activity', (data) => {
+    if (data.chatname !== chatname) return
+    const expires = Date.now() + data.ttl
+    setActivity((current) => {
+      const next = { ...current }
+      for (const [username, fields] of Object.entries<any>(data.users)) {
+        next[username] = { ...next[username], ...fields, expires }
+      }
+      return next
+    })
+  })
+
+  useEffect(() => {
+    const report = () =>
+      socketManager?.send('presence', {
+        chatname: chatname,
+        status: document.visibilityState === 'visible' ? 'active' : 'idle',
+      })
+    report()
+    const presenceTimer = setInterval(report, PRESENCE_REFRESH_MS)
+    const clock = setInterval(() => setNow(Date.now()), 1000)
+    document.addEventListener('visibilitychange', report)
+    return () => {
+      clearInterval(presenceTimer)
+      clearInterval(clock)
+      document.removeEventListener('visibilitychange', report)
+      stopTyping()
+      setActivity({})
+    }
+  }, [chatname])
+
+  const stopTyping = () => {
+    if (typingTimer.current !== null) clearTimeout(typingTimer.current)
+    typingTimer.current = null
+    if (typingSentAt.current) {
+      socketManager?.send('typing', { chatname: chatname, typing: false })
+      typingSentAt.current = 0
+    }
+  }
+
+  const startTyping = () => {
+    if (Date.now() - typingSentAt.current > TYPING_REFRESH_MS) {
+      socketManager?.send('typing', { chatname: chatname, typing: true })
+      typingSentAt.current = Date.now()
+    }
+    if (typingTimer.current !== null) clearTimeout(typingTimer.current)
+    typingTimer.current = window.setTimeout(stopTyping, TYPING_IDLE_MS)
+  }
+
+  const others = Object.entries(activity).filter(
+    ([username, state]) =>
+      username !== socketManager.currentUser && state.expires > now,
+  )
+  const typing = others.filter(([, state]) => state.typing).map(([name]) => name)
+  const here = others
+    .filter(([, state]) => state.status === 'active')
+    .map(([name]) => name)
+
   let isAdmin = false
   for (const user of admin) {
     if (socketManager.currentUser === user.username) {
@@ -59,7 +136,15 @@ function ChatArea({
           return <span key={e.username}>{e.username}</span>
         })}
       </div>
-      <h3>Members</h3>
+      <h3>
+        Members
+        {here.length > 0 && (
+          <span style={{ fontWeight: 'normal', fontSize: '13px' }}>
+            {' '}
+            · here now: {here.join(', ')}
+          </span>
+        )}
+      </h3>
       <div className="flex flex-wrap flex-row gap-2 p-2 w-full bg-white">
         {whitelist.map((e) => {
           return isAdmin ? (
@@ -79,25 +164,20 @@ function ChatArea({
           )
         })}
       </div>
-      <div style={{ flex: 1 }}>
-        <div
-          style={{
-            overflowY: 'scroll',
-            padding: '10px',
-            flex: 1,
-            backgroundColor: '#f9f9f9',
-          }}
-        >
-          {messages.map((message, index) => (
-            <ChatMessageBox
-              key={index}
-              name={message.user.username}
-              message={message.message}
-              chatname={chatname}
-              isAdmin={isAdmin}
-            />
-          ))}
-        </div>
+      <div style={{ flex: 1, minHeight: 0 }}>
+        <MessageList
+          chatname={chatname}
+          messages={messages}
+          isAdmin={isAdmin}
+          more={more}
+          onLoadOlder={(before) =>
+            socketManager?.send('get-history', {
+              chatname: chatname,
+              before: before,
+              limit: HISTORY_PAGE_SIZE,
+            })
+          }
+        />
       </div>
       <div
         style={{
@@ -107,12 +187,19 @@ function ChatArea({
           borderTop: '1px solid #ccc',
         }}
       >
+        <p style={{ margin: 0, minHeight: '18px', fontSize: '13px' }}>
+          {typing.length > 0 &&
+            `${typing.join(', ')} ${typing.length === 1 ? 'is' : 'are'} typing…`}
+        </p>
         <input
           type="text"
           placeholder="Type your message..."
           style={{ width: '100%', padding: '10px' }}
           value={message}
-          onChange={(e) => setMessage(e.currentTarget.value)}
+          onChange={(e) => {
+            setMessage(e.currentTarget.value)
+            startTyping()
+          }}
         />
         <button
           className="bg-blue-500 text-white rounded-md"
@@ -122,17 +209,50 @@ function ChatArea({
             borderRadius: '4px',
             cursor: 'pointer',
           }}
+          disabled={uploading}
           onClick={(e) => {
             e.preventDefault()
+            stopTyping()
             socketManager?.send('post-message', {
               chatname: chatname,
               message: message,
+              key: crypto.randomUUID(),
+              ...(attachment && { attachment: attachment.hash }),
             })
             setMessage('')
+            setAttachment(null)
           }}
         >
           Send
         </button>
+        <label
+          style={{ marginLeft: '10px', cursor: 'pointer', fontSize: '13px' }}
+        >
+          {uploading
+            ? 'Uploading…'
+            : attachment
+              ? `Attached: ${attachment.name}`
+              : 'Attach file'}
+          <input
+            type="file"
+            style={{ display: 'none' }}
+            disabled={uploading}
+            onChange={async (e) => {
+              const file = e.currentTarget.files?.[0]
+              e.currentTarget.value = ''
+              if (!file || !socketManager) return
+              setUploading(true)
+              try {
+                const hash = await socketManager.uploadAttachment(file)
+                setAttachment({ hash, name: file.name })
+              } catch (err) {
+                console.error('Attachment upload failed', err)
+              } finally {
+                setUploading(false)
+              }
+            }}
+          />
+        </label>
       </div>
     </div>
   )
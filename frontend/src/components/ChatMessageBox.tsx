@@ -1,11 +1,13 @@
 import { useContext } from 'react'
 import { WebSocketContext } from './WebSocketProvider'
+import { ATTACHMENTS_URL } from '@/api/api'
 
 interface ChatBoxProps {
   name: string
   message: string
   chatname: string
   isAdmin: boolean
+  attachment?: string
 }
 
 const ChatBox: React.FC<ChatBoxProps> = ({
@@ -13,6 +15,7 @@ const ChatBox: React.FC<ChatBoxProps> = ({
   message,
   chatname,
   isAdmin,
+  attachment,
 }) => {
   const socketManager = useContext(WebSocketContext)
   const handleClick = () => {
@@ -52,6 +55,16 @@ const ChatBox: React.FC<ChatBoxProps> = ({
         >
           {message}
         </p>
+        {attachment && (
+          <a
+            href={`${ATTACHMENTS_URL}/${attachment}`}
+            target="_blank"
+            rel="noreferrer"
+            style={{ paddingLeft: '20px', fontSize: '13px' }}
+          >
+            Attachment
+          </a>
+        )}
       </div>
       {isAdmin && (
         <button
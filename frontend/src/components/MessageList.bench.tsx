@@ -0,0 +1,49 @@
+import { bench, describe } from 'vitest'
+import { act, render } from '@testing-library/react'
+import MessageList from './MessageList'
+
+// Render cost of a large room: the first paint, and applying one appended message
+function makeMessages(count: number) {
+  return Array.from({ length: count }, (_, i) => ({
+    id: i,
+    user: { username: `user-${i % 50}`, pfp: i % 5 },
+    message: `message number ${i} in a very busy room`,
+  }))
+}
+
+for (const size of [1000, 10000, 50000]) {
+  describe(`${size} messages`, () => {
+    const messages = makeMessages(size)
+
+    bench('initial render', () => {
+      const { unmount } = render(
+        <MessageList
+          chatname="room"
+          messages={messages}
+          isAdmin={false}
+          more={false}
+          onLoadOlder={() => {}}
+        />,
+      )
+      unmount()
+    })
+
+    bench('append one message', () => {
+      const props = {
+        chatname: 'room',
+        isAdmin: false,
+        more: false,
+        onLoadOlder: () => {},
+      }
+      const { rerender, unmount } = render(
+        <MessageList {...props} messages={messages} />,
+      )
+      const appended = [
+        ...messages,
+        { id: size, user: { username: 'late', pfp: 0 }, message: 'hi' },
+      ]
+      act(() => rerender(<MessageList {...props} messages={appended} />))
+      unmount()
+    })
+  })
+}
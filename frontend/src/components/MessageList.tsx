@@ -0,0 +1,158 @@
+import { memo, useCallback, useLayoutEffect, useRef, useState } from 'react'
+import ChatMessageBox from './ChatMessageBox'
+
+// Rows are measured once rendered; until then they are assumed to be this tall
+const ESTIMATED_ROW_HEIGHT = 90
+// Extra height rendered above and below the viewport so fast scrolling doesn't show gaps
+const OVERSCAN = 600
+// How close to the top (in px) scrolling gets before older history is requested
+const LOAD_THRESHOLD = 200
+
+interface MessageListProps {
+  chatname: string
+  messages: Array<any>
+  isAdmin: boolean
+  more: boolean
+  onLoadOlder: (before: number) => void
+}
+
+const Row = memo(function Row({
+  message,
+  chatname,
+  isAdmin,
+  measure,
+}: {
+  message: any
+  chatname: string
+  isAdmin: boolean
+  measure: (id: number, el: HTMLDivElement | null) => void
+}) {
+  return (
+    <div ref={(el) => measure(message.id, el)}>
+      <ChatMessageBox
+        name={message.user.username}
+        message={message.message}
+        chatname={chatname}
+        isAdmin={isAdmin}
+        attachment={message.attachment}
+      />
+    </div>
+  )
+})
+
+// Renders only the messages near the viewport. Offsets come from measured row heights,
+// so rows of any height work; everything outside the window is replaced by spacers.
+function MessageList({
+  chatname,
+  messages,
+  isAdmin,
+  more,
+  onLoadOlder,
+}: MessageListProps) {
+  const container = useRef<HTMLDivElement>(null)
+  const heights = useRef<Map<number, number>>(new Map())
+  const [scrollTop, setScrollTop] = useState(0)
+  const [viewport, setViewport] = useState(0)
+  const [, setMeasured] = useState(0)
+  const stickToBottom = useRef(true)
+  const requestedBefore = useRef<number | null>(null)
+  const previous = useRef({ firstId: -1, scrollHeight: 0 })
+
+  const measure = useCallback((id: number, el: HTMLDivElement | null) => {
+    if (!el) return
+    const height = el.offsetHeight
+    if (height && heights.current.get(id) !== height) {
+      heights.current.set(id, height)
+      setMeasured((n) => n + 1)
+    }
+  }, [])
+
+  // Prefix sums of row heights: offsets[i] is where message i starts
+  const offsets = new Array<number>(messages.length + 1)
+  offsets[0] = 0
+  for (let i = 0; i < messages.length; i++) {
+    offsets[i + 1] =
+      offsets[i] +
+      (heights.current.get(messages[i].id) ?? ESTIMATED_ROW_HEIGHT)
+  }
+  const total = offsets[messages.length]
+
+  const height = viewport || 800
+  let first = 0
+  while (
+    first < messages.length &&
+    offsets[first + 1] < scrollTop - OVERSCAN
+  ) {
+    first++
+  }
+  let last = first
+  while (
+    last < messages.length &&
+    offsets[last] < scrollTop + height + OVERSCAN
+  ) {
+    last++
+  }
+
+  useLayoutEffect(() => {
+    const el = container.current
+    if (!el) return
+    setViewport(el.clientHeight)
+
+    const firstId = messages.length ? messages[0].id : -1
+    const before = previous.current.firstId
+    if (before !== -1 && firstId !== -1 && firstId < before) {
+      // Older history was prepended: keep the same messages in view
+      el.scrollTop += el.scrollHeight - previous.current.scrollHeight
+      requestedBefore.current = null
+    } else if (stickToBottom.current) {
+      el.scrollTop = el.scrollHeight
+    }
+    previous.current = { firstId, scrollHeight: el.scrollHeight }
+  })
+
+  const handleScroll = () => {
+    const el = container.current
+    if (!el) return
+    setScrollTop(el.scrollTop)
+    stickToBottom.current = el.scrollHeight - el.scrollTop - el.clientHeight < 20
+
+    const oldest = messages.length ? messages[0].id : null
+    if (
+      more &&
+      oldest !== null &&
+      el.scrollTop < LOAD_THRESHOLD &&
+      requestedBefore.current !== oldest
+    ) {
+      requestedBefore.current = oldest
+      onLoadOlder(oldest)
+    }
+  }
+
+  return (
+    <div
+      ref={container}
+      onScroll={handleScroll}
+      style={{
+        overflowY: 'scroll',
+        padding: '10px',
+        height: '100%',
+        backgroundColor: '#f9f9f9',
+      }}
+    >
+      {more && <p style={{ textAlign: 'center' }}>Loading older messages…</p>}
+      <div style={{ height: offsets[first] }} />
+      {messages.slice(first, last).map((message) => (
+        <Row
+          key={message.id}
+          message={message}
+          chatname={chatname}
+          isAdmin={isAdmin}
+          measure={measure}
+        />
+      ))}
+      <div style={{ height: total - offsets[last] }} />
+    </div>
+  )
+}
+
+export default MessageList
@@ -18,6 +18,50 @@ import woman from '../assets/woman.jpg'
 import { useNavigate } from 'react-router-dom'
 
 const assetImages = [anime, dog, gamer, man, woman]
+const PAGE_SIZE = 50
+
+// Same ordering the server's directory uses: case-insensitive, then exact
+function compareNames(a: string, b: string) {
+  const fa = a.toLowerCase()
+  const fb = b.toLowerCase()
+  if (fa !== fb) return fa < fb ? -1 : 1
+  return a < b ? -1 : a > b ? 1 : 0
+}
+
+// A name pushed by the server belongs in the list only if it falls inside the pages loaded so far
+function inLoadedRange(name: string, prefix: string, cursor: string | null) {
+  return (
+    name.toLowerCase().startsWith(prefix.toLowerCase()) &&
+    (cursor === null || compareNames(name, cursor) < 0)
+  )
+}
+
+function insertSorted(list: Array<any>, item: any, key: string) {
+  const index = list.findIndex((e) => compareNames(e[key], item[key]) > 0)
+  return index === -1
+    ? [...list, item]
+    : [...list.slice(0, index), item, ...list.slice(index)]
+}
+
+// A snapshot only carries the latest page of messages. Keep the older pages already loaded
+// for the same chat, and reuse message objects we already have so their rows don't re-render.
+function mergeSnapshot(current: any, snapshot: any) {
+  if (current?.chatname !== snapshot.chatname || !snapshot.messages.length) {
+    return snapshot
+  }
+  const firstId = snapshot.messages[0].id
+  const known = new Map(current.messages.map((m: any) => [m.id, m]))
+  const older = current.messages.filter((m: any) => m.id < firstId)
+  return {
+    ...snapshot,
+    more: older.length ? current.more : snapshot.more,
+    messages: [
+      ...older,
+      ...snapshot.messages.map((m: any) => known.get(m.id) ?? m),
+    ],
+  }
+}
+
 function Chat() {
   const socketManager = useContext(WebSocketContext)
   const redirect = useNavigate()
@@ -40,22 +84,55 @@ function Chat() {
   const [displayMessage, setDisplayMessage] = useState<any | null>(null)
   const [isNoAccess, setIsNoAccess] = useState(false)
   const [currentChat, setCurrentChat] = useState('')
+  const [userQuery, setUserQuery] = useState('')
+  const [userCursor, setUserCursor] = useState<string | null>(null)
+  const [chatQuery, setChatQuery] = useState('')
+  const [chatCursor, setChatCursor] = useState<string | null>(null)
 
-  useWebSocketEvent('update-user-list', (data) => {
-    setUserList(data)
-    console.log(data)
+  // Reconnected too late to resume our session on the server
+  useWebSocketEvent('session-expired', () => {
+    redirect('/')
   })
 
-  useWebSocketEvent('update-chat-list', (data) => {
-    setChatList(data)
-    console.log(data)
+  useWebSocketEvent('user-query-results', (data) => {
+    if (data.prefix !== userQuery) return
+    setUserList(data.after ? [...userList, ...data.users] : data.users)
+    setUserCursor(data.cursor)
   })
 
-  useWebSocketEvent('update-inbox', (data) => {
-    setInbox([...inbox, data])
-    console.log(data)
+  useWebSocketEvent('chat-query-results', (data) => {
+    if (data.prefix !== chatQuery) return
+    setChatList(data.after ? [...chatList, ...data.chats] : data.chats)
+    setChatCursor(data.cursor)
+  })
+
+  useWebSocketEvent('user-joined', (data) => {
+    if (inLoadedRange(data.username, userQuery, userCursor)) {
+      setUserList(insertSorted(userList, data, 'username'))
+    }
+  })
+
+  useWebSocketEvent('user-left', (data) => {
+    setUserList(userList.filter((u) => u.username !== data.username))
+  })
+
+  useWebSocketEvent('chat-added', (data) => {
+    if (inLoadedRange(data.chatname, chatQuery, chatCursor)) {
+      setChatList(insertSorted(chatList, data, 'chatname'))
+    }
   })
 
+  // Messages stay in our server-side mailbox until acknowledged, so they may arrive more than once
+  const receiveInbox = (messages: Array<any>) => {
+    const fresh = messages.filter((m) => !inbox.some((e) => e.id === m.id))
+    setInbox([...inbox, ...fresh])
+    socketManager?.send('ack-inbox', { ids: messages.map((m) => m.id) })
+  }
+
+  useWebSocketEvent('update-inbox', (data) => receiveInbox([data]))
+
+  useWebSocketEvent('inbox-backlog', (data) => receiveInbox(data))
+
   useWebSocketEvent('join-request', (data) => {
     setRequest(data)
     console.log(data)
@@ -63,8 +140,33 @@ function Chat() {
 
   useWebSocketEvent('update-chat-detail', (data) => {
     setIsNoAccess(false)
-    setDisplayMessage(data)
-    console.log(data)
+    setDisplayMessage(mergeSnapshot(displayMessage, data))
+  })
+
+  useWebSocketEvent('chat-history', (data) => {
+    if (displayMessage?.chatname !== data.chatname) return
+    const oldest = displayMessage.messages.length
+      ? displayMessage.messages[0].id
+      : Infinity
+    setDisplayMessage({
+      ...displayMessage,
+      more: data.more,
+      messages: [
+        ...data.messages.filter((m: any) => m.id < oldest),
+        ...displayMessage.messages,
+      ],
+    })
+  })
+
+  // New messages arrive as deltas instead of a full update-chat-detail
+  useWebSocketEvent('append-message', (data) => {
+    if (displayMessage?.chatname !== data.chatname) return
+    const newest = displayMessage.messages[displayMessage.messages.length - 1]
+    if (newest && newest.id >= data.message.id) return
+    setDisplayMessage({
+      ...displayMessage,
+      messages: [...displayMessage.messages, data.message],
+    })
   })
 
   useWebSocketEvent('revoke-access', (data) => {
@@ -86,7 +188,7 @@ function Chat() {
   })
 
   useWebSocketEvent('delete-chat', (data) => {
-    socketManager?.send('get-data', {})
+    setChatList(chatList.filter((c) => c.chatname !== data.chatname))
     if (currentChat == data.chatname) {
       setDisplayMessage(null)
       setCurrentChat('')
@@ -94,14 +196,24 @@ function Chat() {
   })
 
   useEffect(() => {
-    socketManager?.send('get-data', {})
+    socketManager?.send('get-inbox', {})
   }, [])
 
+  // Load the first page of each directory, again whenever its filter changes
+  useEffect(() => {
+    socketManager?.send('query-users', { prefix: userQuery, limit: PAGE_SIZE })
+  }, [userQuery])
+
+  useEffect(() => {
+    socketManager?.send('query-chats', { prefix: chatQuery, limit: PAGE_SIZE })
+  }, [chatQuery])
+
   const handleCreateChatroom = () => {
     socketManager?.send('create-chat', {
       chatname: chatroomName,
       public: isPublic,
       pfp: selectedImage,
+      key: crypto.randomUUID(),
     })
     setIsModalOpen(false)
   }
@@ -131,9 +243,16 @@ function Chat() {
             >
               Create Chatroom
             </button>
+            <input
+              type="text"
+              placeholder="Find chatroom"
+              className="border-2 border-gray-300 rounded-md p-2 mb-4 w-full"
+              value={chatQuery}
+              onChange={(e) => setChatQuery(e.currentTarget.value)}
+            />
             <ul className="overflow-y-auto max-h-60">
-              {chatList.map((chat, index) => (
-                <li key={index} className="mb-2">
+              {chatList.map((chat) => (
+                <li key={chat.chatname} className="mb-2">
                   <GroupChatBox
                     name={chat.chatname}
                     imageNum={chat.pfp}
@@ -147,16 +266,51 @@ function Chat() {
                   />
                 </li>
               ))}
+              {chatCursor && (
+                <button
+                  className="text-blue-500 w-full"
+                  onClick={() =>
+                    socketManager?.send('query-chats', {
+                      prefix: chatQuery,
+                      cursor: chatCursor,
+                      limit: PAGE_SIZE,
+                    })
+                  }
+                >
+                  Load more
+                </button>
+              )}
             </ul>
           </div>
           <div>
             <h2 className="text-xl font-bold mb-4">User List</h2>
+            <input
+              type="text"
+              placeholder="Find user"
+              className="border-2 border-gray-300 rounded-md p-2 mb-4 w-full"
+              value={userQuery}
+              onChange={(e) => setUserQuery(e.currentTarget.value)}
+            />
             <ul className="overflow-y-auto max-h-60">
-              {userList.map((user, index) => (
-                <li key={index} className="mb-2">
+              {userList.map((user) => (
+                <li key={user.username} className="mb-2">
                   <UserChatBox name={user.username} imageNum={user.pfp} />
                 </li>
               ))}
+              {userCursor && (
+                <button
+                  className="text-blue-500 w-full"
+                  onClick={() =>
+                    socketManager?.send('query-users', {
+                      prefix: userQuery,
+                      cursor: userCursor,
+                      limit: PAGE_SIZE,
+                    })
+                  }
+                >
+                  Load more
+                </button>
+              )}
             </ul>
           </div>
           {/* Bottom section */}
@@ -183,14 +337,15 @@ function Chat() {
                 socketManager?.send('inbox', {
                   username: user,
                   message: message,
+                  key: crypto.randomUUID(),
                 })
               }}
             >
               Send Message
             </button>
             <ul>
-              {inbox.map((user, index) => (
-                <li key={index} className="mb-2">
+              {inbox.map((user) => (
+                <li key={user.id} className="mb-2">
                   <PrivateChatBox
                     name={user.sender.username}
                     imageNum={user.sender.pfp}
@@ -17,7 +17,7 @@ function Register() {
   const navigate = useNavigate()
   const socketManager = useContext(WebSocketContext)
 
-  useWebSocketEvent('update-user-list', (data) => {
+  useWebSocketEvent('session', () => {
     socketManager.currentUser = username
     navigate('/chat')
   })
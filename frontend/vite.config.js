@@ -13,6 +13,10 @@ export default defineConfig({
   },
   server: {
     port: 5173,
+    // Attachments and the rest of the HTTP Api live on the server's api_port
+    proxy: {
+      '/api': 'http://localhost:3001',
+    },
   },
   resolve: {
     alias: {
@@ -0,0 +1,82 @@
+import asyncio
+import random
+
+from typing import Set
+
+NORMAL = 0
+SHEDDING = 1  # defer low-priority events and send deltas instead of snapshots
+CRITICAL = 2  # additionally turn away new connections
+
+LEVEL_NAMES = ("normal", "shedding", "critical")
+
+# Refreshes a client can safely redo later; everything else (posting, inbox, membership) keeps priority
+LOW_PRIORITY: Set[str] = {"get-user", "get-chat", "get-data", "get-history", "query-users", "query-chats", "search-messages"}
+
+
+class AdmissionControl:
+    """Turns live load signals into a shedding level.
+
+    The level rises as soon as any signal crosses its threshold, and falls one step at a
+    time only after `cooldown` consecutive calm updates, so it doesn't flap at the boundary.
+    """
+    level: int
+    deferred: int  # low-priority events currently waiting for the load to drop
+    rejected: int  # connections and events turned away since startup
+
+    def __init__(self, lag: float, lag_critical: float, queued: int, queued_critical: int,
+                 max_connections: int, retry_after: float, cooldown: int = 4):
+        self.lag = lag
+        self.lag_critical = lag_critical
+        self.queued = queued
+        self.queued_critical = queued_critical
+        self.max_connections = max_connections
+        self.retry_after = retry_after
+        self.cooldown = cooldown
+        self.level = NORMAL
+        self.deferred = 0
+        self.rejected = 0
+        self._calm_updates = 0
+        self._calm = asyncio.Event()
+        self._calm.set()
+
+    def update(self, lag: float, queued: int, connections: int) -> int:
+        """Feed the latest loop lag (seconds), outbound bytes queued and open connection count."""
+        if lag >= self.lag_critical or queued >= self.queued_critical or connections >= self.max_connections:
+            target = CRITICAL
+        elif lag >= self.lag or queued >= self.queued:
+            target = SHEDDING
+        else:
+            target = NORMAL
+
+        if target >= self.level:
+            self.level = target
+            self._calm_updates = 0
+        else:
+            self._calm_updates += 1
+            if self._calm_updates >= self.cooldown:
+                self.level -= 1
+                self._calm_updates = 0
+
+        if self.level == NORMAL:
+            self._calm.set()
+        else:
+            self._calm.clear()
+        return self.level
+
+    def admit_connection(self, connections: int) -> bool:
+        return self.level < CRITICAL and connections < self.max_connections
+
+    def should_defer(self, event: str) -> bool:
+        return self.level >= SHEDDING and event in LOW_PRIORITY
+
+    async def wait_for_capacity(self) -> bool:
+        """Wait up to retry_after for the load to drop. Returns False if it didn't."""
+        try:
+            await asyncio.wait_for(self._calm.wait(), self.retry_after)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def retry_hint(self) -> int:
+        """Milliseconds a turned-away client should wait, jittered so retries don't arrive together."""
+        return int(self.retry_after * 1000 * random.uniform(1, 2))
@@ -3,13 +3,21 @@ from pprint import pprint
 import asyncio
 import json
 from urllib.parse import quote, unquote
-import mimetypes
 import secrets
 
+from config import SERVER_CONFIG
+from src.attachments import DEFAULT_TYPE, HASH_PATTERN, AttachmentStore, AttachmentTooLarge, safe_content_type
+from src.ndjson import LineTooLong, iter_records
+from src.proxy import read_proxy_header
+from src.request_factory import RequestFactory
 from src.requests.request import Request
 from src.requests.type import REQUEST_TYPE
-from src.response import make_response
+from src.response import make_negotiated_response, make_response, negotiate_encoding, parse_range, response_head
 from src.requests.header import Header
+from src.static import StaticFiles
+
+# Endpoints that read their own request bodies from the socket, since those can be large
+STREAMING_PATHS = ("/api/ingest", "/api/attachments")
 
 
 class User:
@@ -39,10 +47,83 @@ class Api:
     groups: list[Chat]
     sse_clients: set
 
-    def __init__(self):
+    def __init__(self, bridge=None):
+        # When the Api runs inside the websocket server, the bridge lets chat users (who have
+        # a session token but no Api token) authenticate, and gives access to the real chats
+        self.bridge = bridge
         self.users = []
         self.groups = []
         self.sse_clients = set()
+        self.static = StaticFiles(os.path.join(os.path.dirname(__file__), "..", "dist"), SERVER_CONFIG["compress_min_size"])
+        if bridge is not None:
+            self.attachments = bridge.attachments  # one store, so its cache accounting stays whole
+        else:
+            self.attachments = AttachmentStore(
+                SERVER_CONFIG["attachment_root"],
+                SERVER_CONFIG["attachment_max_size"],
+                SERVER_CONFIG["attachment_cache_bytes"],
+                SERVER_CONFIG["attachment_cache_item_max"]
+            )
+
+    async def serve(self, listener, proxy_protocol: bool = False):
+        """Accept connections on a listening socket (TCP or Unix) and handle one request on each."""
+        loop = asyncio.get_running_loop()
+        listener.setblocking(False)
+        while True:
+            client, addr = await loop.sock_accept(listener)
+            asyncio.create_task(self.serve_client(loop, client, addr, proxy_protocol))
+
+    async def serve_client(self, loop: asyncio.AbstractEventLoop, client, addr, proxy_protocol: bool):
+        """Read the request from a fresh connection and pass it to handle()."""
+        try:
+            data = b""
+            if proxy_protocol:
+                # Behind a proxy, the real client address comes first on the connection
+                proxied, data = await read_proxy_header(loop, client)
+                addr = proxied or addr
+
+            while b"\r\n\r\n" not in data:
+                if len(data) > 65536:
+                    raise ValueError("request head too large")
+                chunk = await loop.sock_recv(client, 4096)
+                if not chunk:
+                    raise ConnectionError("connection closed before the request head")
+                data += chunk
+        except (ValueError, ConnectionError) as e:
+            print(f"Dropping HTTP connection from {addr}: {e}")
+            client.close()
+            return
+
+        try:
+            head, _, body = data.partition(b"\r\n\r\n")
+            try:
+                request = RequestFactory(head.decode("latin-1").split("\r\n")).create_request()
+            except ValueError as e:
+                print(f"Bad request from {addr}: {e}")
+                await loop.sock_sendall(client, make_response("Bad Request", 400))
+                return
+
+            # Streaming endpoints read the rest of the body themselves; the others get it whole
+            if request.path not in STREAMING_PATHS:
+                length = request.header.get_header("Content-Length") or "0"
+                if not length.isdigit():
+                    await loop.sock_sendall(client, make_response("Bad Request", 400))
+                    return
+                if int(length) > SERVER_CONFIG["api_max_body"]:
+                    await loop.sock_sendall(client, make_response("Content Too Large", 413))
+                    return
+                while len(body) < int(length):
+                    chunk = await loop.sock_recv(client, min(65536, int(length) - len(body)))
+                    if not chunk:
+                        raise ConnectionError("connection closed before the end of the body")
+                    body += chunk
+                body = body[:int(length)]
+            request.body = body
+            await self.handle(loop, client, addr, request)
+        except Exception as e:
+            print(f"Error handling HTTP request from {addr}: {e}")
+        finally:
+            client.close()
 
     async def handle(self, loop: asyncio.AbstractEventLoop, client, addr, request: Request):
         pprint(request)
@@ -58,7 +139,7 @@ class Api:
         elif method == REQUEST_TYPE.GET and path == "/api/status": #OK
             response = await self.status(request)
 
-        if method == REQUEST_TYPE.GET and path == "/api/chat": #OK
+        elif method == REQUEST_TYPE.GET and path == "/api/chat": #OK
             response = await self.get_all_chats(request)
 
         elif method == REQUEST_TYPE.POST and path == "/api/chat/create": #OK
@@ -70,6 +151,16 @@ class Api:
         elif method == REQUEST_TYPE.POST and path == "/api/users": #OK
             response = await self.register_user(request)
 
+        elif method == REQUEST_TYPE.POST and path == "/api/ingest":
+            response = await self.bulk_ingest(loop, client, request)
+
+        elif method == REQUEST_TYPE.POST and path == "/api/attachments":
+            response = await self.upload_attachment(loop, client, request)
+
+        elif method == REQUEST_TYPE.GET and path.startswith("/api/attachments/") and path.count("/") == 3:
+            digest = path.split("/")[-1]
+            response = await self.download_attachment(loop, client, request, digest)
+
         elif method == REQUEST_TYPE.GET and path.startswith("/api/events"):
             token = path.split("/")[-1]
             await self.handle_sse(loop, client, request, token)
@@ -106,29 +197,22 @@ class Api:
     # Frontend Routes
     async def frontend_serve(self, request: Request):
         requested_path = request.path if request.path.startswith("/") else "/" + request.path
-        
-        if requested_path.endswith("/"):
-            requested_path = "/index.html"
-
-        base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "dist"))
-        file_path = os.path.abspath(os.path.join(base_dir, requested_path.lstrip("/")))
 
-        if not file_path.startswith(base_dir):
+        file_path = self.static.resolve(requested_path)
+        if file_path is None:
             return make_response("Forbidden", 403)
-        
-        try:
-            with open(file_path, "rb") as f:
-                body = f.read()
 
-            content_type, _ = mimetypes.guess_type(file_path)
-            if not content_type:
-                content_type = "application/octet-stream"
-
-            return make_response(body, 200, content_type, is_binary=True)
-
-        except FileNotFoundError:
+        try:
+            content_type, variants = await self.static.load(file_path)
+        except (FileNotFoundError, IsADirectoryError):
             return make_response("Not Found", 404)
 
+        # Serve the precompressed variant the client prefers; Vary only matters when there are variants
+        encoding = negotiate_encoding(request.header.get_header("Accept-Encoding"))
+        if encoding not in variants:
+            encoding = None
+        return make_response(variants[encoding], 200, content_type, is_binary=True, encoding=encoding, vary=len(variants) > 1)
+
     # API Routes
 
     # GET /api/status
@@ -137,7 +221,11 @@ class Api:
 
     # GET /api/chat
     async def get_all_chats(self, request: Request) -> bytes:
-        return make_response(json.dumps([group.__dict__ for group in self.groups]), 200)
+        return make_negotiated_response(
+            request.header.get_header("Accept-Encoding"),
+            json.dumps([group.__dict__ for group in self.groups]),
+            200, "text/plain", SERVER_CONFIG["compress_min_size"], SERVER_CONFIG["compress_level"]
+        )
 
     # POST /api/chat/:chatname
     async def post_chat_message(self, request: Request, chatname: str) -> bytes:
@@ -187,6 +275,95 @@ class Api:
         except (json.JSONDecodeError, KeyError) as e:
             return make_response("Bad Request", 400)
 
+    # POST /api/ingest
+    async def bulk_ingest(self, loop, client, request: Request) -> bytes:
+        """Post many messages, to any number of chats, in one NDJSON body.
+
+        Each line is {"chatname": ..., "message": ...}. Lines are checked one by one as they
+        stream in; bad lines are reported back and don't stop the rest. Accepted messages are
+        applied at the end, in posting order, with one update per chat. Inside the chat
+        server they go to its chats, under the identity of either an Api token or a chat
+        session token; a standalone Api posts to its own chats as a chat-messages SSE event.
+        """
+        authorization = request.header.get_header("Authorization") or ""
+        token = authorization[len("Bearer "):] if authorization.startswith("Bearer ") else None
+        api_user = next((user for user in self.users if user.token == token), None) if token else None
+        if self.bridge is not None:
+            # Api users and chat sessions alike post as chat users
+            if api_user is not None:
+                this_user = self.bridge.api_user(api_user.name)
+            else:
+                this_user = self.bridge.session_user(token) if token else None
+            chat_error = self.bridge.chat_error
+        else:
+            this_user = api_user
+            groups = {group.name: group for group in self.groups}
+
+            def chat_error(user: User, chatname: str):
+                this_chat = groups.get(chatname)
+                if this_chat is None:
+                    return "Chat not found"
+                if (not this_chat.public) and (user not in this_chat.whitelist):
+                    return "Forbidden"
+                return None
+        if this_user is None:
+            return make_response("Forbidden", 403)
+
+        length = request.header.get_header("Content-Length")
+        if length is None or not length.isdigit():
+            return make_response("Length Required", 411)
+        if int(length) > SERVER_CONFIG["ingest_max_bytes"]:
+            return make_response("Content Too Large", 413)
+
+        batches = {}  # chatname -> messages, in first-seen order
+        rejected = 0
+        errors = []  # only the first few rejected lines, so a bad batch doesn't produce a huge reply
+
+        def reject(line: int, error: str):
+            nonlocal rejected
+            rejected += 1
+            if len(errors) < 100:
+                errors.append({"line": line, "error": error})
+
+        prefix = request.body.encode("latin-1") if isinstance(request.body, str) else request.body
+        try:
+            async for line, record in iter_records(loop, client, prefix, int(length), SERVER_CONFIG["ingest_max_line"]):
+                if isinstance(record, ValueError):
+                    reject(line, "Invalid JSON")
+                    continue
+                if (not isinstance(record, dict) or not isinstance(record.get("chatname"), str)
+                        or not isinstance(record.get("message"), str)):
+                    reject(line, "Expected chatname and message")
+                    continue
+                if len(record["message"]) > SERVER_CONFIG["max_message_length"]:
+                    reject(line, "Message too long")
+                    continue
+                error = chat_error(this_user, record["chatname"])
+                if error is not None:
+                    reject(line, error)
+                    continue
+                batches.setdefault(record["chatname"], []).append(record["message"])
+        except LineTooLong as e:
+            return make_response(f"Line {e} exceeds {SERVER_CONFIG['ingest_max_line']} bytes", 413)
+        except ConnectionError:
+            return make_response("Bad Request", 400)
+
+        for chatname, messages in batches.items():
+            if self.bridge is not None:
+                await self.bridge.post_messages(this_user, chatname, messages)
+                continue
+            await self.broadcast_event("chat-messages",
+                                       json.dumps({
+                                           "chatname": quote(chatname),
+                                           "user": {
+                                               "name": this_user.name,
+                                               "pfp": this_user.pfp
+                                               },
+                                           "messages": messages}))
+
+        accepted = sum(len(messages) for messages in batches.values())
+        return make_response(json.dumps({"accepted": accepted, "chats": len(batches), "rejected": rejected, "errors": errors}), 200, "application/json")
+
     # POST /api/chat/create
     async def create_chat(self, request: Request) -> bytes:
             message_data = json.loads(request.body)
@@ -378,7 +555,11 @@ class Api:
 
     # GET /api/users
     async def get_users(self, request: Request) -> bytes:
-        return make_response(json.dumps([{"name": user.name, "pfp": user.pfp} for user in self.users]), 200)
+        return make_negotiated_response(
+            request.header.get_header("Accept-Encoding"),
+            json.dumps([{"name": user.name, "pfp": user.pfp} for user in self.users]),
+            200, "text/plain", SERVER_CONFIG["compress_min_size"], SERVER_CONFIG["compress_level"]
+        )
 
     # POST /api/users
     async def register_user(self, request: Request) -> bytes:
@@ -387,8 +568,15 @@ class Api:
             user = message_data["user"]
             pfp = message_data["pfp"]
             
+            if not isinstance(user, str) or not isinstance(pfp, int):
+                return make_response("Bad Request", 400)
+
             if(user in [user.name for user in self.users]):
                 return make_response("Conflict", 409)
+
+            # Inside the chat server, the name must not clash with a chat user's either
+            if self.bridge is not None and not self.bridge.claim_name(user, pfp):
+                return make_response("Conflict", 409)
             
             token = secrets.token_hex(16)
 
@@ -401,6 +589,65 @@ class Api:
         except (json.JSONDecodeError, KeyError) as e:
             return make_response("Bad Request", 400)
 
+    # POST /api/attachments
+    async def upload_attachment(self, loop, client, request: Request) -> bytes:
+        # The body is binary, so the token comes in the Authorization header instead of JSON.
+        # Either an Api token or a chat session token will do.
+        authorization = request.header.get_header("Authorization") or ""
+        token = authorization[len("Bearer "):] if authorization.startswith("Bearer ") else None
+        if token is None or not (any(user.token == token for user in self.users)
+                                 or (self.bridge is not None and self.bridge.session_user(token) is not None)):
+            return make_response("Forbidden", 403)
+
+        length = request.header.get_header("Content-Length")
+        if length is None or not length.isdigit():
+            return make_response("Length Required", 411)
+
+        content_type = safe_content_type(request.header.get_header("Content-Type") or DEFAULT_TYPE)
+        prefix = request.body.encode("latin-1") if isinstance(request.body, str) else request.body
+        try:
+            digest, size = await self.attachments.ingest(loop, client, prefix, int(length), content_type)
+        except AttachmentTooLarge:
+            return make_response("Content Too Large", 413)
+        except ConnectionError:
+            return make_response("Bad Request", 400)
+
+        return make_response(json.dumps({"hash": digest, "size": size, "type": content_type}), 201, "application/json")
+
+    # GET /api/attachments/:hash
+    async def download_attachment(self, loop, client, request: Request, digest: str) -> bytes:
+        if not HASH_PATTERN.fullmatch(digest):
+            return make_response("Not Found", 404)
+        info = self.attachments.info(digest)
+        if info is None:
+            return make_response("Not Found", 404)
+        size, content_type = info
+
+        try:
+            byte_range = parse_range(request.header.get_header("Range"), size)
+        except ValueError:
+            return make_response("Range Not Satisfiable", 416, extra_headers={"Content-Range": f"bytes */{size}"})
+
+        # Content never changes for a given hash, so clients may cache it forever. Browsers must
+        # take the type as given, and anything not safe to show in place is downloaded instead.
+        headers = {"Accept-Ranges": "bytes", "ETag": f'"{digest}"', "Cache-Control": "public, max-age=31536000, immutable",
+                   "X-Content-Type-Options": "nosniff",
+                   "Content-Disposition": "attachment" if content_type == DEFAULT_TYPE else "inline"}
+        status, first, last = 200, 0, size - 1
+        if byte_range:
+            status, (first, last) = 206, byte_range
+            headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+
+        cached = self.attachments.read_cached(digest, size)
+        if cached is not None:
+            return make_response(cached[first:last + 1], status, content_type, is_binary=True, extra_headers=headers)
+
+        # Large blobs go straight from the file to the socket
+        await loop.sock_sendall(client, response_head(status, content_type, last - first + 1, extra_headers=headers))
+        with open(self.attachments.path(digest), "rb") as f:
+            await loop.sock_sendfile(client, f, first, last - first + 1)
+        return None
+
     # GET /api/events/:token (SSE)
     async def handle_sse(self, loop, client, request: Request, token: str) -> None:
 
@@ -430,6 +677,8 @@ class Api:
                 if user.token == token:
                     discarded_user = user
             if(discarded_user != None):
+                if self.bridge is not None:
+                    self.bridge.release_name(discarded_user.name)
                 self.broadcast_event("remove-user", json.dumps({"name": discarded_user.name, "pfp": discarded_user.pfp}))
                 self.users.remove(discarded_user)
             client.close()
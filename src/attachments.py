@@ -0,0 +1,122 @@
+import hashlib
+import os
+import re
+
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+HASH_PATTERN = re.compile(r"[0-9a-f]{64}")
+CHUNK_SIZE = 64 * 1024
+# Types a browser may render in place without running anything. Everything else (HTML, SVG,
+# scripts) is served as a download, since it would run on the site's own origin.
+INLINE_TYPES = {"image/png", "image/jpeg", "image/gif", "image/webp", "text/plain", "application/pdf"}
+DEFAULT_TYPE = "application/octet-stream"
+
+
+def safe_content_type(value: str) -> str:
+    """The type to store and serve a blob under: the declared type if it is safe to show
+    inline, with its parameters stripped, otherwise application/octet-stream."""
+    base = value.split(";", 1)[0].strip().lower()
+    return base if base in INLINE_TYPES else DEFAULT_TYPE
+
+
+class AttachmentTooLarge(Exception):
+    pass
+
+
+class AttachmentStore:
+    """Content-addressed blob store on local disk.
+
+    A blob lives at <root>/<first two hex digits>/<sha256>, so uploading the same bytes twice
+    stores them once. Uploads are hashed while they stream to a temporary file and only
+    moved into place when complete. Small blobs that are read often stay in an LRU cache.
+    """
+    root: str
+    cache: "OrderedDict[str, bytes]"  # sha256 -> contents, least recently used first
+    cache_size: int
+
+    def __init__(self, root: str, max_size: int, cache_bytes: int, cache_item_max: int):
+        self.root = os.path.abspath(root)
+        self.max_size = max_size
+        self.cache_bytes = cache_bytes
+        self.cache_item_max = cache_item_max
+        self.cache = OrderedDict()
+        self.cache_size = 0
+        os.makedirs(os.path.join(self.root, "tmp"), exist_ok=True)
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest: str) -> bool:
+        return bool(HASH_PATTERN.fullmatch(digest)) and os.path.exists(self.path(digest))
+
+    def info(self, digest: str) -> Optional[Tuple[int, str]]:
+        """Size and content type of a stored blob, or None if there is no such blob."""
+        if not self.exists(digest):
+            return None
+        try:
+            with open(self.path(digest) + ".type", encoding="utf-8") as f:
+                content_type = f.read().strip()
+        except FileNotFoundError:
+            content_type = DEFAULT_TYPE
+        return os.path.getsize(self.path(digest)), safe_content_type(content_type)
+
+    async def ingest(self, loop, client, prefix: bytes, length: int, content_type: str) -> Tuple[str, int]:
+        """Stream an upload body of `length` bytes from a socket into the store.
+
+        `prefix` is whatever part of the body was already read along with the headers.
+        The blob is stored under safe_content_type(content_type).
+        Returns the blob's sha256 and size. Raises AttachmentTooLarge or ConnectionError.
+        """
+        if length > self.max_size:
+            raise AttachmentTooLarge(length)
+
+        digest = hashlib.sha256()
+        tmp_path = os.path.join(self.root, "tmp", os.urandom(8).hex())
+        received = 0
+        try:
+            with open(tmp_path, "wb") as f:
+                chunk = prefix[:length]
+                while True:
+                    if chunk:
+                        digest.update(chunk)
+                        f.write(chunk)
+                        received += len(chunk)
+                    if received >= length:
+                        break
+                    chunk = await loop.sock_recv(client, min(CHUNK_SIZE, length - received))
+                    if not chunk:
+                        raise ConnectionError(f"upload ended after {received} of {length} bytes")
+
+            sha = digest.hexdigest()
+            final_path = self.path(sha)
+            if os.path.exists(final_path):
+                os.remove(tmp_path)  # already stored: dedup
+            else:
+                os.makedirs(os.path.dirname(final_path), exist_ok=True)
+                os.replace(tmp_path, final_path)
+                with open(final_path + ".type", "w", encoding="utf-8") as f:
+                    f.write(safe_content_type(content_type))
+            return sha, received
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def read_cached(self, digest: str, size: int) -> Optional[bytes]:
+        """Contents of a small blob from the LRU, loading it on a miss. None for blobs too big to cache."""
+        if size > self.cache_item_max:
+            return None
+        body = self.cache.get(digest)
+        if body is not None:
+            self.cache.move_to_end(digest)
+            return body
+
+        with open(self.path(digest), "rb") as f:
+            body = f.read()
+        self.cache[digest] = body
+        self.cache_size += len(body)
+        while self.cache_size > self.cache_bytes:
+            _, evicted = self.cache.popitem(last=False)
+            self.cache_size -= len(evicted)
+        return body
@@ -0,0 +1,83 @@
+from typing import Dict, Iterable, List, Tuple
+
+
+def connection_usage(conn) -> Dict[str, int]:
+    """Bytes a connection holds on the server, by where they sit.
+
+    outbound: written to the socket but not yet sent; pending: batched for the next frame;
+    held: waiting for room in the delivery window; log: kept in the session for replay.
+    Inbound frames aren't counted: websockets caps them at max_size * max_queue per connection.
+    Sizes of queued events are their lengths in characters, which for JSON is close enough.
+    """
+    return {
+        "outbound": conn.ws.transport.get_write_buffer_size() if conn.ws is not None else 0,
+        "pending": sum(len(message) for message in conn.pending),
+        "held": sum(len(message) for message in conn.window.held) if conn.window is not None else 0,
+        "log": conn.session.log_bytes if conn.session is not None else 0,
+    }
+
+
+def buffered(usage: Dict[str, int]) -> int:
+    """Bytes waiting to reach the client, as opposed to kept for a resume."""
+    return usage["outbound"] + usage["pending"] + usage["held"]
+
+
+class MemoryBudget:
+    """Per-connection and process-wide limits on connection memory.
+
+    Replay logs are the first to go: losing one costs the client a resync on its next
+    resume, nothing more. Only a connection whose unsent output alone is over its budget
+    is slow enough to be disconnected. When the total across all connections passes the
+    global cap, the largest logs are dropped, then the largest buffered connections are
+    disconnected, until it is back under `evict_to` of the cap, so that shedding doesn't
+    trigger again on the next check.
+    """
+    trimmed: int  # replay logs dropped since startup
+    evicted: int  # connections disconnected since startup
+
+    def __init__(self, per_connection: int, cap: int, evict_to: float):
+        self.per_connection = per_connection
+        self.cap = cap
+        self.evict_to = evict_to
+        self.total = 0
+        self.trimmed = 0
+        self.evicted = 0
+
+    def check(self, conns: Iterable) -> Tuple[List[Tuple[object, int]], List[Tuple[object, int]]]:
+        """Measure every connection. Returns the (connection, bytes) pairs whose replay logs
+        to drop, and those to disconnect, each largest first."""
+        usages = [(conn, connection_usage(conn)) for conn in conns]
+        self.total = sum(sum(usage.values()) for _, usage in usages)
+
+        trim, evict = [], []
+        remaining = self.total
+        kept = []
+        for conn, usage in usages:
+            if buffered(usage) > self.per_connection:
+                evict.append((conn, buffered(usage)))
+                remaining -= sum(usage.values())  # eviction drops the log as well
+            elif usage["log"] and sum(usage.values()) > self.per_connection:
+                trim.append((conn, usage["log"]))
+                remaining -= usage["log"]
+                kept.append((conn, {**usage, "log": 0}))
+            else:
+                kept.append((conn, usage))
+
+        if remaining > self.cap:
+            target = self.cap * self.evict_to
+            for conn, usage in sorted(kept, key=lambda item: item[1]["log"], reverse=True):
+                if remaining <= target or not usage["log"]:
+                    break
+                trim.append((conn, usage["log"]))
+                remaining -= usage["log"]
+            for conn, usage in sorted(kept, key=lambda item: buffered(item[1]), reverse=True):
+                if remaining <= target or not buffered(usage):
+                    break
+                evict.append((conn, buffered(usage)))
+                remaining -= buffered(usage)
+
+        trim.sort(key=lambda item: item[1], reverse=True)
+        evict.sort(key=lambda item: item[1], reverse=True)
+        self.trimmed += len(trim)
+        self.evicted += len(evict)
+        return trim, evict
@@ -0,0 +1,57 @@
+import json
+import time
+
+from typing import Dict, Iterable
+
+
+class TrafficCapture:
+    """Records every inbound frame as one JSON line, for replaying production traffic locally.
+
+    Lines carry the seconds since the capture started, a connection number and either the
+    parsed frame or an open/close marker. String values under redacted keys are replaced
+    by x's of the same length, so replays keep realistic payload sizes without the content.
+    """
+    connections: Dict[object, int]  # connection -> capture-local number
+
+    def __init__(self, path: str, redact: Iterable[str]):
+        self.file = open(path, "a", encoding="utf-8", buffering=1 << 16)
+        self.redact = set(redact)
+        self.start = time.monotonic()
+        self.connections = {}
+        self.next_id = 1
+        self._write({"capture": 1, "started": time.time()})
+
+    def opened(self, conn):
+        self.connections[conn] = self.next_id
+        self.next_id += 1
+        self._write({"t": self._now(), "conn": self.connections[conn], "open": True})
+
+    def frame(self, conn, payload):
+        conn_id = self.connections.get(conn)
+        if conn_id is not None:
+            self._write({"t": self._now(), "conn": conn_id, "frame": self._redacted(payload)})
+
+    def closed(self, conn):
+        conn_id = self.connections.pop(conn, None)
+        if conn_id is not None:
+            self._write({"t": self._now(), "conn": conn_id, "close": True})
+
+    def close(self):
+        self.file.close()
+
+    def _now(self) -> float:
+        return round(time.monotonic() - self.start, 6)
+
+    def _write(self, record: dict):
+        self.file.write(json.dumps(record, separators=(",", ":")))
+        self.file.write("\n")
+
+    def _redacted(self, value):
+        if isinstance(value, dict):
+            return {
+                key: "x" * len(item) if key in self.redact and isinstance(item, str) else self._redacted(item)
+                for key, item in value.items()
+            }
+        if isinstance(value, list):
+            return [self._redacted(item) for item in value]
+        return value
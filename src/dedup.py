@@ -0,0 +1,58 @@
+import time
+
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+
+class DedupCache:
+    """Replies to recently applied client requests, keyed by user and idempotency key.
+
+    A retried request finds its original reply here instead of being applied again.
+    Each user keeps at most per_user entries, and every entry expires after ttl seconds.
+    """
+    entries: Dict[str, "OrderedDict[str, str]"]  # username -> key -> encoded reply
+    hits: int
+
+    def __init__(self, per_user: int, ttl: float):
+        self.per_user = per_user
+        self.ttl = ttl
+        self.entries = {}
+        self.hits = 0
+        self._expiry: "OrderedDict[Tuple[str, str], float]" = OrderedDict()  # (username, key) -> deadline, oldest first
+
+    def get(self, username: str, key: str) -> Optional[str]:
+        """The reply recorded for a key, or None if it hasn't been seen (or has expired)."""
+        self._sweep()
+        reply = self.entries.get(username, {}).get(key)
+        if reply is not None:
+            self.hits += 1
+        return reply
+
+    def put(self, username: str, key: str, reply: str):
+        box = self.entries.setdefault(username, OrderedDict())
+        box[key] = reply
+        self._expiry[(username, key)] = time.monotonic() + self.ttl
+        if len(box) > self.per_user:
+            self._drop(username, next(iter(box)))
+        self._sweep()
+
+    def discard(self, username: str):
+        """Forget a user's replies, once nobody can resume as them."""
+        for key in list(self.entries.get(username, ())):
+            self._drop(username, key)
+
+    def _sweep(self):
+        now = time.monotonic()
+        while self._expiry:
+            (username, key), deadline = next(iter(self._expiry.items()))
+            if deadline > now:
+                return
+            self._drop(username, key)
+
+    def _drop(self, username: str, key: str):
+        self._expiry.pop((username, key), None)
+        box = self.entries.get(username)
+        if box is not None:
+            box.pop(key, None)
+            if not box:
+                del self.entries[username]
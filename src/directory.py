@@ -0,0 +1,33 @@
+from bisect import bisect_left, bisect_right, insort
+from typing import Iterator, List, Optional, Tuple
+
+
+class PrefixIndex:
+    """Names sorted case-insensitively, for paging through everything that starts with a prefix."""
+    keys: List[Tuple[str, str]]  # (casefolded name, name)
+
+    def __init__(self):
+        self.keys = []
+
+    def add(self, name: str):
+        insort(self.keys, (name.casefold(), name))
+
+    def remove(self, name: str):
+        key = (name.casefold(), name)
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            del self.keys[i]
+
+    def scan(self, prefix: str, after: Optional[str] = None) -> Iterator[str]:
+        """Yield names starting with prefix in order, beginning after the cursor name."""
+        folded = prefix.casefold()
+        i = bisect_left(self.keys, (folded, ""))
+        if after is not None:
+            i = max(i, bisect_right(self.keys, (after.casefold(), after)))
+
+        while i < len(self.keys):
+            key, name = self.keys[i]
+            if not key.startswith(folded):
+                return
+            yield name
+            i += 1
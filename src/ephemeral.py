@@ -0,0 +1,58 @@
+import asyncio
+import time
+
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+
+class EphemeralBus:
+    """Fan-out for high-frequency signals such as typing indicators and presence.
+
+    Updates are coalesced per (room, user) with the last value winning, and flushed once per
+    tick as a single event per room. Each sender has a token bucket of `rate` updates per
+    second (bursting to twice that); updates past it are dropped rather than queued. Nothing
+    outlives the tick it was published in, so clients expire states that stop being refreshed.
+    """
+    pending: Dict[str, Dict[str, dict]]  # room -> user -> latest fields
+    buckets: Dict[str, Tuple[float, float]]  # user -> (tokens, monotonic time of last refill)
+    dropped: int  # updates refused by the rate cap since startup
+
+    def __init__(self, tick: float, rate: float, deliver: Callable[[str, Dict[str, dict]], Awaitable[None]]):
+        self.tick = tick
+        self.rate = rate
+        self.deliver = deliver
+        self.pending = {}
+        self.buckets = {}
+        self.dropped = 0
+        self.flush_task: Optional[asyncio.Task] = None
+
+    def publish(self, room: str, user: str, fields: dict) -> bool:
+        """Queue an update for the next tick. Returns False if the sender is over its rate."""
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(user, (self.rate * 2, now))
+        tokens = min(self.rate * 2, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self.buckets[user] = (tokens, now)
+            self.dropped += 1
+            return False
+        self.buckets[user] = (tokens - 1, now)
+
+        self.pending.setdefault(room, {}).setdefault(user, {}).update(fields)
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush())
+        return True
+
+    def forget(self, user: str):
+        """Drop a departed user's rate state."""
+        self.buckets.pop(user, None)
+
+    async def _flush(self):
+        try:
+            await asyncio.sleep(self.tick)
+        finally:
+            self.flush_task = None
+        pending, self.pending = self.pending, {}
+        for room, states in pending.items():
+            try:
+                await self.deliver(room, states)
+            except Exception as e:
+                print(f"Error delivering ephemeral updates for {room}: {e}")
@@ -0,0 +1,46 @@
+import asyncio
+import os
+import socket
+
+from typing import Callable, List, Optional
+
+
+def receive_listeners(path: Optional[str]) -> List[socket.socket]:
+    """Ask the server running on the handoff path for its listening sockets."""
+    if not path or not os.path.exists(path):
+        return []
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        try:
+            conn.connect(path)
+            _, fds, _, _ = socket.recv_fds(conn, 16, 4)
+        except OSError as e:
+            print(f"Handoff from {path} failed: {e}")
+            return []
+
+    return [socket.socket(fileno=fd) for fd in fds]
+
+
+async def serve_handoff(path: str, listeners: List[socket.socket], on_handoff: Callable[[], None]):
+    """Wait for the next process to connect on path, then pass it our listening sockets."""
+    if os.path.exists(path):
+        os.unlink(path)
+
+    handoff_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    handoff_sock.bind(path)
+    handoff_sock.listen(1)
+    handoff_sock.setblocking(False)
+
+    loop = asyncio.get_running_loop()
+    try:
+        client, _ = await loop.sock_accept(handoff_sock)
+    finally:
+        # Unlink before sending so the new process can bind the path for the next restart
+        handoff_sock.close()
+        os.unlink(path)
+
+    with client:
+        client.setblocking(True)
+        socket.send_fds(client, [b"listener"], [sock.fileno() for sock in listeners])
+    print(f"Handed listening socket over via {path}")
+    on_handoff()
@@ -0,0 +1,210 @@
+import mmap
+import os
+import shutil
+import struct
+import time
+
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Callable, List
+
+OFFSET_SIZE = array("Q").itemsize  # offsets are native uint64s; segments never outlive the process that wrote them
+
+
+class Segment:
+    """A run of consecutive cold messages in one file: the encoded records back to back,
+    followed by count + 1 offsets marking where each record starts and the last one ends."""
+    __slots__ = ("path", "first_id", "count")
+
+    def __init__(self, path: str, first_id: int, count: int):
+        self.path = path
+        self.first_id = first_id
+        self.count = count
+
+
+class ColdStore:
+    """Spills old chat history to disk segments and reads it back through mmap.
+
+    Segments live in a directory of their own per process under root, since history is
+    in-memory state and a restarted server starts empty; directories left behind by
+    processes that are gone are removed on startup. Only the `max_open` most recently
+    read segments stay mapped, so open files don't grow with total history.
+    """
+    maps: "OrderedDict[str, mmap.mmap]"  # segment path -> mapped file, least recently used first
+
+    def __init__(self, root: str, hot_max: int, segment_size: int, max_open: int, decode: Callable[[bytes], object]):
+        self.root = os.path.abspath(root)
+        self.hot_max = hot_max
+        self.segment_size = segment_size
+        self.max_open = max_open
+        self.decode = decode
+        self.directory = os.path.join(self.root, str(os.getpid()))
+        self.maps = OrderedDict()
+        self.next_history = 0
+        self.spilled = 0  # messages written to segments since startup
+        self._remove_stale()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _remove_stale(self):
+        if not os.path.isdir(self.root):
+            return
+        for name in os.listdir(self.root):
+            if not name.isdigit():
+                continue
+            try:
+                os.kill(int(name), 0)
+                alive = int(name) != os.getpid()
+            except ProcessLookupError:
+                alive = False
+            except PermissionError:
+                alive = True
+            if not alive:
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+    def history(self) -> "History":
+        self.next_history += 1
+        return History(self, f"{self.next_history}-")
+
+    def write(self, prefix: str, first_id: int, records: List[bytes]) -> Segment:
+        offsets = array("Q", [0])
+        for record in records:
+            offsets.append(offsets[-1] + len(record))
+        path = os.path.join(self.directory, f"{prefix}{first_id}.seg")
+        with open(path, "wb") as f:
+            f.write(b"".join(records))
+            f.write(offsets.tobytes())
+        self.spilled += len(records)
+        return Segment(path, first_id, len(records))
+
+    def read(self, segment: Segment, start: int, stop: int) -> list:
+        """Decode the messages at positions [start, stop) of a segment."""
+        return [self.decode(record) for record in self.records(segment, start, stop)]
+
+    def read_encoded(self, segment: Segment, start: int, stop: int) -> List[str]:
+        """The encoded JSON of the messages at positions [start, stop) of a segment, without decoding it."""
+        return [record.decode() for record in self.records(segment, start, stop)]
+
+    def records(self, segment: Segment, start: int, stop: int) -> List[bytes]:
+        mapped = self._map(segment)
+        table = len(mapped) - (segment.count + 1) * OFFSET_SIZE
+        offsets = struct.unpack_from(f"={stop - start + 1}Q", mapped, table + start * OFFSET_SIZE)
+        return [mapped[offsets[i]:offsets[i + 1]] for i in range(stop - start)]
+
+    def _map(self, segment: Segment) -> mmap.mmap:
+        mapped = self.maps.get(segment.path)
+        if mapped is not None:
+            self.maps.move_to_end(segment.path)
+            return mapped
+        with open(segment.path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps[segment.path] = mapped
+        while len(self.maps) > self.max_open:
+            _, evicted = self.maps.popitem(last=False)
+            evicted.close()
+        return mapped
+
+    def discard(self, segment: Segment):
+        mapped = self.maps.pop(segment.path, None)
+        if mapped is not None:
+            mapped.close()
+        try:
+            os.remove(segment.path)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        for mapped in self.maps.values():
+            mapped.close()
+        self.maps.clear()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class History:
+    """A chat's messages, indexed by id (ids are positions, starting at 0).
+
+    Behaves like a read-only list with append: len(), indexing, slicing and iteration.
+    Messages must carry their JSON in `encoded`. The newest are kept as objects; when the
+    hot tier grows a segment's worth past its limit, the oldest are written to a segment as
+    their JSON and dropped from memory. Reading ids below the hot tier decodes them from
+    their segment, or with fragments(), copies out their JSON as is.
+    """
+    hot: list  # messages with ids hot_base .. len(self) - 1
+    hot_base: int
+    segments: List[Segment]  # in id order, covering ids 0 .. hot_base - 1
+    last_active: float  # monotonic time of the last append
+
+    def __init__(self, store: ColdStore, prefix: str):
+        self.store = store
+        self.prefix = prefix
+        self.hot = []
+        self.hot_base = 0
+        self.segments = []
+        self.starts = []  # first id of each segment, for bisecting
+        self.last_active = time.monotonic()
+
+    def __len__(self) -> int:
+        return self.hot_base + len(self.hot)
+
+    def append(self, message):
+        self.hot.append(message)
+        self.last_active = time.monotonic()
+        if len(self.hot) >= self.store.hot_max + self.store.segment_size:
+            self.spill(self.store.hot_max)
+
+    def spill(self, keep: int) -> int:
+        """Move all but the newest `keep` hot messages to a segment. Returns how many moved."""
+        count = len(self.hot) - keep
+        if count <= 0:
+            return 0
+        records = [message.encoded.encode() for message in self.hot[:count]]
+        self.segments.append(self.store.write(self.prefix, self.hot_base, records))
+        self.starts.append(self.hot_base)
+        del self.hot[:count]
+        self.hot_base += count
+        return count
+
+    def range(self, start: int, stop: int) -> list:
+        """Messages with ids in [start, stop), oldest first."""
+        return self._collect(start, stop, self.store.read, lambda message: message)
+
+    def fragments(self, start: int, stop: int) -> List[str]:
+        """Encoded JSON of the messages with ids in [start, stop), oldest first."""
+        return self._collect(start, stop, self.store.read_encoded, lambda message: message.encoded)
+
+    def _collect(self, start: int, stop: int, read_cold: Callable, read_hot: Callable) -> list:
+        start, stop = max(start, 0), min(stop, len(self))
+        result = []
+        if start < self.hot_base:
+            i = bisect_right(self.starts, start) - 1
+            while i < len(self.segments) and self.segments[i].first_id < min(stop, self.hot_base):
+                segment = self.segments[i]
+                first = max(start, segment.first_id) - segment.first_id
+                last = min(stop, segment.first_id + segment.count) - segment.first_id
+                result.extend(read_cold(segment, first, last))
+                i += 1
+        if stop > self.hot_base:
+            result.extend(map(read_hot, self.hot[max(start - self.hot_base, 0):stop - self.hot_base]))
+        return result
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError("History slices must be contiguous")
+            return self.range(start, stop)
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError(key)
+        return self.range(key, key + 1)[0]
+
+    def __iter__(self):
+        return iter(self.range(0, len(self)))
+
+    def close(self):
+        """Delete this history's segments, when its chat is deleted."""
+        for segment in self.segments:
+            self.store.discard(segment)
+        self.segments.clear()
+        self.starts.clear()
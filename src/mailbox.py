@@ -0,0 +1,67 @@
+import json
+
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+
+class MailStore:
+    """Bounded per-user mailboxes holding direct messages until the recipient acknowledges them.
+
+    Memory is accounted by encoded size. A full mailbox drops its own oldest message,
+    and once the store as a whole passes max_bytes the oldest messages anywhere go first.
+    """
+    boxes: Dict[str, "OrderedDict[int, str]"]  # username -> mail id -> encoded message
+    bytes: int
+    evicted: int
+
+    def __init__(self, per_user: int, max_bytes: int):
+        self.per_user = per_user
+        self.max_bytes = max_bytes
+        self.boxes = {}
+        self.bytes = 0
+        self.evicted = 0
+        self.next_id = 1
+        self._owners: "OrderedDict[int, str]" = OrderedDict()  # every stored mail id -> username, oldest first
+
+    def put(self, username: str, message: dict) -> Tuple[int, str]:
+        """Store a message for a user. Returns its mail id and its encoded form (which includes the id)."""
+        mail_id = self.next_id
+        self.next_id += 1
+        encoded = json.dumps({"id": mail_id, **message})
+
+        box = self.boxes.setdefault(username, OrderedDict())
+        box[mail_id] = encoded
+        self.bytes += len(encoded)
+        self._owners[mail_id] = username
+
+        if len(box) > self.per_user:
+            self._drop(username, next(iter(box)))
+            self.evicted += 1
+        while self.bytes > self.max_bytes and self._owners:
+            oldest_id, oldest_user = next(iter(self._owners.items()))
+            self._drop(oldest_user, oldest_id)
+            self.evicted += 1
+        return mail_id, encoded
+
+    def pending(self, username: str) -> List[str]:
+        """Encoded messages waiting for a user, oldest first."""
+        return list(self.boxes.get(username, {}).values())
+
+    def ack(self, username: str, mail_ids: List[int]) -> int:
+        """Forget acknowledged messages. Returns how many were removed."""
+        return sum(self._drop(username, mail_id) for mail_id in mail_ids)
+
+    def discard(self, username: str):
+        """Forget a user's whole mailbox, once nobody can resume as them."""
+        for mail_id in list(self.boxes.get(username, ())):
+            self._drop(username, mail_id)
+
+    def _drop(self, username: str, mail_id: int) -> bool:
+        box = self.boxes.get(username)
+        if not box or mail_id not in box:
+            return False
+        self.bytes -= len(box.pop(mail_id))
+        del self._owners[mail_id]
+        if not box:
+            del self.boxes[username]
+        return True
@@ -0,0 +1,64 @@
+import asyncio
+import time
+
+from typing import Dict, List
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up from a short fixed sleep."""
+    interval: float
+    last: float
+    avg: float
+    max: float
+    beat: float  # time.monotonic() of the latest wake-up, read by the watchdog thread
+
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.last = 0.0
+        self.avg = 0.0  # exponentially weighted, in seconds
+        self.max = 0.0  # since the last report
+        self.beat = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.beat = time.monotonic()
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.record(max(0.0, loop.time() - start - self.interval))
+
+    def record(self, lag: float):
+        self.last = lag
+        self.avg += (lag - self.avg) * 0.1
+        self.max = max(self.max, lag)
+
+    def report(self) -> dict:
+        """Current lag figures in milliseconds; resets the running max."""
+        report = {"last_ms": round(self.last * 1000, 2), "avg_ms": round(self.avg * 1000, 2), "max_ms": round(self.max * 1000, 2)}
+        self.max = 0.0
+        return report
+
+
+class DispatchTimer:
+    """Wall time spent in each event handler, including the time it spends awaiting sends."""
+    stats: Dict[str, List[float]]  # event -> [count, total seconds, max seconds] since the last report
+
+    def __init__(self):
+        self.stats = {}
+
+    def record(self, event: str, elapsed: float):
+        stat = self.stats.get(event)
+        if stat is None:
+            stat = self.stats[event] = [0, 0.0, 0.0]
+        stat[0] += 1
+        stat[1] += elapsed
+        stat[2] = max(stat[2], elapsed)
+
+    def report(self, top: int = 5) -> List[dict]:
+        """The handlers with the most total time since the last report, in milliseconds; resets the figures."""
+        ranked = sorted(self.stats.items(), key=lambda item: item[1][1], reverse=True)[:top]
+        self.stats = {}
+        return [
+            {"event": event, "count": count, "total_ms": round(total * 1000, 1), "max_ms": round(longest * 1000, 1)}
+            for event, (count, total, longest) in ranked
+        ]
@@ -0,0 +1,46 @@
+import json
+
+from typing import AsyncIterator, Tuple
+
+CHUNK_SIZE = 64 * 1024
+
+
+class LineTooLong(Exception):
+    pass
+
+
+async def iter_records(loop, client, prefix: bytes, length: int, max_line: int) -> AsyncIterator[Tuple[int, object]]:
+    """Yield (line number, record) for each line of an NDJSON body of `length` bytes read from a socket.
+
+    `prefix` is whatever part of the body was already read along with the headers. Lines are
+    decoded as they arrive, so only one chunk plus one partial line is held at a time. Blank
+    lines are skipped; a line that isn't valid JSON is yielded as its JSONDecodeError.
+    Raises LineTooLong or ConnectionError.
+    """
+    buffer = b""
+    received = 0
+    line_number = 0
+    chunk = prefix[:length]
+    while True:
+        received += len(chunk)
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        if len(buffer) > max_line:
+            raise LineTooLong(line_number + len(lines) + 1)
+        if received >= length:
+            lines.append(buffer)
+        for line in lines:
+            line_number += 1
+            if len(line) > max_line:
+                raise LineTooLong(line_number)
+            if not line.strip():
+                continue
+            try:
+                yield line_number, json.loads(line)
+            except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                yield line_number, e
+        if received >= length:
+            return
+        chunk = await loop.sock_recv(client, min(CHUNK_SIZE, length - received))
+        if not chunk:
+            raise ConnectionError(f"body ended after {received} of {length} bytes")
@@ -0,0 +1,97 @@
+import os
+import sys
+import threading
+import time
+import traceback
+
+from collections import Counter
+from typing import Optional
+
+from src.metrics import LoopLagMonitor
+
+
+class LoopWatchdog:
+    """Watches the lag monitor's heartbeat from a separate thread and logs where the loop is stuck.
+
+    The event loop can't report its own stalls while it is stalled, so a daemon thread checks
+    how long ago the monitor last woke up and prints the loop thread's stack once per stall.
+    """
+    stalls: int
+
+    def __init__(self, monitor: LoopLagMonitor, threshold: float):
+        self.monitor = monitor
+        self.threshold = threshold
+        self.stalls = 0
+        self.thread_id: Optional[int] = None
+
+    def start(self):
+        """Start watching the calling thread, which must be the one running the event loop."""
+        self.thread_id = threading.get_ident()
+        threading.Thread(target=self._run, name="loop-watchdog", daemon=True).start()
+
+    def _run(self):
+        stalled = False
+        while True:
+            time.sleep(min(self.threshold / 4, 0.05))
+            if not self.monitor.beat:
+                continue
+            behind = time.monotonic() - self.monitor.beat - self.monitor.interval
+            if behind <= self.threshold:
+                stalled = False
+            elif not stalled:
+                stalled = True
+                self.stalls += 1
+                frame = sys._current_frames().get(self.thread_id)
+                stack = "".join(traceback.format_stack(frame)) if frame else "  (no stack)\n"
+                print(f"Event loop stalled for {behind * 1000:.0f}ms, currently in:\n{stack}", end="")
+
+
+class SamplingProfiler:
+    """Samples the event loop thread's stack at a fixed interval while running.
+
+    Samples are kept as collapsed stacks ("file:function;file:function count"), the input
+    format for flamegraph.pl, speedscope and similar tools.
+    """
+    samples: Counter
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples = Counter()
+        self._stop: Optional[threading.Event] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._stop is not None
+
+    def start(self):
+        """Start sampling the calling thread, which must be the one running the event loop."""
+        if self.running:
+            return
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(threading.get_ident(), self._stop), name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self, path: str) -> int:
+        """Stop sampling and write the collapsed stacks to path. Returns the number of samples."""
+        if not self.running:
+            return 0
+        self._stop.set()
+        self._thread.join()
+        self._stop = self._thread = None
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write(f"{stack} {count}\n")
+        return sum(self.samples.values())
+
+    def _run(self, thread_id: int, stop: threading.Event):
+        while not stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if names:
+                self.samples[";".join(reversed(names))] += 1
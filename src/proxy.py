@@ -0,0 +1,135 @@
+import ipaddress
+import struct
+
+from typing import Optional, Tuple
+
+from websockets.asyncio.server import ServerConnection
+
+V1_PREFIX = b"PROXY "
+V1_MAX_LENGTH = 107  # longest legal v1 line, CRLF included
+V2_SIGNATURE = b"\r\n\r\n\x00\r\nQUIT\n"
+V2_HEADER_LENGTH = 16
+
+
+def parse_proxy_header(data: bytes) -> Optional[Tuple[Optional[tuple], int]]:
+    """Parse a PROXY protocol v1 or v2 header at the start of data.
+
+    Returns None while more bytes are needed, otherwise (address, header length). The address
+    is a (host, port) tuple for the original client, or None when the proxy sent a LOCAL or
+    UNKNOWN header (health checks) and the connection's own address applies.
+    Raises ValueError if data doesn't start with a valid header.
+    """
+    if data.startswith(V2_SIGNATURE):
+        return _parse_v2(data)
+    if data.startswith(V1_PREFIX):
+        return _parse_v1(data)
+    if V2_SIGNATURE.startswith(data) or V1_PREFIX.startswith(data):
+        return None
+    raise ValueError("missing PROXY header")
+
+
+def _parse_v1(data: bytes) -> Optional[Tuple[Optional[tuple], int]]:
+    end = data.find(b"\r\n", 0, V1_MAX_LENGTH)
+    if end == -1:
+        if len(data) >= V1_MAX_LENGTH:
+            raise ValueError("PROXY v1 header too long")
+        return None
+
+    parts = data[:end].decode("ascii", "replace").split(" ")
+    if len(parts) >= 2 and parts[1] == "UNKNOWN":
+        return None, end + 2
+    if len(parts) != 6 or parts[1] not in ("TCP4", "TCP6"):
+        raise ValueError(f"malformed PROXY v1 header: {data[:end]!r}")
+    _, _, source, _, source_port, _ = parts
+    host = ipaddress.ip_address(source)  # raises ValueError for a bad address
+    port = int(source_port)
+    if not 0 <= port <= 65535:
+        raise ValueError(f"bad port in PROXY v1 header: {port}")
+    return (str(host), port), end + 2
+
+
+def _parse_v2(data: bytes) -> Optional[Tuple[Optional[tuple], int]]:
+    if len(data) < V2_HEADER_LENGTH:
+        return None
+    version_command, family, length = struct.unpack("!BBH", data[12:V2_HEADER_LENGTH])
+    if version_command >> 4 != 2:
+        raise ValueError(f"unsupported PROXY version {version_command >> 4}")
+    total = V2_HEADER_LENGTH + length
+    if len(data) < total:
+        return None
+
+    command = version_command & 0x0F
+    if command == 0:  # LOCAL: the proxy's own connection, e.g. a health check
+        return None, total
+    if command != 1:
+        raise ValueError(f"unsupported PROXY v2 command {command}")
+
+    body = data[V2_HEADER_LENGTH:total]
+    address_family = family >> 4
+    if address_family == 1 and length >= 12:  # AF_INET
+        source = ipaddress.IPv4Address(body[:4])
+        (port,) = struct.unpack("!H", body[8:10])
+    elif address_family == 2 and length >= 36:  # AF_INET6
+        source = ipaddress.IPv6Address(body[:16])
+        (port,) = struct.unpack("!H", body[32:34])
+    else:
+        return None, total  # AF_UNSPEC or AF_UNIX: no useful client address
+    return (str(source), port), total
+
+
+class ProxiedConnection(ServerConnection):
+    """WebSocket connection that expects a PROXY protocol header before the HTTP handshake.
+
+    remote_address reports the client the proxy saw rather than the proxy itself. Connections
+    that don't open with a valid header are dropped.
+    """
+    proxied_address: Optional[tuple] = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._proxy_buffer = b""
+        self._proxy_done = False
+
+    @property
+    def remote_address(self):
+        return self.proxied_address or super().remote_address
+
+    def data_received(self, data: bytes) -> None:
+        if self._proxy_done:
+            super().data_received(data)
+            return
+
+        self._proxy_buffer += data
+        try:
+            parsed = parse_proxy_header(self._proxy_buffer)
+        except ValueError as e:
+            print(f"Dropping connection: {e}")
+            self.transport.close()
+            return
+        if parsed is None:
+            return
+
+        self.proxied_address, consumed = parsed
+        rest = self._proxy_buffer[consumed:]
+        self._proxy_buffer = b""
+        self._proxy_done = True
+        if rest:
+            super().data_received(rest)
+
+
+async def read_proxy_header(loop, client) -> Tuple[Optional[tuple], bytes]:
+    """Read a PROXY protocol header from a raw socket.
+
+    Returns the client address (or None, see parse_proxy_header) and any bytes read past the
+    header. Raises ValueError for a missing or invalid header and ConnectionError on EOF.
+    """
+    data = b""
+    while True:
+        parsed = parse_proxy_header(data)
+        if parsed is not None:
+            address, consumed = parsed
+            return address, data[consumed:]
+        chunk = await loop.sock_recv(client, 4096)
+        if not chunk:
+            raise ConnectionError("connection closed before the PROXY header")
+        data += chunk
@@ -24,9 +24,15 @@ class RequestFactory:
 
     
     def create_request(self) -> Request:
-        # Implement Logic to generate Request Object
+        """Build the Request from the head's lines. Raises ValueError for a malformed head."""
+        request_line = self.headers[0].split(" ")
+        if len(request_line) < 2:
+            raise ValueError(f"malformed request line: {self.headers[0]!r}")
         header:Header = Header()
         for head in self.headers[1:]:
-            key, value = head.split(": ")
+            # Only the first ": " separates the name; values may contain it too
+            key, separator, value = head.partition(": ")
+            if not separator:
+                raise ValueError(f"malformed header line: {head!r}")
             header.add_header(key, value)
-        return Request(self.headers[0].split(" ")[1], header, "", self.get_request_type())
\ No newline at end of file
+        return Request(request_line[1], header, "", self.get_request_type())
\ No newline at end of file
@@ -6,7 +6,14 @@ class Header:
         self.headers[name] = value
 
     def get_header(self, name):
-        return self.headers.get(name)
+        value = self.headers.get(name)
+        if value is None:
+            # Header names are case-insensitive
+            folded = name.lower()
+            for key, candidate in self.headers.items():
+                if key.lower() == folded:
+                    return candidate
+        return value
 
     def to_http(self):
         return '\r\n'.join(f'{name}: {value}' for name, value in self.headers.items())
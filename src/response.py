@@ -1,27 +1,132 @@
-def make_response(body: str = "", status: int = 200, content_type: str = "text/plain", is_binary: bool = False) -> bytes:
+import gzip
+
+from typing import Dict, Optional, Tuple
+
+try:
+    import brotli  # optional: pip install brotli
+except ImportError:
+    brotli = None
+
+# Content types worth compressing; images, fonts and archives are already compressed
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml", "application/wasm")
+
+
+def available_encodings() -> tuple:
+    """Encodings this server can produce, most preferred first."""
+    return ("br", "gzip") if brotli else ("gzip",)
+
+
+def is_compressible(content_type: str) -> bool:
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Pick the best encoding the client accepts from an Accept-Encoding header, or None for identity."""
+    if not accept_encoding:
+        return None
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+
+    best, best_weight = None, 0.0
+    for encoding in available_encodings():
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def compress(body: bytes, encoding: str, level: int = 6) -> bytes:
+    """Compress a body. Levels are gzip's 1-9 scale; brotli's quality is scaled to match."""
+    if encoding == "br":
+        return brotli.compress(body, quality=min(11, level + level // 3))
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+def response_head(status: int, content_type: str, content_length: int, encoding: Optional[str] = None,
+                  vary: bool = False, extra_headers: Optional[Dict[str, str]] = None) -> bytes:
+    """Status line and headers, for responses whose body is written separately (e.g. with sendfile)."""
     reason = {
         200: "OK",
         201: "Created",
         204: "No Content",
+        206: "Partial Content",
         400: "Bad Request",
         403: "Forbidden",
         404: "Not Found",
         409: "Conflict",
+        411: "Length Required",
+        413: "Content Too Large",
+        416: "Range Not Satisfiable",
         500: "Internal Server Error",
         501: "Not Implemented"
     }.get(status, "OK")
     headers = (
         f"HTTP/1.1 {status} {reason}\r\n"
         f"Content-Type: {content_type}\r\n"
-        f"Content-Length: {len(body)}\r\n"
-        "Access-Control-Allow-Origin: *\r\n"
+        f"Content-Length: {content_length}\r\n"
+        + (f"Content-Encoding: {encoding}\r\n" if encoding else "")
+        + ("Vary: Accept-Encoding\r\n" if vary else "")
+        + "".join(f"{name}: {value}\r\n" for name, value in (extra_headers or {}).items())
+        + "Access-Control-Allow-Origin: *\r\n"
         "Access-Control-Allow-Methods: GET, POST, PUT, DELETE, OPTIONS\r\n"
         "Access-Control-Allow-Headers: Content-Type, Authorization\r\n"
         "Connection: close\r\n"
         "\r\n"
     )
+    return headers.encode()
+
+
+def make_response(body: str = "", status: int = 200, content_type: str = "text/plain", is_binary: bool = False,
+                  encoding: Optional[str] = None, vary: bool = False, extra_headers: Optional[Dict[str, str]] = None) -> bytes:
+    payload = body if is_binary else body.encode()
+    return response_head(status, content_type, len(payload), encoding, vary, extra_headers) + payload
+
+
+def parse_range(value: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single-range Range header into (first, last) byte positions, inclusive.
+
+    Returns None when the whole body should be sent (no header, or one we don't handle,
+    such as multiple ranges). Raises ValueError for a range outside the body.
+    """
+    if not value or not value.startswith("bytes=") or "," in value:
+        return None
+    first, _, last = value[6:].strip().partition("-")
+    try:
+        start = int(first) if first else None
+        end = int(last) if last else None
+    except ValueError:
+        return None
+    if start is None:
+        # Suffix range: the last N bytes
+        if end is None:
+            return None
+        if end <= 0:
+            raise ValueError(value)
+        return max(0, size - end), size - 1
+    if end is None:
+        end = size - 1
+    if start >= size or end < start:
+        raise ValueError(value)
+    return start, min(end, size - 1)
+
+
+def make_negotiated_response(accept_encoding: Optional[str], body: str, status: int = 200,
+                             content_type: str = "application/json", min_size: int = 1024, level: int = 6) -> bytes:
+    """Like make_response, but compresses bodies of at least min_size bytes when the client accepts it.
 
-    if is_binary:
-        return headers.encode() + body
-    else:
-        return (headers + body).encode()
\ No newline at end of file
+    The response always carries Vary: Accept-Encoding, since the same URL may be served either way.
+    """
+    payload = body.encode()
+    encoding = negotiate_encoding(accept_encoding) if len(payload) >= min_size else None
+    if encoding:
+        payload = compress(payload, encoding, level)
+    return make_response(payload, status, content_type, is_binary=True, encoding=encoding, vary=True)
@@ -0,0 +1,83 @@
+import heapq
+import math
+import re
+
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from typing import Dict, List, Tuple
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class Posting:
+    """Messages containing a term, as parallel arrays kept in message id order."""
+    __slots__ = ("ids", "freqs")
+
+    def __init__(self):
+        self.ids = array("I")
+        self.freqs = array("H")
+
+
+class SearchIndex:
+    """Incremental inverted index over one chat's messages."""
+    postings: Dict[str, Posting]
+    documents: int
+
+    def __init__(self):
+        self.postings = {}
+        self.documents = 0
+
+    def add(self, message_id: int, text: str):
+        """Index a message. Ids must be added in increasing order."""
+        self.documents += 1
+        for term, freq in Counter(tokenize(text)).items():
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = Posting()
+            posting.ids.append(message_id)
+            posting.freqs.append(min(freq, 0xFFFF))
+
+    def search(self, terms: List[str], limit: int, scan_limit: int) -> Tuple[int, bool, List[Tuple[float, int]]]:
+        """Rank messages containing every term by tf-idf, newest first on ties.
+
+        Only the newest `scan_limit` messages containing the rarest term are considered, so a
+        query over common words costs the same however long the history grows. Returns the
+        number of matches within that scan, whether it covered every candidate, and the best
+        `limit` of the matches as (score, message id).
+        """
+        postings = []
+        for term in set(terms):
+            posting = self.postings.get(term)
+            if posting is None:
+                return 0, True, []
+            postings.append(posting)
+
+        # Walk the newest part of the rarest term and probe the others by binary search
+        postings.sort(key=lambda p: len(p.ids))
+        weights = [math.log(1 + self.documents / len(p.ids)) for p in postings]
+        first, rest = postings[0], list(zip(postings[1:], weights[1:]))
+        start = max(len(first.ids) - scan_limit, 0)
+        ids, freqs = first.ids[start:], first.freqs[start:]
+
+        if not rest:
+            top = heapq.nlargest(limit, zip(freqs, ids))
+            return len(ids), start == 0, [(freq * weights[0], message_id) for freq, message_id in top]
+
+        matches = []
+        bounds = [len(posting.ids) for posting, _ in rest]
+        for freq, message_id in zip(reversed(freqs), reversed(ids)):
+            score = freq * weights[0]
+            for j, (posting, weight) in enumerate(rest):
+                # Ids only go down from here, so later probes search below this one
+                i = bounds[j] = bisect_left(posting.ids, message_id, 0, bounds[j])
+                if i == len(posting.ids) or posting.ids[i] != message_id:
+                    break
+                score += posting.freqs[i] * weight
+            else:
+                matches.append((score, message_id))
+        return len(matches), start == 0, heapq.nlargest(limit, matches)
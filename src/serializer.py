@@ -0,0 +1,41 @@
+import asyncio
+import json
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+CHUNK_SIZE = 256  # list items encoded per call, so the GIL can change hands between chunks
+
+
+def dumps_chunked(value) -> str:
+    """json.dumps with default separators, but encoding long lists a chunk at a time."""
+    if isinstance(value, list) and len(value) > CHUNK_SIZE:
+        chunks = (json.dumps(value[i:i + CHUNK_SIZE])[1:-1] for i in range(0, len(value), CHUNK_SIZE))
+        return f"[{', '.join(chunks)}]"
+    if isinstance(value, dict):
+        return "{" + ", ".join(f"{json.dumps(key)}: {dumps_chunked(item)}" for key, item in value.items()) + "}"
+    return json.dumps(value)
+
+
+class Serializer:
+    """Encodes events, moving large payloads onto a thread pool so the loop keeps serving other clients."""
+    threshold: int
+    offloaded: int
+
+    def __init__(self, workers: int, threshold: int):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="serializer")
+        self.threshold = threshold
+        self.offloaded = 0
+
+    async def encode(self, event_type: str, size: int, build: Callable) -> str:
+        """Encode {"event": event_type, "data": build()}.
+
+        size is the number of items in the payload. At or above the threshold, build runs
+        on the pool too, so it must only read data that the loop won't mutate meanwhile.
+        """
+        if size < self.threshold:
+            return json.dumps({"event": event_type, "data": build()})
+
+        self.offloaded += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, lambda: dumps_chunked({"event": event_type, "data": build()}))
@@ -1,24 +1,59 @@
 import asyncio
+import heapq
 import websockets
 import json
-
-from typing import Dict, List
+import math
+import os
+import random
+import signal
+import socket
+import time
+
+from http import HTTPStatus
+from typing import Dict, List, Optional, Set
+
+from config import SERVER_CONFIG
+from src.admission import CRITICAL, LEVEL_NAMES, SHEDDING, AdmissionControl
+from src.api import Api
+from src.attachments import AttachmentStore
+from src.budget import MemoryBudget, connection_usage
+from src.capture import TrafficCapture
+from src.dedup import DedupCache
+from src.ephemeral import EphemeralBus
+from src.handoff import receive_listeners, serve_handoff
+from src.history import ColdStore, History
+from src.mailbox import MailStore
+from src.metrics import DispatchTimer, LoopLagMonitor
+from src.profiler import LoopWatchdog, SamplingProfiler
+from src.proxy import ProxiedConnection
+from src.search import SearchIndex, tokenize
+from src.serializer import Serializer
+from src.session import Connection, DeliveryWindow, Session
+from src.state import StateEngine
 
 class User:
     name: str
     pfp: int
+    encoded: str  # JSON of user_to_dict(), built once since users never change
 
     def __init__(self, name, pfp):
         self.name = name
         self.pfp = pfp
+        self.encoded = json.dumps({"username": name, "pfp": pfp})
 
 class Message:
+    id: int
     user: User
     message: str
+    attachment: Optional[str]  # sha256 of a blob in the attachment store
+    encoded: Optional[str]  # JSON sent to clients for this message, built once it has its id
 
-    def __init__(self, user, message):
+    def __init__(self, user, message, attachment=None):
+        self.id = -1  # assigned when added to a chat
         self.user = user
         self.message = message
+        self.attachment = attachment
+        self.encoded = None
 
 class Chat:
     name: str
@@ -26,7 +61,8 @@ class Chat:
     admin: List[User]
     public: bool
     whitelist: List[User]
-    messages: List[Message]
+    messages: History
+    index: SearchIndex
 
     def __init__(self, name, pfp, admin, public):
         self.name = name
@@ -34,47 +70,135 @@ class Chat:
         self.admin = [admin]
         self.public = public
         self.whitelist = []
-        self.messages = []
+        self.messages = cold_history.history()
+        self.index = SearchIndex()
     
     def add_message(self, message: Message):
+        message.id = len(self.messages)
+        message.encoded = encode_message(message)
         self.messages.append(message)
-
-
-# Global dictionaries for tracking users and chats
-connected_users: Dict[websockets.WebSocketServerProtocol, User] = {}
-active_chats: Dict[str, Chat] = {}
-focused_chats: Dict[str, List[websockets.WebSocketServerProtocol]] = {}  # chatname -> list of clients
+        self.index.add(message.id, message.message)
+
+
+def decode_cold_message(record: bytes) -> Message:
+    """Rebuild a message moved out of memory from its record, which is its encoded JSON."""
+    fields = json.loads(record)
+    message = Message(User(fields["user"]["username"], fields["user"]["pfp"]), fields["message"], fields.get("attachment"))
+    message.id = fields["id"]
+    message.encoded = record.decode()
+    return message
+
+
+# Shared state is owned by the engine; these names are read-only views of it.
+# Mutate through state.apply() and iterate snapshots (state.clients() etc.) across awaits.
+state = StateEngine()
+connected_users: Dict[Connection, User] = state.users
+active_chats: Dict[str, Chat] = state.chats
+focused_chats: Dict[str, List[Connection]] = state.focused  # chatname -> list of clients
+sessions: Dict[str, Connection] = state.sessions  # resume token -> connection holding the session
+open_connections: Set[Connection] = set()  # every live socket, registered or not
+api_users: Dict[str, User] = {}  # name -> chat identity of a user registered through the HTTP Api
+
+serializer = Serializer(SERVER_CONFIG["serializer_workers"], SERVER_CONFIG["offload_threshold"])
+lag_monitor = LoopLagMonitor()
+watchdog = LoopWatchdog(lag_monitor, SERVER_CONFIG["stall_threshold"])
+dispatch_timer = DispatchTimer()
+profiler = SamplingProfiler(SERVER_CONFIG["profile_interval"])
+mailboxes = MailStore(SERVER_CONFIG["mailbox_size"], SERVER_CONFIG["mailbox_max_bytes"])
+attachments = AttachmentStore(
+    SERVER_CONFIG["attachment_root"],
+    SERVER_CONFIG["attachment_max_size"],
+    SERVER_CONFIG["attachment_cache_bytes"],
+    SERVER_CONFIG["attachment_cache_item_max"]
+)
+cold_history = ColdStore(
+    SERVER_CONFIG["history_root"],
+    SERVER_CONFIG["history_hot_messages"],
+    SERVER_CONFIG["history_segment_size"],
+    SERVER_CONFIG["history_open_segments"],
+    decode_cold_message
+)
+replies = DedupCache(SERVER_CONFIG["dedup_size"], SERVER_CONFIG["dedup_ttl"])
+capture: Optional[TrafficCapture] = None  # opened by main() when capture_path is set
+admission = AdmissionControl(
+    SERVER_CONFIG["overload_lag"],
+    SERVER_CONFIG["overload_lag_critical"],
+    SERVER_CONFIG["overload_queued"],
+    SERVER_CONFIG["overload_queued_critical"],
+    SERVER_CONFIG["max_connections"],
+    SERVER_CONFIG["overload_retry_after"]
+)
+memory_budget = MemoryBudget(SERVER_CONFIG["connection_budget"], SERVER_CONFIG["memory_cap"], SERVER_CONFIG["memory_evict_to"])
+deferred_events = set()  # (connection, event, data) waiting for the load to drop, so repeats aren't queued twice
 
 
 # === HELPER FUNCTIONS ===
 
 def broadcast(event_type, data, clients):
     """Send a message to all clients in a specified list."""
-    message = json.dumps({"event": event_type, "data": data})
+    return send_all(json.dumps({"event": event_type, "data": data}), clients)
 
+
+def send_all(message: str, clients):
+    """Send an already encoded event to all clients in a specified list."""
     async def safe_send(client):
         try:
             await asyncio.wait_for(client.send(message), timeout=5)  # Set a 5-second timeout
         except asyncio.TimeoutError:
             print(f"Timeout: Failed to send message to client {client}")
         except websockets.ConnectionClosed:
-            print(f"Connection closed: Removing client {client}")
-            if client in connected_users:
-                del connected_users[client]
-            for chat_ws_list in focused_chats.values():
-                if client in chat_ws_list:
-                    chat_ws_list.remove(client)
+            # The client's own handler notices the close and runs its cleanup
+            print(f"Connection closed: Skipping client {client}")
         except Exception as e:
             print(f"Error sending message to client {client}: {e}")
 
     return asyncio.gather(*(safe_send(client) for client in clients))
 
 
+def split_by_deltas(clients, shedding: bool):
+    """Split recipients of a new message into clients that need a chat snapshot and clients that
+    take an append-message delta: those paging through history always, the others only under load."""
+    full, deltas = [], []
+    for client in clients:
+        (deltas if client.history or (shedding and client.deltas) else full).append(client)
+    return full, deltas
+
+
+def split_by_paging(clients):
+    """Split recipients into clients that take full user/chat lists and clients that page the directory."""
+    full, paged = [], []
+    for client in clients:
+        (paged if client.paged else full).append(client)
+    return full, paged
+
+
+def page_names(index, prefix, cursor, limit, keep):
+    """Take up to limit names from a prefix scan that pass keep. Returns (names, next cursor)."""
+    names = []
+    for name in index.scan(prefix, cursor):
+        if keep(name):
+            names.append(name)
+            if len(names) > limit:
+                return names[:limit], names[limit - 1]
+    return names, None
+
+
 def user_to_dict(user: User):
     """Convert a User object to a dictionary."""
     return {"username": user.name, "pfp": user.pfp}
 
 
+def encode_message(message: Message) -> str:
+    """A message's JSON as clients receive it: id, user, text and the attachment hash if any."""
+    attachment = f', "attachment": {json.dumps(message.attachment)}' if message.attachment else ""
+    return f'{{"id": {message.id}, "user": {message.user.encoded}, "message": {json.dumps(message.message)}{attachment}}}'
+
+
+def encode_list(fragments) -> str:
+    """Splice already-encoded JSON values into a JSON array."""
+    return "[" + ", ".join(fragments) + "]"
+
+
 def chat_to_dict(chat: Chat):
     """Convert a Chat object to a dictionary."""
     return {
@@ -84,15 +208,173 @@ def chat_to_dict(chat: Chat):
     }
 
 
-def chat_detail_to_dict(chat: Chat):
-    """Convert detailed Chat information (including messages) to a dictionary."""
-    return {
-        "chatname": chat.name,
-        "pfp": chat.pfp,
-        "admin": [user_to_dict(u) for u in chat.admin],
-        "whitelist": [user_to_dict(u) for u in chat.whitelist],
-        "messages": [{"user": user_to_dict(m.user), "message": m.message} for m in chat.messages]
-    }
+def encode_chat_detail(chat: Chat, start: int = 0, more: Optional[bool] = None) -> str:
+    """JSON of a chat's details and its messages from id start on, spliced from encoded fragments."""
+    return (
+        f'{{"chatname": {json.dumps(chat.name)}, "pfp": {json.dumps(chat.pfp)}, '
+        f'"admin": {encode_list(u.encoded for u in chat.admin)}, '
+        f'"whitelist": {encode_list(u.encoded for u in chat.whitelist)}, '
+        f'"messages": {encode_list(chat.messages.fragments(start, len(chat.messages)))}'
+        + (f', "more": {json.dumps(more)}' if more is not None else "")
+        + "}"
+    )
+
+
+# === SNAPSHOT ENCODING ===
+# Users and messages carry their own JSON, so lists of them are spliced together on the
+# loop. Other large snapshots are serialized on the worker pool from frozen copies.
+
+async def user_list_event() -> str:
+    return f'{{"event": "update-user-list", "data": {encode_list(u.encoded for u in connected_users.values())}}}'
+
+
+async def chat_list_event() -> str:
+    chats = tuple(active_chats.values())
+    return await serializer.encode("update-chat-list", len(chats), lambda: [chat_to_dict(c) for c in chats])
+
+
+async def chat_detail_event(chat: Chat, limit: int = 0) -> str:
+    """Encode a chat snapshot. With a limit, only the latest messages are included, plus a
+    "more" flag saying whether older ones can be fetched with get-history."""
+    start = max(len(chat.messages) - limit, 0) if limit else 0
+    detail = encode_chat_detail(chat, start, start > 0 if limit else None)
+    return f'{{"event": "update-chat-detail", "data": {detail}}}'
+
+
+async def send_chat_detail(chat: Chat, clients):
+    """Send a chat snapshot to each client, trimmed to the history size it asked for."""
+    groups: Dict[int, list] = {}
+    for client in clients:
+        groups.setdefault(client.history, []).append(client)
+    for limit, group in groups.items():
+        await send_all(await chat_detail_event(chat, limit), group)
+
+
+# === STATE COMMANDS ===
+# Applied through state.apply(); they must not await.
+
+def register_connection(state: StateEngine, ws: Connection, user: User, session: Session):
+    state.users[ws] = user
+    state.names[user.name] = ws
+    state.user_directory.add(user.name)
+    ws.session = session
+    state.sessions[session.token] = ws
+
+
+def add_chat(state: StateEngine, chat: Chat, user: User):
+    chat.whitelist.append(user)
+    state.chats[chat.name] = chat
+    state.focused[chat.name] = []
+    state.chat_directory.add(chat.name)
+
+
+def focus_chat(state: StateEngine, ws: Connection, chat: Chat, user: User):
+    # If the chat is public, add the user to the whitelist
+    if chat.public and user not in chat.whitelist:
+        chat.whitelist.append(user)
+
+    # Remove the user from all current focused chat lists
+    for ws_list in state.focused.values():
+        if ws in ws_list:
+            ws_list.remove(ws)
+
+    # Focus the chat for this user
+    state.focused[chat.name].append(ws)
+
+
+def add_message(state: StateEngine, chat: Chat, message: Message):
+    chat.add_message(message)
+
+
+def whitelist_user(state: StateEngine, chat: Chat, user: User):
+    if user not in chat.whitelist:
+        chat.whitelist.append(user)
+
+
+def promote_admin(state: StateEngine, chat: Chat, user: User) -> bool:
+    if user in chat.admin:
+        return False
+    chat.admin.append(user)
+    return True
+
+
+def remove_member(state: StateEngine, chat: Chat, user: User, ws: Connection) -> bool:
+    """Take a user out of a chat. Returns True if that left it without admins and it was deleted."""
+    if user in chat.whitelist:
+        chat.whitelist.remove(user)
+    if user in chat.admin:
+        chat.admin.remove(user)
+    if ws in state.focused.get(chat.name, []):
+        state.focused[chat.name].remove(ws)
+
+    if len(chat.admin) == 0:
+        chat.messages.close()
+        del state.chats[chat.name]
+        state.focused.pop(chat.name, None)
+        state.chat_directory.remove(chat.name)
+        return True
+    return False
+
+
+def spill_idle_history(state: StateEngine, idle_after: float, keep: int) -> int:
+    """Move the history of chats nobody is posting in or viewing to disk. Returns messages moved."""
+    now = time.monotonic()
+    spilled = 0
+    for chatname, chat in state.chats.items():
+        if not state.focused.get(chatname) and now - chat.messages.last_active >= idle_after:
+            spilled += chat.messages.spill(keep)
+    return spilled
+
+
+def rebind_connection(state: StateEngine, old: Connection, ws: Connection):
+    """Move a user, their focus and their session from one connection to another."""
+    user = state.users[ws] = state.users.pop(old)
+    state.names[user.name] = ws
+    for ws_list in state.focused.values():
+        if old in ws_list:
+            ws_list[ws_list.index(old)] = ws
+    ws.session, old.session = old.session, None
+    state.sessions[ws.session.token] = ws
+
+
+def end_session(state: StateEngine, conn: Connection):
+    state.sessions.pop(conn.session.token, None)
+    conn.session = None
+
+
+def drop_connection(state: StateEngine, ws: Connection):
+    """Remove a departed client everywhere. Returns (user, updated chats, deleted chatnames)."""
+    updated, deleted = [], []
+    user = state.users.pop(ws, None)
+    if user:
+        del state.names[user.name]
+        state.user_directory.remove(user.name)
+
+        # Remove the user from all active chats
+        for chatname, chat in state.chats.items():
+            if user in chat.whitelist:
+                chat.whitelist.remove(user)
+            if user in chat.admin:
+                chat.admin.remove(user)
+            # If no admins remain, mark the chat for deletion
+            if len(chat.admin) == 0:
+                deleted.append(chatname)
+            else:
+                updated.append(chat)
+
+        # Delete chats with no admins
+        for chatname in deleted:
+            state.chats[chatname].messages.close()
+            del state.chats[chatname]
+            state.focused.pop(chatname, None)
+            state.chat_directory.remove(chatname)
+
+    # Remove the WebSocket from focused chats
+    for chat_ws_list in state.focused.values():
+        if ws in chat_ws_list:
+            chat_ws_list.remove(ws)
+
+    return user, updated, deleted
 
 
 # === EVENT HANDLERS ===
@@ -111,18 +393,28 @@ async def handle_register_user(ws, data):
             await ws.send(json.dumps({"event": "error", "data": {"event-type": "register-user", "message": "Invalid profile picture ID"}}))
             return
 
+        # A connection holds one name for its lifetime; a second name would never be released
+        if ws in connected_users:
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "register-user", "message": "Already registered"}}))
+            return
+
         # Check if the username already exists
-        if any(user.name == username for user in connected_users.values()):
+        if username in state.names or username in api_users:
             await ws.send(json.dumps({"event": "error", "data": {"event-type": "register-user", "message": "Username already taken"}}))
             return
 
         # Register the user
+        # Issue a resume token so a dropped connection can pick up where it left off
         user = User(name=username, pfp=pfp)
-        connected_users[ws] = user
-
-        # Broadcast updated user and chat lists to all clients
-        await broadcast("update-user-list", [user_to_dict(u) for u in connected_users.values()], connected_users.keys())
-        await broadcast("update-chat-list", [chat_to_dict(chat) for chat in active_chats.values()], connected_users.keys())
+        state.apply(register_connection, ws, user, ws.session or Session(SERVER_CONFIG["session_log_size"], SERVER_CONFIG["session_log_bytes"]))
+        await ws.send(json.dumps({"event": "session", "data": {"token": ws.session.token}}))
+        await deliver_mailbox(ws, username)
+
+        # Broadcast updated user and chat lists; clients paging the directory just hear who joined
+        full, paged = split_by_paging(state.clients())
+        await send_all(await user_list_event(), full)
+        await send_all(await chat_list_event(), full)
+        await broadcast("user-joined", user_to_dict(user), paged)
     except Exception as e:
         print(f"Error in handle_register_user: {e}")
         await ws.send(json.dumps({"event": "error", "data": {"event-type": "register-user", "message": "Internal server error"}}))
@@ -135,6 +427,7 @@ async def handle_create_chat(ws, data):
         chatname = data.get("chatname")
         pfp = data.get("pfp")
         public = data.get("public")
+        key = data.get("key")
 
         if not chatname or not isinstance(chatname, str):
             await ws.send(json.dumps({"event": "error", "data": {"event-type":"create-chat","message": "Invalid or missing chatname"}}))
@@ -144,6 +437,17 @@ async def handle_create_chat(ws, data):
         if not isinstance(public, bool):
             await ws.send(json.dumps({"event": "error", "data": {"event-type":"create-chat","message": "Invalid or missing public flag"}}))
             return
+        if key is not None and (not isinstance(key, str) or len(key) > 128):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type":"create-chat","message": "Invalid idempotency key"}}))
+            return
+
+        # A retry of a chat this user already created gets the original reply instead of a name clash
+        user = connected_users.get(ws)
+        if user and key is not None:
+            reply = replies.get(user.name, f"create-chat:{key}")
+            if reply is not None:
+                await ws.send(reply)
+                return
 
         # Ensure chatname is unique
         if chatname in active_chats:
@@ -157,13 +461,17 @@ async def handle_create_chat(ws, data):
             return
 
         chat = Chat(name=chatname, pfp=pfp, admin=user, public=public)
-        chat.whitelist.append(user)
-
-        active_chats[chat.name] = chat
-        focused_chats[chat.name] = []
+        state.apply(add_chat, chat, user)
+        if key is not None:
+            reply = json.dumps({"event": "chat-created", "data": {"key": key, "chatname": chatname}})
+            replies.put(user.name, f"create-chat:{key}", reply)
 
         # Broadcast the new chat to all clients
-        await broadcast("update-chat-list", [chat_to_dict(c) for c in active_chats.values()], connected_users.keys())
+        full, paged = split_by_paging(state.clients())
+        await send_all(await chat_list_event(), full)
+        await broadcast("chat-added", chat_to_dict(chat), paged)
+        if key is not None:
+            await ws.send(reply)
     except Exception as e:
         print(f"Error in handle_create_chat: {e}")
         await ws.send(json.dumps({"event": "error", "data": {"event-type":"create-chat","message": "Internal server error"}}))
@@ -201,24 +509,10 @@ async def handle_open_chat(ws, data):
 
         # Check access permissions
         if chat.public or user in chat.whitelist:
-            # If the chat is public, add the user to the whitelist
-            if chat.public and user not in chat.whitelist:
-                chat.whitelist.append(user)
-
-            # Remove the user from all current focused chat lists
-            for ws_list in focused_chats.values():
-                if ws in ws_list:
-                    ws_list.remove(ws)
-
-            # Focus the chat for this user
-            if ws not in focused_chats[chat.name]:
-                focused_chats[chat.name].append(ws)
+            state.apply(focus_chat, ws, chat, user)
 
             # Send chat details to the user
-            await ws.send(json.dumps({
-                "event": "update-chat-detail",
-                "data": chat_detail_to_dict(chat)
-            }))
+            await ws.send(await chat_detail_event(chat, ws.history))
         else:
             # User has no access to the chat
             await ws.send(json.dumps({
@@ -236,7 +530,29 @@ async def handle_post_message(ws, data):
     """Handles posting a message in a chat."""
     user = connected_users[ws]
     chatname = data.get("chatname")
-    message_text = data["message"]
+    message_text = data.get("message")
+    key = data.get("key")
+    if not isinstance(message_text, str):
+        await ws.send(json.dumps({"event": "error", "data": {"event-type": "post-message", "message": "Invalid or missing message"}}))
+        return
+    if len(message_text) > SERVER_CONFIG["max_message_length"]:
+        await ws.send(json.dumps({"event": "error", "data": {"event-type": "post-message", "message": "Message too long"}}))
+        return
+    if key is not None and (not isinstance(key, str) or len(key) > 128):
+        await ws.send(json.dumps({"event": "error", "data": {"event-type": "post-message", "message": "Invalid idempotency key"}}))
+        return
+    # Attachments are uploaded over HTTP first; the message only carries the hash
+    attachment = data.get("attachment")
+    if attachment is not None and (not isinstance(attachment, str) or not attachments.exists(attachment)):
+        await ws.send(json.dumps({"event": "error", "data": {"event-type": "post-message", "message": "Unknown attachment"}}))
+        return
+
+    # A retry of a message that already went through just gets the original reply
+    if key is not None:
+        reply = replies.get(user.name, f"post-message:{key}")
+        if reply is not None:
+            await ws.send(reply)
+            return
 
     chat = active_chats.get(chatname)
     if not chat:
@@ -253,12 +569,28 @@ async def handle_post_message(ws, data):
         return
 
     # Add message
-    new_msg = Message(user, message_text)
-    chat.add_message(new_msg)
-
-    # Send update to focused clients only
-    clients = focused_chats.get(chatname, [])
-    await broadcast("update-chat-detail", chat_detail_to_dict(chat), clients)
+    new_msg = Message(user, message_text, attachment)
+    state.apply(add_message, chat, new_msg)
+    if key is not None:
+        reply = json.dumps({"event": "message-posted", "data": {"key": key, "chatname": chatname, "id": new_msg.id}})
+        replies.put(user.name, f"post-message:{key}", reply)
+
+    await announce_messages(chat, [new_msg])
+    if key is not None:
+        await ws.send(reply)
+
+
+async def announce_messages(chat: Chat, messages: List[Message]):
+    """Send new messages to the clients viewing a chat. Clients that can take a delta get just
+    the message instead of a snapshot of the whole room; a batch goes out as one snapshot."""
+    if len(messages) > 1:
+        await send_chat_detail(chat, state.audience(chat.name))
+        return
+    clients, deltas = split_by_deltas(state.audience(chat.name), admission.level >= SHEDDING)
+    if deltas:
+        await send_all(f'{{"event": "append-message", "data": {{"chatname": {json.dumps(chat.name)}, "message": {messages[0].encoded}}}}}', deltas)
+    if clients:
+        await send_chat_detail(chat, clients)
 
 
 async def handle_join_chat(ws, data):
@@ -304,7 +636,7 @@ async def handle_join_chat(ws, data):
             return
 
         # Notify chat admins about the join request
-        for client_ws, admin_user in connected_users.items():
+        for client_ws, admin_user in state.user_items():
             if admin_user in chat.admin:
                 await client_ws.send(json.dumps({
                     "event": "join-request",
@@ -362,15 +694,13 @@ async def handle_accept_join_request(ws, data):
             return
 
         # Add the user to the whitelist if not already present
-        if user_to_add not in chat.whitelist:
-            chat.whitelist.append(user_to_add)
+        state.apply(whitelist_user, chat, user_to_add)
 
         # Update all focused clients
-        focused = focused_chats.get(chat.name, [])
-        await broadcast("update-chat-detail", chat_detail_to_dict(chat), focused)
+        await send_chat_detail(chat, state.audience(chat.name))
 
         # Notify the admins and the newly whitelisted user that the request is resolved
-        for client_ws, user in connected_users.items():
+        for client_ws, user in state.user_items():
             if user == user_to_add or user in chat.admin:
                 await client_ws.send(json.dumps({
                     "event": "resolve-join-request",
@@ -429,7 +759,7 @@ async def handle_reject_join_request(ws, data):
             return
 
         # Notify the admins and the rejected user that the request is resolved
-        for client_ws, user in connected_users.items():
+        for client_ws, user in state.user_items():
             if user == user_to_reject or user in chat.admin:
                 await client_ws.send(json.dumps({
                     "event": "resolve-join-request",
@@ -488,15 +818,8 @@ async def handle_remove_user(ws, data):
             await ws.send(json.dumps({"event": "error", "data": {"event-type": "remove-user", "message": "User not found"}}))
             return
 
-        # Remove the user from the chat's whitelist and admin list
-        if target_user in chat.whitelist:
-            chat.whitelist.remove(target_user)
-        if target_user in chat.admin:
-            chat.admin.remove(target_user)
-
-        # Remove the user's focus on the chat if applicable
-        if target_user_ws in focused_chats.get(chatname, []):
-            focused_chats[chatname].remove(target_user_ws)
+        # Remove the user from the chat's whitelist, admin list and focus; the chat goes if no admins remain
+        chat_deleted = state.apply(remove_member, chat, target_user, target_user_ws)
 
         # Notify the removed user
         await target_user_ws.send(json.dumps({
@@ -506,18 +829,12 @@ async def handle_remove_user(ws, data):
             }
         }))
 
-        # Check if no admins remain
-        if len(chat.admin) == 0:
-            del active_chats[chatname]
-            if chatname in focused_chats:
-                del focused_chats[chatname]
-            
+        if chat_deleted:
             # Notify all clients about the deleted chat
-            await broadcast("delete-chat", {"chatname": chatname}, connected_users.keys())
+            await broadcast("delete-chat", {"chatname": chatname}, state.clients())
         else:
             # Notify all focused clients with updated chat details
-            focused = focused_chats.get(chatname, [])
-            await broadcast("update-chat-detail", chat_detail_to_dict(chat), focused)
+            await send_chat_detail(chat, state.audience(chatname))
 
     except Exception as e:
         print(f"Error in handle_remove_user: {e}")
@@ -533,12 +850,19 @@ async def handle_inbox(ws, data):
 
         target_username = data.get("username")
         message = data.get("message")
+        key = data.get("key")
         if not target_username or not isinstance(target_username, str):
             await ws.send(json.dumps({"event": "error", "data": {"event-type": "inbox", "message": "Invalid or missing target username"}}))
             return
         if not message or not isinstance(message, str):
             await ws.send(json.dumps({"event": "error", "data": {"event-type": "inbox", "message": "Invalid or missing message"}}))
             return
+        if len(message) > SERVER_CONFIG["max_message_length"]:
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "inbox", "message": "Message too long"}}))
+            return
+        if key is not None and (not isinstance(key, str) or len(key) > 128):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "inbox", "message": "Invalid idempotency key"}}))
+            return
 
         # Validate sender
         sender = connected_users.get(ws)
@@ -546,29 +870,75 @@ async def handle_inbox(ws, data):
             await ws.send(json.dumps({"event": "error", "data": {"event-type": "inbox", "message": "Sender not connected"}}))
             return
 
-        # Find the target user
-        target_user_ws = None
-        for client_ws, user in connected_users.items():
-            if user.name == target_username:
-                target_user_ws = client_ws
-                break
+        # A retry of a message already in the mailbox just gets the original reply
+        if key is not None:
+            reply = replies.get(sender.name, f"inbox:{key}")
+            if reply is not None:
+                await ws.send(reply)
+                return
 
-        if not target_user_ws:
+        # Mail is only kept for users who are connected or can still resume their session
+        target_user_ws = state.names.get(target_username)
+        if target_user_ws is None:
             await ws.send(json.dumps({"event": "error", "data": {"event-type": "inbox", "message": "Target user not found"}}))
             return
 
-        # Send the message to the target user's inbox
-        await target_user_ws.send(json.dumps({
-            "event": "update-inbox",
-            "data": {
-                "sender": user_to_dict(sender),
-                "message": message
-            }
-        }))
+        # Keep the message until the target acknowledges it, whether or not they are online
+        mail_id, encoded = mailboxes.put(target_username, {"sender": user_to_dict(sender), "message": message})
+        reply = json.dumps({"event": "inbox-sent", "data": {"username": target_username, "id": mail_id, "delivered": target_user_ws.ws is not None, "key": key}})
+        if key is not None:
+            replies.put(sender.name, f"inbox:{key}", reply)
+
+        # Deliver right away; a suspended target gets it replayed or in its backlog on resume
+        await target_user_ws.send(f'{{"event": "update-inbox", "data": {encoded}}}')
+
+        await ws.send(reply)
     except Exception as e:
         print(f"Error in handle_inbox: {e}")
         await ws.send(json.dumps({"event": "error", "data": {"event-type": "inbox", "message": "Internal server error"}}))
 
+async def deliver_mailbox(ws, username: str):
+    """Send everything waiting in a user's mailbox as one inbox-backlog event."""
+    pending = mailboxes.pending(username)
+    if pending:
+        await ws.send(f'{{"event": "inbox-backlog", "data": [{", ".join(pending)}]}}')
+
+async def handle_get_inbox(ws, data):
+    """Resends the unacknowledged messages in the user's mailbox."""
+    try:
+        user = connected_users.get(ws)
+        if not user:
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "get-inbox", "message": "User not connected"}}))
+            return
+
+        await deliver_mailbox(ws, user.name)
+    except Exception as e:
+        print(f"Error in handle_get_inbox: {e}")
+        await ws.send(json.dumps({"event": "error", "data": {"event-type": "get-inbox", "message": "Internal server error"}}))
+
+async def handle_ack_inbox(ws, data):
+    """Removes delivered messages from the user's mailbox."""
+    try:
+        # Validate input data
+        if not isinstance(data, dict):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "ack-inbox", "message": "Invalid data format"}}))
+            return
+
+        ids = data.get("ids")
+        if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "ack-inbox", "message": "Invalid or missing ids"}}))
+            return
+
+        user = connected_users.get(ws)
+        if not user:
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "ack-inbox", "message": "User not connected"}}))
+            return
+
+        mailboxes.ack(user.name, ids)
+    except Exception as e:
+        print(f"Error in handle_ack_inbox: {e}")
+        await ws.send(json.dumps({"event": "error", "data": {"event-type": "ack-inbox", "message": "Internal server error"}}))
+
 async def handle_add_admin(ws, data):
     """Adds a user as an admin to the chatroom."""
     try:
@@ -618,20 +988,14 @@ async def handle_add_admin(ws, data):
             return
 
         # Add the user as an admin if not already an admin
-        if user_to_add not in chat.admin:
-            chat.admin.append(user_to_add)
-
+        if state.apply(promote_admin, chat, user_to_add):
             # Notify all focused clients with updated chat details
-            focused = focused_chats.get(chatname, [])
-            await broadcast("update-chat-detail", chat_detail_to_dict(chat), focused)
+            await send_chat_detail(chat, state.audience(chatname))
 
             # Notify the newly added admin
-            for client_ws, user in connected_users.items():
+            for client_ws, user in state.user_items():
                 if user == user_to_add:
-                    await client_ws.send(json.dumps({
-                        "event": "update-chat-detail",
-                        "data": chat_detail_to_dict(chat)
-                    }))
+                    await client_ws.send(await chat_detail_event(chat, client_ws.history))
                     break
     except Exception as e:
         print(f"Error in handle_add_admin: {e}")
@@ -639,30 +1003,25 @@ async def handle_add_admin(ws, data):
 
 async def handle_get_user(ws, data):
     try:
-        await ws.send(json.dumps({"event": "update-user-list", "data": [user_to_dict(u) for u in connected_users.values()]}))
+        await ws.send(await user_list_event())
     except Exception as e:
         print(f"Error in handle_get_user: {e}")
         await ws.send(json.dumps({"event": "error", "data": {"event-type": "get-user", "message": "Internal server error"}}))
 
 async def handle_get_chat(ws, data):
     try:
-        await ws.send(json.dumps({"event": "update-chat-list", "data": [chat_to_dict(c) for c in active_chats.values()]}))
+        await ws.send(await chat_list_event())
     except Exception as e:
         print(f"Error in handle_get_chat: {e}")
         await ws.send(json.dumps({"event": "error", "data": {"event-type": "get-chat", "message": "Internal server error"}}))
 
 async def handle_get_data(ws, data):
     try:
-        await ws.send(json.dumps({"event": "update-user-list", "data": [user_to_dict(u) for u in connected_users.values()]}))
-        await ws.send(json.dumps({"event": "update-chat-list", "data": [chat_to_dict(c) for c in active_chats.values()]}))
-        for chatname, ws_list in focused_chats.items():
-            if ws in ws_list:
-                chat = active_chats.get(chatname)
-            if chat:
-                await ws.send(json.dumps({
-                    "event": "update-chat-detail",
-                    "data": chat_detail_to_dict(chat)
-                }))
+        await ws.send(await user_list_event())
+        await ws.send(await chat_list_event())
+        chat = next((active_chats.get(name) for name, ws_list in focused_chats.items() if ws in ws_list), None)
+        if chat:
+            await ws.send(await chat_detail_event(chat, ws.history))
             return
         # If no focused chat is found, notify the user
         await ws.send(json.dumps({
@@ -676,6 +1035,492 @@ async def handle_get_data(ws, data):
         print(f"Error in handle_get_chat: {e}")
         await ws.send(json.dumps({"event": "error", "data": {"event-type": "get-chat", "message": "Internal server error"}}))
 
+async def handle_query_users(ws, data):
+    """Returns one page of connected users whose names start with a prefix."""
+    try:
+        # Validate input data
+        if not isinstance(data, dict):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "query-users", "message": "Invalid data format"}}))
+            return
+
+        prefix = data.get("prefix", "")
+        cursor = data.get("cursor")
+        limit = data.get("limit", 50)
+        if not isinstance(prefix, str) or (cursor is not None and not isinstance(cursor, str)):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "query-users", "message": "Invalid prefix or cursor"}}))
+            return
+        if not isinstance(limit, int) or limit < 1:
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "query-users", "message": "Invalid limit"}}))
+            return
+
+        names, next_cursor = page_names(state.user_directory, prefix, cursor, min(limit, 200), lambda name: True)
+        await ws.send(json.dumps({
+            "event": "user-query-results",
+            "data": {
+                "prefix": prefix,
+                "after": cursor,
+                "cursor": next_cursor,
+                "users": [user_to_dict(connected_users[state.names[name]]) for name in names]
+            }
+        }))
+    except Exception as e:
+        print(f"Error in handle_query_users: {e}")
+        await ws.send(json.dumps({"event": "error", "data": {"event-type": "query-users", "message": "Internal server error"}}))
+
+async def handle_query_chats(ws, data):
+    """Returns one page of chats whose names start with a prefix, optionally filtered."""
+    try:
+        # Validate input data
+        if not isinstance(data, dict):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "query-chats", "message": "Invalid data format"}}))
+            return
+
+        prefix = data.get("prefix", "")
+        cursor = data.get("cursor")
+        limit = data.get("limit", 50)
+        public = data.get("public")
+        joined = data.get("joined")
+        if not isinstance(prefix, str) or (cursor is not None and not isinstance(cursor, str)):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "query-chats", "message": "Invalid prefix or cursor"}}))
+            return
+        if not isinstance(limit, int) or limit < 1:
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "query-chats", "message": "Invalid limit"}}))
+            return
+        if public not in (None, True, False) or joined not in (None, True, False):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "query-chats", "message": "Invalid filter"}}))
+            return
+
+        # Validate user
+        user = connected_users.get(ws)
+        if not user:
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "query-chats", "message": "User not connected"}}))
+            return
+
+        def keep(name):
+            chat = active_chats[name]
+            if public is not None and chat.public != public:
+                return False
+            return joined is None or (user in chat.whitelist) == joined
+
+        names, next_cursor = page_names(state.chat_directory, prefix, cursor, min(limit, 200), keep)
+        await ws.send(json.dumps({
+            "event": "chat-query-results",
+            "data": {
+                "prefix": prefix,
+                "after": cursor,
+                "cursor": next_cursor,
+                "chats": [chat_to_dict(active_chats[name]) for name in names]
+            }
+        }))
+    except Exception as e:
+        print(f"Error in handle_query_chats: {e}")
+        await ws.send(json.dumps({"event": "error", "data": {"event-type": "query-chats", "message": "Internal server error"}}))
+
+async def handle_get_history(ws, data):
+    """Sends the page of messages just before a given message id, for clients scrolling back."""
+    try:
+        # Validate input data
+        if not isinstance(data, dict):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "get-history", "message": "Invalid data format"}}))
+            return
+
+        chatname = data.get("chatname")
+        before = data.get("before")
+        limit = data.get("limit", 50)
+        if not chatname or not isinstance(chatname, str):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "get-history", "message": "Invalid or missing chatname"}}))
+            return
+        if not isinstance(before, int) or isinstance(before, bool) or before < 0:
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "get-history", "message": "Invalid or missing before id"}}))
+            return
+        if not isinstance(limit, int) or isinstance(limit, bool) or not 0 < limit <= SERVER_CONFIG["history_page_max"]:
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "get-history", "message": "Invalid limit"}}))
+            return
+
+        user = connected_users.get(ws)
+        if not user:
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "get-history", "message": "User not connected"}}))
+            return
+
+        chat = active_chats.get(chatname)
+        if not chat:
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "get-history", "message": "Chat doesn't exist."}}))
+            return
+        if not (chat.public or user in chat.whitelist):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "get-history", "message": "No access to this chat"}}))
+            return
+
+        # Message ids are positions in the chat's history
+        end = min(before, len(chat.messages))
+        start = max(0, end - limit)
+        await ws.send(
+            f'{{"event": "chat-history", "data": {{"chatname": {json.dumps(chatname)}, "before": {json.dumps(before)}, '
+            f'"more": {json.dumps(start > 0)}, "messages": {encode_list(chat.messages.fragments(start, end))}}}}}'
+        )
+    except Exception as e:
+        print(f"Error in handle_get_history: {e}")
+        await ws.send(json.dumps({"event": "error", "data": {"event-type": "get-history", "message": "Internal server error"}}))
+
+async def handle_search_messages(ws, data):
+    """Searches the history of one chat, or of every chat the user can access."""
+    try:
+        # Validate input data
+        if not isinstance(data, dict):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "search-messages", "message": "Invalid data format"}}))
+            return
+
+        query = data.get("query")
+        chatname = data.get("chatname")
+        limit = data.get("limit", 20)
+        cursor = data.get("cursor", 0)
+        if not query or not isinstance(query, str) or not tokenize(query):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "search-messages", "message": "Invalid or missing query"}}))
+            return
+        if chatname is not None and not isinstance(chatname, str):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "search-messages", "message": "Invalid chatname"}}))
+            return
+        if not isinstance(limit, int) or not isinstance(cursor, int) or limit < 1 or cursor < 0:
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "search-messages", "message": "Invalid limit or cursor"}}))
+            return
+        limit = min(limit, 100)
+
+        # Validate user
+        user = connected_users.get(ws)
+        if not user:
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "search-messages", "message": "User not connected"}}))
+            return
+
+        # Only chats the user could open are searched
+        if chatname is not None:
+            chat = active_chats.get(chatname)
+            if not chat:
+                await ws.send(json.dumps({"event": "error", "data": {"event-type": "search-messages", "message": "Chat doesn't exist."}}))
+                return
+            if not (chat.public or user in chat.whitelist):
+                await ws.send(json.dumps({"event": "no-access", "data": {"message": "You are not whitelisted for this chat. Request access to join."}}))
+                return
+            chats = [chat]
+        else:
+            chats = [c for c in active_chats.values() if c.public or user in c.whitelist]
+
+        # Take the best cursor + limit hits of each chat, then merge them into one ranking
+        terms = tokenize(query)
+        total = 0
+        partial = False
+        hits = []
+        for chat in chats:
+            count, complete, top = chat.index.search(terms, cursor + limit, SERVER_CONFIG["search_scan_limit"])
+            total += count
+            partial = partial or not complete
+            hits.extend((score, message_id, chat) for score, message_id in top)
+        page = heapq.nlargest(cursor + limit, hits, key=lambda hit: hit[:2])[cursor:]
+
+        await ws.send(json.dumps({
+            "event": "search-results",
+            "data": {
+                "query": query,
+                "chatname": chatname,
+                "total": total,
+                "partial": partial,  # only the newest search_scan_limit candidates per chat were ranked
+                "cursor": cursor + limit if cursor + limit < total else None,
+                "results": [{
+                    "chatname": chat.name,
+                    "id": message_id,
+                    "user": user_to_dict(chat.messages[message_id].user),
+                    "message": chat.messages[message_id].message,
+                    "score": round(score, 3)
+                } for score, message_id, chat in page]
+            }
+        }))
+    except Exception as e:
+        print(f"Error in handle_search_messages: {e}")
+        await ws.send(json.dumps({"event": "error", "data": {"event-type": "search-messages", "message": "Internal server error"}}))
+
+async def handle_hello(ws, data):
+    """Records which optional protocol features the client supports."""
+    try:
+        if not isinstance(data, dict):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "hello", "message": "Invalid data format"}}))
+            return
+
+        ws.batching = data.get("batch") is True
+        ws.paged = data.get("paged") is True
+        ws.deltas = data.get("deltas") is True
+        history = data.get("history")
+        ws.history = min(history, SERVER_CONFIG["history_page_max"]) if isinstance(history, int) and not isinstance(history, bool) and history > 0 else 0
+        if data.get("reliable") is True and ws.window is None:
+            ws.window = DeliveryWindow(
+                SERVER_CONFIG["delivery_window"],
+                SERVER_CONFIG["delivery_max_held"],
+                SERVER_CONFIG["ack_timeout"],
+                SERVER_CONFIG["ack_timeout_max"]
+            )
+        await ws.send(json.dumps({"event": "hello", "data": {"batch": ws.batching, "paged": ws.paged, "reliable": ws.window is not None, "deltas": ws.deltas, "history": ws.history}}))
+    except Exception as e:
+        print(f"Error in handle_hello: {e}")
+        await ws.send(json.dumps({"event": "error", "data": {"event-type": "hello", "message": "Internal server error"}}))
+
+async def handle_ack(ws, data):
+    """Cumulatively acknowledges sequenced events on a reliable connection."""
+    try:
+        seq = data.get("seq") if isinstance(data, dict) else None
+        if not isinstance(seq, int) or isinstance(seq, bool):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "ack", "message": "Invalid or missing seq"}}))
+            return
+
+        await ws.ack(seq)
+    except Exception as e:
+        print(f"Error in handle_ack: {e}")
+        await ws.send(json.dumps({"event": "error", "data": {"event-type": "ack", "message": "Internal server error"}}))
+
+async def handle_profile(ws, data):
+    """Toggles the sampling profiler. Requires the configured admin token."""
+    try:
+        if not isinstance(data, dict):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "profile", "message": "Invalid data format"}}))
+            return
+
+        admin_token = SERVER_CONFIG["admin_token"]
+        if not admin_token or data.get("token") != admin_token:
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "profile", "message": "Not authorized"}}))
+            return
+
+        enabled = data.get("enabled")
+        if not isinstance(enabled, bool):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "profile", "message": "Invalid or missing enabled flag"}}))
+            return
+
+        status = toggle_profiler() if enabled != profiler.running else {"enabled": enabled, "path": SERVER_CONFIG["profile_path"], "samples": 0}
+        await ws.send(json.dumps({"event": "profile", "data": status}))
+    except Exception as e:
+        print(f"Error in handle_profile: {e}")
+        await ws.send(json.dumps({"event": "error", "data": {"event-type": "profile", "message": "Internal server error"}}))
+
+async def handle_memory_usage(ws, data):
+    """Reports what the largest connections hold in memory. Requires the configured admin token."""
+    try:
+        if not isinstance(data, dict):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "memory-usage", "message": "Invalid data format"}}))
+            return
+
+        admin_token = SERVER_CONFIG["admin_token"]
+        if not admin_token or data.get("token") != admin_token:
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "memory-usage", "message": "Not authorized"}}))
+            return
+
+        limit = data.get("limit", 20)
+        if not isinstance(limit, int) or isinstance(limit, bool) or limit < 1:
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "memory-usage", "message": "Invalid limit"}}))
+            return
+
+        usage = []
+        for conn in tracked_connections():
+            user = connected_users.get(conn)
+            breakdown = connection_usage(conn)
+            usage.append({"username": user.name if user else None, "connected": conn.ws is not None,
+                          "bytes": sum(breakdown.values()), **breakdown})
+        usage.sort(key=lambda entry: entry["bytes"], reverse=True)
+        await ws.send(json.dumps({"event": "memory-usage", "data": {
+            "total": sum(entry["bytes"] for entry in usage),
+            "cap": memory_budget.cap,
+            "connection_budget": memory_budget.per_connection,
+            "trimmed": memory_budget.trimmed,
+            "evicted": memory_budget.evicted,
+            "connections": usage[:limit]
+        }}))
+    except Exception as e:
+        print(f"Error in handle_memory_usage: {e}")
+        await ws.send(json.dumps({"event": "error", "data": {"event-type": "memory-usage", "message": "Internal server error"}}))
+
+async def handle_resume_session(ws, data):
+    """Reattaches a new connection to a session and replays the events it missed."""
+    try:
+        # Validate input data
+        if not isinstance(data, dict):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "resume-session", "message": "Invalid data format"}}))
+            return
+
+        token = data.get("token")
+        seq = data.get("seq")
+        if not token or not isinstance(token, str):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "resume-session", "message": "Invalid or missing token"}}))
+            return
+        if not isinstance(seq, int) or isinstance(seq, bool):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "resume-session", "message": "Invalid or missing seq"}}))
+            return
+        if ws in connected_users:
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "resume-session", "message": "Already registered"}}))
+            return
+
+        old = sessions.get(token)
+        if old not in connected_users:
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "resume-session", "message": "Unknown or expired session"}}))
+            return
+
+        # Take over the session, closing the previous socket if the server hasn't noticed it died yet
+        session = old.session
+        if session.expiry:
+            session.expiry.cancel()
+            session.expiry = None
+        if old.ws is not None:
+            asyncio.create_task(old.ws.close())
+        state.apply(rebind_connection, old, ws)
+
+        # Replay what was missed, or fall back to a full resync if the log has moved past it
+        replayed = await ws.replay(seq)
+        await ws.send(json.dumps({"event": "session-resumed", "data": {"token": token, "replayed": replayed}}))
+        if replayed is None:
+            await handle_get_data(ws, {})
+            await deliver_mailbox(ws, connected_users[ws].name)
+    except Exception as e:
+        print(f"Error in handle_resume_session: {e}")
+        await ws.send(json.dumps({"event": "error", "data": {"event-type": "resume-session", "message": "Internal server error"}}))
+
+# === HTTP API BRIDGE ===
+
+class ApiBridge:
+    """What the HTTP Api, running in this process, may see of chat state."""
+    attachments: AttachmentStore
+
+    def __init__(self):
+        self.attachments = attachments  # the store post-message checks hashes against
+
+    def session_user(self, token: str) -> Optional[User]:
+        """The user holding a session, connected or suspended, for requests that carry its token."""
+        conn = sessions.get(token)
+        return connected_users.get(conn) if conn is not None else None
+
+    def claim_name(self, name: str, pfp: int) -> bool:
+        """Give a user registering through the Api a chat identity, so its token can post to
+        chats. Returns False if a chat user already holds the name."""
+        if name in state.names or name in api_users:
+            return False
+        api_users[name] = User(name, pfp)
+        return True
+
+    def release_name(self, name: str):
+        api_users.pop(name, None)
+
+    def api_user(self, name: str) -> Optional[User]:
+        """The chat identity of a user registered through the Api."""
+        return api_users.get(name)
+
+    def chat_error(self, user: User, chatname: str) -> Optional[str]:
+        """Why the user can't post to a chat, or None if they can."""
+        chat = active_chats.get(chatname)
+        if chat is None:
+            return "Chat not found"
+        if not (chat.public or user in chat.whitelist):
+            return "Forbidden"
+        return None
+
+    async def post_messages(self, user: User, chatname: str, texts: List[str]):
+        """Add messages to a chat in order, then announce them together."""
+        chat = active_chats.get(chatname)
+        if chat is None:
+            return  # deleted while the request body was streaming in
+        messages = [Message(user, text) for text in texts]
+        for message in messages:
+            state.apply(add_message, chat, message)
+        await announce_messages(chat, messages)
+
+# === SESSION LIFECYCLE ===
+
+def suspend_connection(conn: Connection):
+    """Keep a disconnected user's memberships alive for the grace period."""
+    conn.detach()
+    conn.session.expiry = asyncio.create_task(expire_session(conn))
+
+
+async def expire_session(conn: Connection):
+    """Run the normal disconnect cleanup once the grace period runs out."""
+    await asyncio.sleep(SERVER_CONFIG["session_grace"])
+    conn.session.expiry = None
+    state.apply(end_session, conn)
+    await cleanup_connection(conn)
+
+
+async def cleanup_connection(ws):
+    """Remove a departed client from every chat and notify the others."""
+    user, updated, deleted = state.apply(drop_connection, ws)
+    if user:
+        # Before anyone else can register the name and inherit them
+        mailboxes.discard(user.name)
+        replies.discard(user.name)
+
+    # Broadcast updated chat details for chats that survive, and notify clients about deleted ones
+    for chat in updated:
+        await send_chat_detail(chat, state.audience(chat.name))
+    for chatname in deleted:
+        await broadcast("delete-chat", {"chatname": chatname}, state.clients())
+
+    # Broadcast updated user list
+    full, paged = split_by_paging(state.clients())
+    await send_all(await user_list_event(), full)
+    if user:
+        ephemeral.forget(user.name)
+        await broadcast("user-left", user_to_dict(user), paged)
+
+# === EPHEMERAL EVENTS ===
+# Typing and presence only reach the clients viewing a room. They bypass the state engine,
+# the session log and acknowledged delivery, and are coalesced per tick by the bus.
+
+PRESENCE_STATUSES = ("active", "idle")
+
+
+async def deliver_ephemeral(chatname: str, states: Dict[str, dict]):
+    if admission.level >= SHEDDING:
+        return  # the first thing to give up under load
+    clients = state.audience(chatname)
+    if not clients:
+        return
+    event = (f'{{"event": "room-activity", "data": {{"chatname": {json.dumps(chatname)}, '
+             f'"ttl": {int(SERVER_CONFIG["ephemeral_ttl"] * 1000)}, "users": {json.dumps(states)}}}}}')
+    for client in clients:
+        try:
+            await client.send_ephemeral(event)
+        except websockets.ConnectionClosed:
+            pass
+
+
+ephemeral = EphemeralBus(SERVER_CONFIG["ephemeral_tick"], SERVER_CONFIG["ephemeral_rate"], deliver_ephemeral)
+
+
+async def publish_ephemeral(ws, event_type: str, data, fields: dict):
+    """Checks that the sender is viewing the chat, then queues the update on the bus."""
+    user = connected_users.get(ws)
+    chatname = data.get("chatname")
+    if user is None or not isinstance(chatname, str):
+        await ws.send(json.dumps({"event": "error", "data": {"event-type": event_type, "message": "Invalid or missing chatname"}}))
+        return
+    # Only viewers see these, so only viewers may send them
+    if ws not in state.audience(chatname):
+        return
+    ephemeral.publish(chatname, user.name, fields)
+
+
+async def handle_typing(ws, data):
+    """Tells the other viewers of a chat whether the user is typing."""
+    try:
+        if not isinstance(data, dict) or not isinstance(data.get("typing"), bool):
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "typing", "message": "Invalid or missing typing flag"}}))
+            return
+        await publish_ephemeral(ws, "typing", data, {"typing": data["typing"]})
+    except Exception as e:
+        print(f"Error in handle_typing: {e}")
+
+
+async def handle_presence(ws, data):
+    """Tells the other viewers of a chat whether the user is active or idle there."""
+    try:
+        if not isinstance(data, dict) or data.get("status") not in PRESENCE_STATUSES:
+            await ws.send(json.dumps({"event": "error", "data": {"event-type": "presence", "message": "Invalid or missing status"}}))
+            return
+        await publish_ephemeral(ws, "presence", data, {"status": data["status"]})
+    except Exception as e:
+        print(f"Error in handle_presence: {e}")
+
+
 # === DISPATCHER ===
 
 event_handlers = {
@@ -691,15 +1536,114 @@ event_handlers = {
     "add-admin": handle_add_admin,
     "get-user": handle_get_user,
     "get-chat": handle_get_chat,
-    "get-data": handle_get_data
+    "get-data": handle_get_data,
+    "resume-session": handle_resume_session,
+    "hello": handle_hello,
+    "search-messages": handle_search_messages,
+    "query-users": handle_query_users,
+    "query-chats": handle_query_chats,
+    "get-inbox": handle_get_inbox,
+    "ack-inbox": handle_ack_inbox,
+    "ack": handle_ack,
+    "profile": handle_profile,
+    "memory-usage": handle_memory_usage,
+    "get-history": handle_get_history,
+    "typing": handle_typing,
+    "presence": handle_presence
     # Add more handlers here as needed...
 }
 
 
 # === MAIN HANDLER ===
 
+async def dispatch(conn: Connection, payload):
+    """Validate a single event and run its handler."""
+    try:
+        if not isinstance(payload, dict):
+            await conn.send(json.dumps({"event": "error", "data": {"message": "Invalid payload format"}}))
+            return
+
+        event = payload.get("event")
+        data = payload.get("data")
+        if not event or not isinstance(event, str):
+            await conn.send(json.dumps({"event": "error", "data": {"message": "Invalid or missing event type"}}))
+            return
+
+        if event in event_handlers:
+            if admission.should_defer(event):
+                await defer_event(conn, event, data)
+            else:
+                await run_handler(conn, event, data)
+        else:
+            await conn.send(json.dumps({"event": "error", "data": {"message": f"Unknown event: {event}"}}))
+
+    except websockets.ConnectionClosed:
+        print(f"Connection closed for client {conn.ws}")
+    except Exception as e:
+        print(f"Error handling message: {e}")
+        await conn.send(json.dumps({"event": "error", "data": {"message": "Internal server error"}}))
+
+
+async def run_handler(conn: Connection, event: str, data):
+    start = time.perf_counter()
+    try:
+        await event_handlers[event](conn, data)
+    finally:
+        elapsed = time.perf_counter() - start
+        dispatch_timer.record(event, elapsed)
+        if elapsed > SERVER_CONFIG["slow_handler_threshold"]:
+            print(f"Slow handler: {event} took {elapsed * 1000:.0f}ms")
+
+
+async def defer_event(conn: Connection, event: str, data):
+    """Hold a low-priority event until the load drops, or tell the client to retry it later."""
+    key = (conn, event, json.dumps(data, sort_keys=True))
+    if key in deferred_events:
+        return  # the copy already waiting answers this one too
+
+    if admission.level >= CRITICAL or admission.deferred >= SERVER_CONFIG["max_deferred"]:
+        admission.rejected += 1
+        await conn.send(json.dumps({"event": "overloaded", "data": {"event-type": event, "retry_after": admission.retry_hint()}}))
+        return
+
+    async def run_later():
+        try:
+            if await admission.wait_for_capacity():
+                if conn.ws is not None:
+                    await run_handler(conn, event, data)
+            else:
+                admission.rejected += 1
+                await conn.send(json.dumps({"event": "overloaded", "data": {"event-type": event, "retry_after": admission.retry_hint()}}))
+        except websockets.ConnectionClosed:
+            pass
+        except Exception as e:
+            print(f"Error running deferred {event}: {e}")
+        finally:
+            admission.deferred -= 1
+            deferred_events.discard(key)
+
+    # Run it on its own so the connection's more important events aren't stuck behind it
+    admission.deferred += 1
+    deferred_events.add(key)
+    asyncio.create_task(run_later())
+
+
+def process_request(connection, request):
+    """Turn new connections away with 503 while the server is overloaded."""
+    if admission.admit_connection(len(open_connections)):
+        return None
+    admission.rejected += 1
+    response = connection.respond(HTTPStatus.SERVICE_UNAVAILABLE, "Server overloaded, retry later\n")
+    response.headers["Retry-After"] = str(math.ceil(admission.retry_hint() / 1000))
+    return response
+
+
 async def handler(ws):
     """Main WebSocket handler with heartbeat mechanism."""
+    conn = Connection(ws)
+    open_connections.add(conn)
+    if capture:
+        capture.opened(conn)
     disconnect_event = asyncio.Event()
 
     # Start a background task to send pings
@@ -723,33 +1667,31 @@ async def handler(ws):
     try:
         async for message in ws:
             try:
-                # Parse and validate the payload
                 payload = json.loads(message)
-                if not isinstance(payload, dict):
-                    await ws.send(json.dumps({"event": "error", "data": {"message": "Invalid payload format"}}))
-                    continue
-
-                event = payload.get("event")
-                data = payload.get("data")
-                if not event or not isinstance(event, str):
-                    await ws.send(json.dumps({"event": "error", "data": {"message": "Invalid or missing event type"}}))
-                    continue
-
-                if event in event_handlers:
-                    await event_handlers[event](ws, data)
-                else:
-                    await ws.send(json.dumps({"event": "error", "data": {"message": f"Unknown event: {event}"}}))
-
             except json.JSONDecodeError:
-                await ws.send(json.dumps({"event": "error", "data": {"message": "Invalid JSON format"}}))
-            except websockets.ConnectionClosed:
-                print(f"Connection closed for client {ws}")
-            except Exception as e:
-                print(f"Error handling message: {e}")
-                await ws.send(json.dumps({"event": "error", "data": {"message": "Internal server error"}}))
+                await conn.send(json.dumps({"event": "error", "data": {"message": "Invalid JSON format"}}))
+                continue
+            if capture:
+                capture.frame(conn, payload)
+
+            # Replies to one inbound frame go out together when the client batches
+            conn.cork()
+            try:
+                # A batch envelope carries several events that are dispatched in order
+                if isinstance(payload, dict) and payload.get("event") == "batch":
+                    events = payload.get("data")
+                    if not isinstance(events, list):
+                        await conn.send(json.dumps({"event": "error", "data": {"message": "Invalid batch format"}}))
+                        continue
+                    for item in events:
+                        await dispatch(conn, item)
+                else:
+                    await dispatch(conn, payload)
+            finally:
+                conn.uncork()
 
     except Exception as e:
-        print(f"Unexpected error in handler: {e}")
+        print(f"Unexpected error in handler for {ws.remote_address}: {e}")
     finally:
         # Cancel the heartbeat task
         disconnect_event.set()
@@ -759,45 +1701,188 @@ async def handler(ws):
         except asyncio.CancelledError:
             pass
 
-        # Cleanup on disconnect
-        user = connected_users.pop(ws, None)
-        if user:
-            # Remove the user from all active chats
-            chats_to_delete = []
-            for chatname, chat in active_chats.items():
-                if user in chat.whitelist:
-                    chat.whitelist.remove(user)
-                if user in chat.admin:
-                    chat.admin.remove(user)
-                # If no admins remain, mark the chat for deletion
-                if len(chat.admin) == 0:
-                    chats_to_delete.append(chatname)
-                else:
-                    # Broadcast updated chat details if the chat isn't marked for deletion
-                    focused = focused_chats.get(chatname, [])
-                    await broadcast("update-chat-detail", chat_detail_to_dict(chat), focused)
-
-            # Delete chats with no admins and notify clients
-            for chatname in chats_to_delete:
-                del active_chats[chatname]
-                if chatname in focused_chats:
-                    del focused_chats[chatname]
-                await broadcast("delete-chat", {"chatname": chatname}, connected_users.keys())
-
-        # Remove the WebSocket from focused chats
-        for chat_ws_list in focused_chats.values():
-            if ws in chat_ws_list:
-                chat_ws_list.remove(ws)
-
-        # Broadcast updated user list
-        await broadcast("update-user-list", [user_to_dict(u) for u in connected_users.values()], connected_users.keys())
+        open_connections.discard(conn)
+        if capture:
+            capture.closed(conn)
+
+        # Registered users get a grace period to resume before their memberships are dropped
+        if conn.session is not None and conn in connected_users:
+            suspend_connection(conn)
+        else:
+            await cleanup_connection(conn)
 # === SERVER STARTUP ===
 
+async def drain(servers):
+    """Stop accepting and close every client at its own jittered slot across the drain window."""
+    for server in servers:
+        server.close(close_connections=False)
+
+    clients = list(open_connections)
+    random.shuffle(clients)
+    window = SERVER_CONFIG["drain_window"]
+    slot = window / max(len(clients), 1)
+    print(f"Draining {len(clients)} connections over {window}s")
+
+    async def release(conn, delay):
+        try:
+            await conn.send(json.dumps({"event": "reconnect", "data": {"delay": int(delay * 1000)}}))
+            await asyncio.sleep(delay)
+            await conn.flush()
+            if conn.ws is not None:
+                await conn.ws.close(1001, "Server restarting")  # The close handshake goes out after anything still buffered
+        except websockets.ConnectionClosed:
+            pass
+
+    await asyncio.gather(*(release(conn, (i + random.random()) * slot) for i, conn in enumerate(clients)))
+    for server in servers:
+        await server.wait_closed()
+
+
+async def report_metrics():
+    """Periodically log event loop lag so stalls show up in the server output."""
+    while True:
+        await asyncio.sleep(SERVER_CONFIG["metrics_interval"])
+        lag = lag_monitor.report()
+        print(f"Loop lag: avg {lag['avg_ms']}ms, max {lag['max_ms']}ms; {serializer.offloaded} snapshots offloaded; {watchdog.stalls} stalls")
+        print(f"Load level {LEVEL_NAMES[admission.level]}: {admission.deferred} events deferred, {admission.rejected} rejected")
+        print(f"Connection memory: {memory_budget.total} of {memory_budget.cap} bytes; {memory_budget.trimmed} session logs dropped, {memory_budget.evicted} connections evicted")
+        for stat in dispatch_timer.report():
+            print(f"  {stat['event']}: {stat['count']} calls, {stat['total_ms']}ms total, {stat['max_ms']}ms max")
+
+
+async def watch_load():
+    """Feed loop lag, outbound backlog and connection count to admission control."""
+    while True:
+        await asyncio.sleep(0.5)
+        queued = sum(conn.ws.transport.get_write_buffer_size() for conn in open_connections if conn.ws is not None)
+        previous = admission.level
+        level = admission.update(lag_monitor.avg, queued, len(open_connections))
+        if level != previous:
+            print(f"Load level {LEVEL_NAMES[level]}: lag {lag_monitor.avg * 1000:.0f}ms, {queued} bytes queued, {len(open_connections)} connections")
+        enforce_memory_budget()
+
+
+def tracked_connections() -> Set[Connection]:
+    """Live connections plus suspended sessions, which still hold their replay logs."""
+    return open_connections | set(sessions.values())
+
+
+def enforce_memory_budget():
+    """Drop replay logs over budget and disconnect clients too slow to take their output; see MemoryBudget."""
+    trim, evict = memory_budget.check(tracked_connections())
+    if trim:
+        print(f"Dropped {len(trim)} session logs holding {sum(size for _, size in trim)} bytes "
+              f"({memory_budget.total} bytes held across connections)")
+    for conn, _ in trim:
+        conn.session.clear_log()
+    for conn, size in evict:
+        user = connected_users.get(conn)
+        print(f"Evicting {user.name if user else 'unregistered client'} with {size} bytes unsent "
+              f"({memory_budget.total} bytes held across connections)")
+        conn.evict()
+
+
+async def watch_idle_history():
+    """Periodically spill the history of idle chats, so memory follows the chats in use."""
+    idle_after = SERVER_CONFIG["history_idle_after"]
+    while True:
+        await asyncio.sleep(max(idle_after / 10, 1))
+        spilled = state.apply(spill_idle_history, idle_after, SERVER_CONFIG["history_idle_keep"])
+        if spilled:
+            print(f"Spilled {spilled} messages of idle chats to {cold_history.directory}")
+
+
+def toggle_profiler() -> dict:
+    """Start the sampling profiler, or stop it and write its collapsed stacks."""
+    path = SERVER_CONFIG["profile_path"]
+    if profiler.running:
+        samples = profiler.stop(path)
+        print(f"Profiler stopped, {samples} samples written to {path}")
+        return {"enabled": False, "path": path, "samples": samples}
+    profiler.start()
+    print("Profiler started")
+    return {"enabled": True, "path": path, "samples": 0}
+
+
+def bind_unix_listener(path: str) -> socket.socket:
+    """Bind a listening Unix socket, replacing a stale socket file left by a previous run."""
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(socket.SOMAXCONN)
+    return listener
+
+
 async def main(port_number: int):
     """Start the WebSocket server."""
+    global capture
+    loop = asyncio.get_running_loop()
+    draining = asyncio.Event()
+    handoff_path = SERVER_CONFIG["handoff_path"]
+
     try:
-        async with websockets.serve(handler, "", port_number):
+        # Take over the listening sockets of a running server if one offers them, otherwise bind fresh
+        # Behind a proxy speaking the PROXY protocol, connections report the client's address, not the proxy's
+        # Oversized frames are refused before they are parsed, and a connection's inbound and
+        # outbound buffers are bounded so one slow or abusive client can't pin unbounded memory
+        serve_options = {
+            "process_request": process_request,
+            "create_connection": ProxiedConnection if SERVER_CONFIG["proxy_protocol"] else None,
+            "max_size": SERVER_CONFIG["ws_max_size"],
+            "max_queue": SERVER_CONFIG["ws_max_queue"],
+            "write_limit": SERVER_CONFIG["ws_write_limit"],
+        }
+        listeners = receive_listeners(handoff_path)
+        if listeners:
+            servers = [await websockets.serve(handler, sock=sock, **serve_options) for sock in listeners]
+            print(f"WebSocket server took over listening socket via {handoff_path}")
+        else:
+            servers = [await websockets.serve(handler, "", port_number, **serve_options)]
             print(f"WebSocket server started on port {port_number}")
-            await asyncio.Future()  # Run forever
+            if SERVER_CONFIG["unix_path"]:
+                servers.append(await websockets.unix_serve(handler, SERVER_CONFIG["unix_path"], **serve_options))
+                print(f"WebSocket server listening on {SERVER_CONFIG['unix_path']}")
+
+        # The Api serves the frontend too, so the attachment links it renders resolve against it.
+        # reuse_port lets a restarted server bind alongside the one it takes over from.
+        api = Api(ApiBridge())
+        if SERVER_CONFIG["api_port"]:
+            api_listener = socket.create_server(("", SERVER_CONFIG["api_port"]), reuse_port=True)
+            asyncio.create_task(api.serve(api_listener, SERVER_CONFIG["proxy_protocol"]))
+            print(f"HTTP API listening on port {SERVER_CONFIG['api_port']}")
+        if SERVER_CONFIG["api_unix_path"]:
+            asyncio.create_task(api.serve(bind_unix_listener(SERVER_CONFIG["api_unix_path"]), SERVER_CONFIG["proxy_protocol"]))
+            print(f"HTTP API listening on {SERVER_CONFIG['api_unix_path']}")
+
+        if SERVER_CONFIG["capture_path"]:
+            capture = TrafficCapture(SERVER_CONFIG["capture_path"], SERVER_CONFIG["capture_redact"])
+            print(f"Capturing inbound traffic to {SERVER_CONFIG['capture_path']}")
+
+        asyncio.create_task(lag_monitor.run())
+        watchdog.start()
+        asyncio.create_task(watch_load())
+        asyncio.create_task(watch_idle_history())
+        asyncio.create_task(report_metrics())
+
+        try:
+            loop.add_signal_handler(signal.SIGTERM, draining.set)
+            loop.add_signal_handler(signal.SIGUSR2, toggle_profiler)
+        except NotImplementedError:
+            pass  # No signal handlers on Windows event loops
+
+        if handoff_path:
+            sockets = [sock for server in servers for sock in server.sockets]
+            handoff_task = asyncio.create_task(serve_handoff(handoff_path, sockets, draining.set))
+
+        await draining.wait()
+        if handoff_path:
+            handoff_task.cancel()
+        await drain(servers)
+        print("WebSocket server drained")
     except KeyboardInterrupt:
-        print("\nWebSocket server stopped by user")
\ No newline at end of file
+        print("\nWebSocket server stopped by user")
+    finally:
+        if capture:
+            capture.close()
+        cold_history.close()
@@ -0,0 +1,241 @@
+import asyncio
+import secrets
+
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+
+
+class Session:
+    token: str
+    seq: int
+    log: Deque[Tuple[int, str]]
+    log_bytes: int  # total length of the events in the log
+    expiry: Optional[asyncio.Task]
+
+    def __init__(self, log_size: int, log_max_bytes: int):
+        self.token = secrets.token_hex(16)
+        self.seq = 0
+        self.log = deque(maxlen=log_size)  # (seq, message) pairs kept for replay on resume
+        self.log_bytes = 0
+        self.log_max_bytes = log_max_bytes
+        self.expiry = None
+
+    def record(self, message: str) -> str:
+        """Stamp an outgoing event with the next sequence number and keep it for replay.
+
+        The oldest events are dropped once the log holds more than log_size events or
+        log_max_bytes in total; a resume from before them gets a full resync instead.
+        """
+        self.seq += 1
+        stamped = f'{message[:-1]}, "seq": {self.seq}}}'
+        if len(self.log) == self.log.maxlen:
+            self.log_bytes -= len(self.log[0][1])
+        self.log.append((self.seq, stamped))
+        self.log_bytes += len(stamped)
+        while self.log_bytes > self.log_max_bytes:
+            self.log_bytes -= len(self.log.popleft()[1])
+        return stamped
+
+    def clear_log(self):
+        """Forget every logged event; a later resume gets a full resync instead of a replay."""
+        self.log.clear()
+        self.log_bytes = 0
+
+    def missed(self, seq: int) -> Optional[list]:
+        """Return the events sent after seq, or None if the log no longer reaches back that far."""
+        if seq > self.seq:
+            return None
+        if seq == self.seq:
+            return []
+        if not self.log or self.log[0][0] > seq + 1:
+            return None
+        return [message for s, message in self.log if s > seq]
+
+
+class DeliveryWindow:
+    """Acknowledged delivery for one connection: at most `size` sequenced events in flight,
+    redelivered with exponential backoff until the client acks them cumulatively."""
+    size: int
+    max_held: int
+    acked: int
+    unacked: Deque[Tuple[int, str]]  # (seq, stamped message) sent but not yet acknowledged
+    held: Deque[str]  # waiting for room in the window
+    retransmit_task: Optional[asyncio.Task]
+
+    def __init__(self, size: int, max_held: int, timeout: float, max_timeout: float):
+        self.size = size
+        self.max_held = max_held
+        self.timeout = timeout
+        self.max_timeout = max_timeout
+        self.acked = 0
+        self.unacked = deque()
+        self.held = deque()
+        self.retransmit_task = None
+
+
+class Connection:
+    ws: object  # underlying websocket, None while the session is suspended
+    session: Optional[Session]
+    window: Optional[DeliveryWindow]  # set when the client asked for acknowledged delivery
+    batching: bool  # client asked for events sent in the same tick to share one frame
+    paged: bool  # client pages through the directory instead of receiving full user/chat lists
+    deltas: bool  # client can apply append-message deltas in place of chat snapshots
+    history: int  # messages per chat snapshot for clients that load older ones on demand (0 for all)
+    corked: bool  # hold queued events until the inbound frame being handled is done
+    pending: List[str]
+    flush_task: Optional[asyncio.Task]
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.session = None
+        self.window = None
+        self.batching = False
+        self.paged = False
+        self.deltas = False
+        self.history = 0
+        self.corked = False
+        self.pending = []
+        self.flush_task = None
+
+    async def send(self, message: str):
+        if self.window is not None and self.session is not None and self.ws is not None:
+            self.window.held.append(message)
+            await self._fill_window()
+            return
+        if self.session is not None:
+            message = self.session.record(message)
+        await self._transmit(message)
+
+    async def send_ephemeral(self, message: str):
+        """Send an event outside the session: never sequenced, kept for replay or redelivered.
+        Dropped while suspended or while the socket still has unsent output, since a newer
+        value follows soon anyway."""
+        if self.ws is None or self.ws.transport.get_write_buffer_size() > 0:
+            return
+        await self._transmit(message)
+
+    async def _transmit(self, message: str):
+        if self.ws is None:
+            return
+        if self.batching:
+            self.pending.append(message)
+            self._schedule_flush()
+        else:
+            await self.ws.send(message)
+
+    async def _fill_window(self):
+        """Sequence and send held events while the window has room."""
+        window = self.window
+        if len(window.held) > window.max_held:
+            # Too far behind to catch up by acks; the client resumes from the session log instead
+            print(f"Client {self.ws} fell {len(window.held)} events behind, closing")
+            asyncio.create_task(self.ws.close(1013, "Too far behind"))
+            self.detach()
+            return
+
+        while window.held and len(window.unacked) < window.size and self.ws is not None:
+            stamped = self.session.record(window.held.popleft())
+            window.unacked.append((self.session.seq, stamped))
+            await self._transmit(stamped)
+
+        if window.unacked and window.retransmit_task is None:
+            window.retransmit_task = asyncio.create_task(self._retransmit())
+
+    async def _retransmit(self):
+        """Resend everything in flight whenever acks stop making progress, backing off each time."""
+        window = self.window
+        timeout = window.timeout
+        try:
+            while window.unacked and self.ws is not None:
+                acked = window.acked
+                await asyncio.sleep(timeout)
+                if window.acked != acked:
+                    timeout = window.timeout
+                    continue
+                for _, stamped in list(window.unacked):
+                    await self._transmit(stamped)
+                timeout = min(timeout * 2, window.max_timeout)
+        except Exception as e:
+            print(f"Error redelivering to client {self.ws}: {e}")
+        finally:
+            window.retransmit_task = None
+
+    async def ack(self, seq: int):
+        """Cumulatively acknowledge every event up to seq and refill the window."""
+        window = self.window
+        if window is None or self.session is None:
+            return
+        seq = min(seq, self.session.seq)
+        if seq <= window.acked:
+            return
+        window.acked = seq
+        while window.unacked and window.unacked[0][0] <= seq:
+            window.unacked.popleft()
+        await self._fill_window()
+
+    def detach(self):
+        """Drop the socket, keeping anything not yet sequenced in the session log for replay."""
+        self.ws = None
+        if self.window is not None:
+            if self.window.retransmit_task is not None:
+                self.window.retransmit_task.cancel()
+            while self.window.held and self.session is not None:
+                self.session.record(self.window.held.popleft())
+
+    def evict(self):
+        """Free everything a client too slow to read its output holds, and drop the socket at
+        once without waiting for that output. The session survives, so the client can resume
+        into a resync."""
+        self.pending.clear()
+        if self.window is not None:
+            self.window.held.clear()
+            self.window.unacked.clear()
+        if self.session is not None:
+            self.session.clear_log()
+        if self.ws is not None:
+            self.ws.transport.abort()
+
+    def cork(self):
+        self.corked = True
+
+    def uncork(self):
+        self.corked = False
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self.pending and not self.corked and self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._write_pending())
+
+    async def _write_pending(self):
+        """Write everything queued since the last tick as a single frame."""
+        try:
+            while self.pending and self.ws is not None:
+                pending, self.pending = self.pending, []
+                if len(pending) == 1:
+                    await self.ws.send(pending[0])
+                else:
+                    await self.ws.send(f'{{"event": "batch", "data": [{", ".join(pending)}]}}')
+        except Exception as e:
+            print(f"Error flushing to client {self.ws}: {e}")
+        finally:
+            self.flush_task = None
+
+    async def flush(self):
+        """Wait until every queued event has been handed to the socket."""
+        while self.flush_task is not None:
+            await asyncio.shield(self.flush_task)
+
+    async def replay(self, seq: int) -> Optional[int]:
+        """Resend the events the client missed after seq. Returns how many were sent, or None on a gap."""
+        missed = self.session.missed(seq)
+        if self.window is not None:
+            # Replayed events are in flight again; anything older the client can no longer ask for
+            self.window.acked = self.session.seq if missed is None else seq
+            self.window.unacked = deque((s, message) for s, message in self.session.log if s > self.window.acked)
+            if self.window.unacked and self.window.retransmit_task is None:
+                self.window.retransmit_task = asyncio.create_task(self._retransmit())
+        if missed is None:
+            return None
+        for message in missed:
+            await self.ws.send(message)
+        return len(missed)
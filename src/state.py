@@ -0,0 +1,72 @@
+import inspect
+
+from typing import Callable, Dict, List, Tuple
+
+from src.directory import PrefixIndex
+
+
+class StateEngine:
+    """Owns the shared chat state.
+
+    Every mutation is a plain (non-async) command function run through apply(), so it
+    completes without yielding to the event loop and no two writers ever interleave.
+    Readers that hold on to state across an await take a snapshot instead of iterating
+    the live dicts; snapshots are immutable tuples cached until the next mutation.
+    """
+    users: Dict[object, object]  # connection -> User
+    chats: Dict[str, object]  # chatname -> Chat
+    focused: Dict[str, List[object]]  # chatname -> connections viewing it
+    sessions: Dict[str, object]  # resume token -> connection holding the session
+    names: Dict[str, object]  # username -> connection
+    user_directory: PrefixIndex
+    chat_directory: PrefixIndex
+    version: int
+
+    def __init__(self):
+        self.users = {}
+        self.chats = {}
+        self.focused = {}
+        self.sessions = {}
+        self.names = {}
+        self.user_directory = PrefixIndex()
+        self.chat_directory = PrefixIndex()
+        self.version = 0
+        self._snapshots = {}
+        self._applying = False
+
+    def apply(self, command: Callable, *args):
+        """Run a command against the state and return its result."""
+        if self._applying:
+            raise RuntimeError(f"{command.__name__} applied from inside another command")
+        self._applying = True
+        try:
+            result = command(self, *args)
+        finally:
+            self._applying = False
+            self.version += 1
+            self._snapshots.clear()
+        if inspect.isawaitable(result):
+            raise TypeError(f"{command.__name__} must not be a coroutine")
+        return result
+
+    def _snapshot(self, key, build) -> Tuple:
+        snapshot = self._snapshots.get(key)
+        if snapshot is None:
+            snapshot = self._snapshots[key] = tuple(build())
+        return snapshot
+
+    def clients(self) -> Tuple:
+        """Every registered connection."""
+        return self._snapshot("clients", self.users.keys)
+
+    def user_items(self) -> Tuple:
+        """(connection, user) pairs for every registered connection."""
+        return self._snapshot("user_items", self.users.items)
+
+    def chat_items(self) -> Tuple:
+        """(chatname, chat) pairs for every chat."""
+        return self._snapshot("chat_items", self.chats.items)
+
+    def audience(self, chatname: str) -> Tuple:
+        """Connections currently viewing a chat."""
+        return self._snapshot(("audience", chatname), lambda: self.focused.get(chatname, ()))
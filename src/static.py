@@ -0,0 +1,66 @@
+import asyncio
+import mimetypes
+import os
+
+from typing import Dict, Optional, Tuple
+
+from src.response import available_encodings, compress, is_compressible
+
+
+class StaticFiles:
+    """Serves files from a directory, keeping a compressed copy of each in every supported encoding.
+
+    Variants are built once per file version, on first request, at maximum compression,
+    on a worker thread. Prebuilt foo.js.gz / foo.js.br files sitting next to an asset are
+    used as they are. A file that changes on disk is picked up by its mtime.
+    """
+    root: str
+    cache: Dict[str, Tuple[float, str, Dict[Optional[str], bytes]]]  # path -> (mtime, content type, encoding -> body)
+
+    def __init__(self, root: str, min_size: int = 1024):
+        self.root = os.path.abspath(root)
+        self.min_size = min_size
+        self.cache = {}
+
+    def resolve(self, requested_path: str) -> Optional[str]:
+        """Map a URL path to a file under the root, or None if it points outside it."""
+        if requested_path.endswith("/"):
+            requested_path = "/index.html"
+        file_path = os.path.abspath(os.path.join(self.root, requested_path.lstrip("/")))
+        if file_path != self.root and not file_path.startswith(self.root + os.sep):
+            return None
+        return file_path
+
+    async def load(self, file_path: str) -> Tuple[str, Dict[Optional[str], bytes]]:
+        """Content type and every available variant of a file. Raises FileNotFoundError."""
+        mtime = os.stat(file_path).st_mtime
+        cached = self.cache.get(file_path)
+        if cached and cached[0] == mtime:
+            return cached[1], cached[2]
+
+        content_type, _ = mimetypes.guess_type(file_path)
+        content_type = content_type or "application/octet-stream"
+        loop = asyncio.get_running_loop()
+        variants = await loop.run_in_executor(None, self._build_variants, file_path, content_type)
+        self.cache[file_path] = (mtime, content_type, variants)
+        return content_type, variants
+
+    def _build_variants(self, file_path: str, content_type: str) -> Dict[Optional[str], bytes]:
+        with open(file_path, "rb") as f:
+            body = f.read()
+        variants = {None: body}
+        if len(body) < self.min_size or not is_compressible(content_type):
+            return variants
+
+        for encoding in available_encodings():
+            suffix = ".br" if encoding == "br" else ".gz"
+            try:
+                with open(file_path + suffix, "rb") as f:
+                    variants[encoding] = f.read()
+                continue
+            except FileNotFoundError:
+                pass
+            compressed = compress(body, encoding, level=9)
+            if len(compressed) < len(body):
+                variants[encoding] = compressed
+        return variants
@@ -0,0 +1,222 @@
+"""Per-handler micro-benchmarks against synthetic state, with no sockets involved.
+
+Handlers are driven through FakeWebSocket, which records what would have been sent; a
+benchmark whose warm-up call is answered with an error fails instead of being timed.
+Each benchmark is timed while one state dimension (users, chats, room size, history
+length) is swept and the others stay at their defaults. The result is a scaling curve
+per handler and dimension, with a fitted exponent: roughly 0 means the cost doesn't
+depend on that dimension, 1 means it grows linearly.
+
+    python tools/bench.py
+    python tools/bench.py --only post_message --out new.json
+    python tools/bench.py --compare old.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src import server  # noqa: E402
+from src.directory import PrefixIndex  # noqa: E402
+from src.session import Connection, Session  # noqa: E402
+
+DEFAULTS = {"users": 1000, "chats": 100, "room": 50, "history": 1000}
+SWEEPS = {
+    "users": [100, 1000, 10000],
+    "chats": [10, 100, 1000],
+    "room": [10, 100, 1000],
+    "history": [100, 1000, 10000],
+}
+
+
+class FakeWebSocket:
+    """Stands in for a websockets connection: sends are counted instead of written."""
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.last = None
+        self.remote_address = ("127.0.0.1", 0)
+
+    async def send(self, message: str):
+        self.frames += 1
+        self.bytes += len(message)
+        self.last = message
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        pass
+
+
+def build_world(users: int, chats: int, room: int, history: int) -> list:
+    """Replace the server's state with synthetic users and chats. Returns the connections.
+
+    chat-0 is the room under test: its first `room` users are viewing it and it holds
+    `history` messages. Every other chat is public with a single member.
+    """
+    state = server.state
+    for table in (state.users, state.chats, state.focused, state.sessions, state.names):
+        table.clear()
+    state.user_directory = PrefixIndex()
+    state.chat_directory = PrefixIndex()
+    state._snapshots.clear()
+
+    conns = []
+    for i in range(max(users, room)):
+        conn = Connection(FakeWebSocket())
+        state.apply(server.register_connection, conn, server.User(f"user-{i}", i % 5), Session(16, 1024 * 1024))
+        conns.append(conn)
+
+    for i in range(chats):
+        admin = server.connected_users[conns[i % len(conns)]]
+        state.apply(server.add_chat, server.Chat(f"chat-{i}", 1, admin, True), admin)
+
+    room_chat = server.active_chats["chat-0"]
+    for conn in conns[:room]:
+        state.apply(server.focus_chat, conn, room_chat, server.connected_users[conn])
+    for i in range(history):
+        author = server.connected_users[conns[i % room]]
+        state.apply(server.add_message, room_chat, server.Message(author, f"synthetic message number {i} about nothing"))
+    return conns
+
+
+async def bench_post_message(conns):
+    await server.handle_post_message(conns[0], {"chatname": "chat-0", "message": "hello there"})
+
+
+async def bench_open_chat(conns):
+    await server.handle_open_chat(conns[1], {"chatname": "chat-0"})
+
+
+async def bench_encode_chat_detail(conns):
+    server.encode_chat_detail(server.active_chats["chat-0"])
+
+
+async def bench_chat_detail_event(conns):
+    await server.chat_detail_event(server.active_chats["chat-0"])
+
+
+async def bench_user_list_event(conns):
+    await server.user_list_event()
+
+
+async def bench_broadcast(conns):
+    await server.broadcast("update-user-list", {"username": "someone", "pfp": 1}, server.state.audience("chat-0"))
+
+
+async def bench_get_data(conns):
+    await server.handle_get_data(conns[0], {})
+
+
+async def bench_query_users(conns):
+    await server.handle_query_users(conns[0], {"prefix": "user-1", "limit": 50})
+
+
+async def bench_search_messages(conns):
+    await server.handle_search_messages(conns[0], {"chatname": "chat-0", "query": "message number"})
+
+
+async def bench_search_messages_global(conns):
+    # Every chat but chat-0 is empty, so most of them lack the query's terms
+    await server.handle_search_messages(conns[0], {"query": "message number"})
+
+
+BENCHMARKS = {name[len("bench_"):]: fn for name, fn in globals().items() if name.startswith("bench_")}
+
+
+def check_replies(fn, conns):
+    """Fail a benchmark whose handler answered with an error, rather than timing the error path."""
+    for conn in conns:
+        if conn.ws.last is not None and json.loads(conn.ws.last)["event"] == "error":
+            raise RuntimeError(f"{fn.__name__} got an error reply: {conn.ws.last}")
+
+
+async def measure(fn, conns, budget: float) -> float:
+    """Median seconds per call, over repeated runs sized to fill the time budget."""
+    for conn in conns:
+        conn.ws.last = None
+    await fn(conns)  # warm up caches and the serializer pool
+    check_replies(fn, conns)
+    start = time.perf_counter()
+    await fn(conns)
+    once = max(time.perf_counter() - start, 1e-7)
+    number = max(1, min(1000, int(budget / 5 / once)))
+
+    runs = []
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(number):
+            await fn(conns)
+        runs.append((time.perf_counter() - start) / number)
+    return statistics.median(runs)
+
+
+def exponent(points) -> float:
+    """Slope of log(time) over log(size) between the smallest and largest sizes."""
+    (x0, y0), (x1, y1) = points[0], points[-1]
+    return math.log(y1 / y0) / math.log(x1 / x0)
+
+
+async def run(args) -> dict:
+    results = {}
+    for name, fn in BENCHMARKS.items():
+        if args.only and name not in args.only:
+            continue
+        for dimension, sizes in SWEEPS.items():
+            points = []
+            for size in sizes:
+                params = dict(DEFAULTS, **{dimension: size})
+                conns = build_world(**params)
+                points.append((size, await measure(fn, conns, args.budget)))
+            results[f"{name}/{dimension}"] = {
+                "times_us": {str(size): round(seconds * 1e6, 2) for size, seconds in points},
+                "exponent": round(exponent(points), 2),
+            }
+    return results
+
+
+def print_report(results: dict, baseline: dict, tolerance: float) -> bool:
+    regressed = False
+    for key, result in results.items():
+        curve = "  ".join(f"{size:>6}: {us:>10.1f}us" for size, us in result["times_us"].items())
+        line = f"{key:<32} {curve}   n^{result['exponent']:.2f}"
+        before = baseline.get(key) if baseline else None
+        if before:
+            largest = list(result["times_us"])[-1]
+            ratio = result["times_us"][largest] / before["times_us"][largest]
+            line += f"   was n^{before['exponent']:.2f}, {ratio:.2f}x at {largest}"
+            if ratio > tolerance or result["exponent"] > before["exponent"] + 0.3:
+                line += "  REGRESSION"
+                regressed = True
+        print(line)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--only", nargs="*", choices=sorted(BENCHMARKS), help="benchmarks to run (default all)")
+    parser.add_argument("--budget", type=float, default=0.2, help="seconds to spend per measurement")
+    parser.add_argument("--out", help="write results here as JSON")
+    parser.add_argument("--compare", help="results from another build; exits non-zero on regressions")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="slowdown at the largest size counted as a regression")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    regressed = print_report(results, baseline, args.tolerance)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
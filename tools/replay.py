@@ -0,0 +1,149 @@
+"""Replay a traffic capture against a running server and report latency and throughput.
+
+Each connection in the capture becomes a virtual client that sends its frames on the
+recorded schedule, scaled by --speed (0 sends everything as fast as possible). Latency is
+the time from sending a frame to the next frame the server sends back on that connection.
+
+    python tools/replay.py capture.jsonl --url ws://localhost:3000 --speed 4 --out new.json
+    python tools/replay.py capture.jsonl --compare old.json
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from collections import deque
+from typing import Dict, List
+
+import websockets
+
+
+def load_capture(path: str) -> Dict[int, List[dict]]:
+    """Group the capture's records by connection, in recorded order."""
+    connections = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if "conn" in record:
+                connections.setdefault(record["conn"], []).append(record)
+    return connections
+
+
+class Results:
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.failed = 0
+        self.latencies: List[float] = []
+
+
+async def run_client(url: str, records: List[dict], speed: float, start: float, results: Results):
+    async def wait_until(t: float):
+        if speed > 0:
+            delay = start + t / speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    await wait_until(records[0]["t"])
+    try:
+        ws = await websockets.connect(url, max_size=None)
+    except Exception as e:
+        print(f"Connect failed: {e}")
+        results.failed += 1
+        return
+
+    outstanding = deque()  # send times waiting for the server's next frame
+
+    async def read():
+        async for message in ws:
+            if '"event": "heartbeat"' in message[:40]:
+                continue
+            results.received += 1
+            if outstanding:
+                results.latencies.append(time.monotonic() - outstanding.popleft())
+
+    reader = asyncio.create_task(read())
+    try:
+        for record in records:
+            if "frame" not in record:
+                continue
+            await wait_until(record["t"])
+            outstanding.append(time.monotonic())
+            await ws.send(json.dumps(record["frame"]))
+            results.sent += 1
+
+        # Give the last replies a moment to arrive before hanging up. The recorded close is
+        # when the server noticed the disconnect, which can trail the client by a lot.
+        await asyncio.sleep(0.5)
+    except websockets.ConnectionClosed:
+        results.failed += 1
+    finally:
+        await ws.close()
+        reader.cancel()
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def summarize(results: Results, elapsed: float) -> dict:
+    latencies = sorted(results.latencies)
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "sent": results.sent,
+        "received": results.received,
+        "failed": results.failed,
+        "sent_per_s": round(results.sent / elapsed, 1),
+        "received_per_s": round(results.received / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000 if latencies else 0.0, 2),
+    }
+
+
+def print_report(summary: dict, baseline: dict = None):
+    for key, value in summary.items():
+        line = f"{key:>16} {value:>12}"
+        if baseline and key in baseline:
+            before = baseline[key]
+            change = f"{(value - before) / before * 100:+.1f}%" if before else "n/a"
+            line += f"   was {before:>12}  ({change})"
+        print(line)
+
+
+async def replay(args):
+    connections = load_capture(args.capture)
+    results = Results()
+    start = time.monotonic()
+    await asyncio.gather(*(
+        run_client(args.url, records, args.speed, start, results)
+        for records in connections.values()
+    ))
+    return summarize(results, time.monotonic() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("capture", help="JSONL file written by the server's capture_path setting")
+    parser.add_argument("--url", default="ws://localhost:3000")
+    parser.add_argument("--speed", type=float, default=1.0, help="time scale; 0 replays as fast as possible")
+    parser.add_argument("--out", help="write the summary here as JSON")
+    parser.add_argument("--compare", help="summary from another build to report deltas against")
+    args = parser.parse_args()
+
+    summary = asyncio.run(replay(args))
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(summary, baseline)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""Soak the server with connect/churn/post cycles and fail if memory keeps growing.
+
+The server runs in this process so its objects can be inspected. Each cycle connects a
+batch of clients that register, create and open chats, post, send each other inbox
+messages and then leave, some cleanly and some by dropping the socket. Once the server
+has cleaned up, live objects are counted by type and a tracemalloc snapshot is taken.
+After the warmup cycles, the average growth per cycle must stay within the budgets.
+
+    python tools/soak.py --hours 2
+    python tools/soak.py --cycles 50 --clients 100
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import websockets
+
+from config import SERVER_CONFIG
+
+# Short grace periods and caches, so whatever a cycle leaves behind is a leak rather than retention
+SERVER_CONFIG.update(session_grace=0.2, dedup_ttl=0.5)
+
+from src import server  # noqa: E402
+
+TRACKED = ("User", "Chat", "Message", "Connection", "Session", "ServerConnection", "Task", "Future")
+
+
+def count_objects() -> Counter:
+    gc.collect()
+    counts = Counter(type(obj).__name__ for obj in gc.get_objects())
+    return Counter({name: counts[name] for name in TRACKED})
+
+
+async def run_client(url: str, cycle: int, index: int, peers: int, messages: int):
+    ws = await websockets.connect(url)
+    name = f"soak-{cycle}-{index}"
+    chatname = f"room-{cycle}-{index % 5}"
+
+    async def read():
+        # Acknowledge inbox messages like a real client, so mailboxes drain
+        async for raw in ws:
+            message = json.loads(raw)
+            events = message["data"] if message["event"] == "batch" else [message]
+            for event in events:
+                if event["event"] == "update-inbox":
+                    await ws.send(json.dumps({"event": "ack-inbox", "data": {"ids": [event["data"]["id"]]}}))
+
+    reader = asyncio.create_task(read())
+    try:
+        await ws.send(json.dumps({"event": "hello", "data": {"batch": True, "paged": random.random() < 0.5}}))
+        await ws.send(json.dumps({"event": "register-user", "data": {"username": name, "pfp": 1}}))
+        if index < 5:
+            await ws.send(json.dumps({"event": "create-chat", "data": {"chatname": chatname, "pfp": 1, "public": True}}))
+        await asyncio.sleep(0.1)
+        await ws.send(json.dumps({"event": "open-chat", "data": {"chatname": chatname}}))
+        for i in range(messages):
+            await ws.send(json.dumps({"event": "post-message", "data": {"chatname": chatname, "message": f"message {i} from {name}"}}))
+            await ws.send(json.dumps({"event": "inbox", "data": {"username": f"soak-{cycle}-{random.randrange(peers)}", "message": "hi"}}))
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.2)
+    finally:
+        reader.cancel()
+        if index % 3 == 0:
+            ws.transport.abort()  # vanish without a close handshake
+        else:
+            await ws.close()
+
+
+async def wait_for_cleanup(timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not server.open_connections and not server.connected_users and not server.active_chats:
+            return True
+        await asyncio.sleep(0.1)
+    return False
+
+
+async def soak(args) -> bool:
+    async with websockets.serve(server.handler, "127.0.0.1", 0) as ws_server:
+        url = f"ws://127.0.0.1:{ws_server.sockets[0].getsockname()[1]}"
+        tracemalloc.start(args.frames)
+        deadline = time.monotonic() + args.hours * 3600 if args.hours else None
+        baseline_counts = baseline_snapshot = None
+        cycle = 0
+
+        while (deadline and time.monotonic() < deadline) or (not deadline and cycle < args.cycles):
+            started = time.monotonic()
+            await asyncio.gather(*(run_client(url, cycle, i, args.clients, args.messages) for i in range(args.clients)))
+            if not await wait_for_cleanup(SERVER_CONFIG["session_grace"] + 15):
+                print(f"cycle {cycle}: server still holds {len(server.open_connections)} sockets, "
+                      f"{len(server.connected_users)} users, {len(server.active_chats)} chats after disconnect")
+            # Mail for users who left before reading it is kept by design; clear it so it isn't counted as growth
+            for username in list(server.mailboxes.boxes):
+                server.mailboxes.ack(username, list(server.mailboxes.boxes[username]))
+
+            counts = count_objects()
+            traced, _ = tracemalloc.get_traced_memory()
+            print(f"cycle {cycle}: {time.monotonic() - started:.1f}s, {traced / 1024:.0f} KiB traced, "
+                  + ", ".join(f"{name} {counts[name]}" for name in TRACKED))
+
+            if cycle == args.warmup:
+                baseline_counts, baseline_traced = counts, traced
+                baseline_snapshot = tracemalloc.take_snapshot()
+            cycle += 1
+
+        if baseline_counts is None:
+            print("Not enough cycles past the warmup to measure growth")
+            return True
+
+        measured = cycle - 1 - args.warmup
+        if measured == 0:
+            return True
+        failed = False
+        for name in TRACKED:
+            growth = (counts[name] - baseline_counts[name]) / measured
+            if growth > args.object_budget:
+                print(f"LEAK: {name} grew by {growth:.1f} objects per cycle (budget {args.object_budget})")
+                failed = True
+        growth = (traced - baseline_traced) / measured
+        if growth > args.byte_budget:
+            print(f"LEAK: traced memory grew by {growth:.0f} bytes per cycle (budget {args.byte_budget})")
+            failed = True
+
+        if failed:
+            print("Largest allocation growth since the warmup:")
+            for stat in tracemalloc.take_snapshot().compare_to(baseline_snapshot, "traceback")[:10]:
+                print(f"  {stat.size_diff / 1024:+.1f} KiB in {stat.count_diff:+d} blocks")
+                for line in stat.traceback.format()[-args.frames * 2:]:
+                    print(f"    {line}")
+        else:
+            print(f"No growth beyond budget over {measured} cycles")
+        return not failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cycles", type=int, default=20, help="cycles to run when --hours isn't given")
+    parser.add_argument("--hours", type=float, default=0, help="run for this long instead of a fixed cycle count")
+    parser.add_argument("--clients", type=int, default=50, help="clients connected per cycle")
+    parser.add_argument("--messages", type=int, default=10, help="messages each client posts per cycle")
+    parser.add_argument("--warmup", type=int, default=3, help="cycles to run before taking the baseline")
+    parser.add_argument("--object-budget", type=float, default=1.0, help="allowed growth per tracked type per cycle")
+    parser.add_argument("--byte-budget", type=float, default=64 * 1024, help="allowed traced memory growth per cycle")
+    parser.add_argument("--frames", type=int, default=5, help="traceback depth tracemalloc records")
+    args = parser.parse_args()
+
+    sys.exit(0 if asyncio.run(soak(args)) else 1)
+
+
+if __name__ == "__main__":
+    main()